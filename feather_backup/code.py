@@ -6,6 +6,11 @@ import adafruit_bmp3xx
 import adafruit_ahtx0
 import time
 import pwmio
+import struct
+import binascii
+
+BINARY_SYNC = b"\xa5\x5a"  # marks the start of every binary frame
+COMMAND_BUFFER_SIZE = 256  # longest command frame accepted, batched commands included
 
 def init_sensors(i2c):
     """
@@ -48,49 +53,54 @@ def init_sensors(i2c):
         return "Error connecting to one or more of the sensors"
 
 
-def receive_command(port):
+def read_commands(port):
     """
-    Receives a command from the pc over the specified port. Command is sent bit by bit but will be of form <TYPE, VAL>
-
+    Reads whatever the pc has written without waiting and returns every command it completes. Bytes are read with
+    in_waiting sized reads into the preallocated command_buffer, and only the new bytes are scanned, so a command split
+    across reads is finished on a later call. A frame is of the form <TYPE,VAL,...> and may batch several commands
+    separated by ';', e.g. <P,30000;D,1>, which are returned in order. A '<' restarts the frame, and bytes outside a
+    frame or in a frame longer than the buffer are discarded
     :param port: the port the pc is writing to
-    :return: the command in the form <type, val>
-    """
-
-    # Ensure Port Connection
-    if port is None:
-        return "Trouble connecting to port"
-
-    # Receive command from PC
-    command_received = False  # start with assuming no command has been received yet
-    value = ""  # empty string to contain each value for the command
-    # e.g. this lets me store '11' in the list rather than '1','1'
-    while True:  # loop indefinitely
-        byte_read = port.read(1)  # read 1 byte from computer
-
-        if not command_received:  # if command hasn't yet been received
-            if byte_read == b"<":  # start message
-                command = []
-                command_received = True
-                continue  # do not record the "<"
-
-        if command_received:  # if command has started to be recieved
-            if byte_read == b">":  # if command ended break loop
-                command.append(value)
-                break
-            elif byte_read == b",":  # skip if byte is ','
-                command.append(value)
-                value = ""
-            else:
-                value = value + byte_read.decode('utf-8')
-    return command
+    :return: a list of commands, each a list of strings of the form [type, val, ...], empty if none is complete
+    """
+    global command_length, frame_start
+
+    waiting = port.in_waiting
+    if not waiting:
+        return []
+    if command_length == COMMAND_BUFFER_SIZE:  # a frame that never ended filled the buffer: drop it
+        command_length = 0
+        frame_start = -1
+    end = command_length + port.readinto(command_view[command_length:min(command_length + waiting,
+                                                                          COMMAND_BUFFER_SIZE)])
+    commands = []
+    for index in range(command_length, end):
+        byte = command_buffer[index]
+        if byte == 60:  # '<' starts a frame
+            frame_start = index + 1
+        elif byte == 62 and frame_start >= 0:  # '>' ends it
+            frame = str(command_buffer[frame_start:index], "ascii")
+            for command in frame.split(";"):
+                commands.append(command.split(","))
+            frame_start = -1
+
+    if frame_start < 0:  # no frame is open: keep nothing
+        command_length = 0
+    else:  # move the body of the unfinished frame to the front of the buffer
+        command_length = end - frame_start
+        command_buffer[0:command_length] = command_buffer[frame_start:end]
+        frame_start = 0
+    return commands
 
 
 def handle_command(command):
     """
-    Interprets and acts on the command from receive_command().
+    Interprets and acts on a command from read_commands().
     :param command: the command in form "type, val"
     :return: True when finished
     """
+    global streaming, stream_period_ns, next_sample_ns, frame_format, lwlp_reads, ambient_reads, lwlp_window
+    global bmp_interval_ns, aht_interval_ns
 
     if command[0] == 'D':  # command requesting data
         num_samples = int(command[1])
@@ -99,28 +109,163 @@ def handle_command(command):
     elif command[0] == 'P':  # command updating pwm value
         pwm_val = int(command[1])
         send_pwm(pwm_val)
+        reset_lwlp_average()  # reads taken at the old duty do not belong in the next sample
 
+    elif command[0] == 'S':  # command starting a continuous stream at rate_hz (0 = as fast as possible)
+        rate_hz = float(command[1])
+        stream_period_ns = int(1000000000 / rate_hz) if rate_hz > 0 else 0
+        next_sample_ns = time.monotonic_ns()
+        streaming = True
 
-def get_data(bmp, aht, lwlp):
+    elif command[0] == 'X':  # command stopping the stream
+        streaming = False
+
+    elif command[0] == 'F':  # command selecting the frame format, 0 = ascii, 1 = binary, 2 = extended ascii
+        frame_format = int(command[1])
+
+    elif command[0] == 'A':  # command setting on-device averaging: <A, lwlp reads> or <A, lwlp reads, ambient reads>
+        lwlp_reads = max(int(command[1]), 1)
+        ambient_reads = max(int(command[2]), 1) if len(command) > 2 else 1
+        lwlp_window = [[0.0, 0.0] for _ in range(lwlp_reads)]
+        reset_lwlp_average()
+
+    elif command[0] == 'I':  # command setting the ambient read intervals in ms: <I, bmp ms, aht ms>, 0 = every sample
+        bmp_interval_ns = max(int(command[1]), 0) * 1000000
+        aht_interval_ns = max(int(command[2]), 0) * 1000000 if len(command) > 2 else bmp_interval_ns
+
+
+def read_bmp(bmp):
+    """
+    Reads the bmp ambient_reads times and caches the mean
+    :param bmp: bmp sensor object
+    :return: None
+    """
+    global bmp_read_ns
+
+    pressure = 0.0
+    temperature = 0.0
+    for _ in range(ambient_reads):
+        pressure += bmp.pressure
+        temperature += bmp.temperature
+    ambient_cache[0] = pressure / ambient_reads
+    ambient_cache[1] = temperature / ambient_reads
+    bmp_read_ns = time.monotonic_ns()
+
+
+def read_aht(aht):
+    """
+    Reads the aht ambient_reads times and caches the mean
+    :param aht: aht sensor object
+    :return: None
+    """
+    global aht_read_ns
+
+    humidity = 0.0
+    temperature = 0.0
+    for _ in range(ambient_reads):
+        humidity += aht.relative_humidity
+        temperature += aht.temperature
+    ambient_cache[2] = humidity / ambient_reads
+    ambient_cache[3] = temperature / ambient_reads
+    aht_read_ns = time.monotonic_ns()
+
+
+def refresh_ambient(bmp, aht, idle=False):
     """
-    Fetches data from each of the sensors and returns it in the form of a list
+    Reads each ambient sensor whose interval has run out. A sensor with an interval of 0 is read for every sample,
+    so it is never read while idle
     :param bmp: bmp sensor object
     :param aht: aht sensor object
-    :param lwlp: lwlp sensor object
-    :return: list of data in form [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+    :param idle: True when called between streamed samples rather than for a sample
+    :return: True if a sensor was read
     """
 
-    data = [bmp.pressure, bmp.temperature, aht.relative_humidity, aht.temperature]
+    now = time.monotonic_ns()
+    bmp_due = bmp_read_ns is None or now - bmp_read_ns >= bmp_interval_ns
+    aht_due = aht_read_ns is None or now - aht_read_ns >= aht_interval_ns
+    if idle:
+        bmp_due = bmp_due and bmp_interval_ns > 0
+        aht_due = aht_due and aht_interval_ns > 0
+    if bmp_due:
+        read_bmp(bmp)
+    if aht_due:
+        read_aht(aht)
+    return bmp_due or aht_due
+
+
+def ambient_ages_ms():
+    """
+    Ages of the cached ambient values
+    :return: [bmp age, aht age] in ms, capped at 65535
+    """
+
+    now = time.monotonic_ns()
+    return [min((now - bmp_read_ns) // 1000000, 65535), min((now - aht_read_ns) // 1000000, 65535)]
+
+
+def read_lwlp(lwlp):
+    """
+    Reads the lwlp once
+    :param lwlp: lwlp sensor object
+    :return: [lwlp pressure, lwlp temp]
+    """
 
-    # get data from lwlp
     lwlp.i2c.try_lock()
     lwlp_data = lwlp.get_filter_data()
-
-    data.append(lwlp_data[0])
-    data.append(lwlp_data[1])
     lwlp.i2c.unlock()
+    return [lwlp_data[0], lwlp_data[1]]
+
+
+def accumulate_lwlp(lwlp):
+    """
+    Adds one lwlp read to the window averaged into the next sample. Once the window holds lwlp_reads reads, each new
+    read replaces the oldest, so a long wait between samples neither grows a sum nor dilutes the average with old reads
+    :param lwlp: lwlp sensor object
+    :return: None
+    """
+    global lwlp_count, lwlp_next
+
+    lwlp_window[lwlp_next] = read_lwlp(lwlp)
+    lwlp_next = (lwlp_next + 1) % lwlp_reads
+    lwlp_count = min(lwlp_count + 1, lwlp_reads)
+
+
+def reset_lwlp_average():
+    """
+    Empties the lwlp window
+    :return: None
+    """
+    global lwlp_count, lwlp_next
+
+    lwlp_count = 0
+    lwlp_next = 0
+
+
+def get_data(bmp, aht, lwlp):
+    """
+    Fetches data from each of the sensors and returns it in the form of a list. The lwlp values are the mean of the
+    latest lwlp_reads reads since the previous sample or pwm change, topped up with new reads if fewer were taken. The
+    bmp and aht values come from the cache, which is refreshed first for any sensor whose interval has run out (see
+    refresh_ambient)
+    :param bmp: bmp sensor object
+    :param aht: aht sensor object
+    :param lwlp: lwlp sensor object
+    :return: (data, count) where data is a list in form
+        [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp] and count is the number of lwlp reads
+    """
+
+    refresh_ambient(bmp, aht)
+    data = list(ambient_cache)
+
+    # get data from lwlp
+    while lwlp_count < lwlp_reads:
+        accumulate_lwlp(lwlp)
+    count = lwlp_count
+    data.append(sum(read[0] for read in lwlp_window) / count)
+    data.append(sum(read[1] for read in lwlp_window) / count)
+    reset_lwlp_average()
 
-    return data
+    return data, count
 
 
 def send_pwm(duty_cycle):
@@ -136,22 +281,32 @@ def send_pwm(duty_cycle):
     
 def send_data(port, num_samples):
     """
-    Sends data to PC
+    Sends data to PC. Each sample is written with a single port.write, either as ascii <a,b,c,...> or, when binary
+    frames are enabled, as a 46 byte frame: sync, six float32 values, uint32 sequence, uint32 device time in ms,
+    uint32 lwlp read count, uint16 bmp and aht value ages in ms and a uint32 crc32 of everything after the sync (all
+    little endian). Extended ascii frames hold the same fields as a binary frame in the same order, without the sync
+    and crc. The device time is taken when the sample's sensor reads have finished
     :param port: port to send to. should be data port of pc
     :param num_samples: number of samples to send
     :return: True when finished
     """
+    global sequence
 
     sample_count = 0
     while sample_count < num_samples:
-        port.write(bytes("<", "ascii"))
-        sample = get_data(bmp, aht, lwlp)
-
-        for value in sample:
-            port.write(bytes(f"{value}", "ascii"))
-            if value != sample[-1]:  # put commas between all  but the final
-                port.write(bytes(",", "ascii"))
-        port.write(bytes(">", "ascii"))
+        sample, count = get_data(bmp, aht, lwlp)
+        device_ms = (time.monotonic_ns() // 1000000) & 0xFFFFFFFF
+        ages = ambient_ages_ms()
+
+        if frame_format == 1:
+            payload = struct.pack("<6fIIIHH", *sample, sequence, device_ms, count, *ages)
+            port.write(BINARY_SYNC + payload + struct.pack("<I", binascii.crc32(payload)))
+        else:
+            if frame_format == 2:
+                sample.extend([sequence, device_ms, count])
+                sample.extend(ages)
+            port.write(bytes("<" + ",".join(str(value) for value in sample) + ">", "ascii"))
+        sequence = (sequence + 1) & 0xFFFFFFFF
         sample_count += 1
     return True
 
@@ -174,7 +329,48 @@ lwlp = sensors[2]
 console_port = usb_cdc.console
 data_port = usb_cdc.data
 
+# command input, filled by read_commands
+command_buffer = bytearray(COMMAND_BUFFER_SIZE)
+command_view = memoryview(command_buffer)  # readinto a slice without copying
+command_length = 0  # bytes held in command_buffer
+frame_start = -1  # index after the '<' of the unfinished frame, -1 outside a frame
+
+# streaming state, changed by the S and X commands
+streaming = False
+stream_period_ns = 0  # integer ns, as float monotonic() loses resolution the longer the board is up
+next_sample_ns = 0
+
+# output format, changed by the F command
+frame_format = 0  # 0 = ascii, 1 = binary, 2 = extended ascii
+sequence = 0
+
+# on-device averaging, changed by the A command
+lwlp_reads = 1  # lwlp reads averaged into each sample
+ambient_reads = 1  # bmp and aht reads averaged into each sample
+lwlp_window = [[0.0, 0.0]]  # the latest lwlp_reads [lwlp pressure, lwlp temp] reads since the previous sample
+lwlp_count = 0  # reads held in lwlp_window
+lwlp_next = 0  # index in lwlp_window of the next read
+
+# ambient read scheduling, changed by the I command
+bmp_interval_ns = 0  # time between bmp reads, 0 = read for every sample
+aht_interval_ns = 0  # time between aht reads, 0 = read for every sample
+bmp_read_ns = None  # time of the cached bmp values
+aht_read_ns = None  # time of the cached aht values
+ambient_cache = [0.0, 0.0, 0.0, 0.0]  # [bmp pressure, bmp temp, aht hum, aht temp]
+
+# each pass handles the commands that have arrived, then does at most one sample or sensor read, so commands are
+# picked up between reads whether or not a stream is running
 while True:
-    command = receive_command(console_port)
-    handle_command(command)
+    for command in read_commands(console_port):
+        try:
+            handle_command(command)
+        except (ValueError, IndexError):  # a malformed command is ignored rather than stopping the loop
+            print("Bad command:", command)
+    if streaming and time.monotonic_ns() >= next_sample_ns:
+        send_data(data_port, 1)
+        next_sample_ns = max(next_sample_ns + stream_period_ns, time.monotonic_ns())  # no catch-up bursts
+    elif refresh_ambient(bmp, aht, idle=True):  # read slow sensors while waiting for the next sample or command
+        pass
+    elif lwlp_reads > 1:  # oversample the lwlp while waiting for the next sample or command
+        accumulate_lwlp(lwlp)
  
\ No newline at end of file
@@ -1,32 +1,75 @@
 import sys
 import time
-import serial
 import os
-import csv
 import argparse
+import importlib.util
+import threading
+import xml.etree.ElementTree as ElementTree
 import pyqtgraph as pg
-from PyQt5.QtWidgets import QApplication
+from PyQt5 import QtWidgets
+from PyQt5.QtWidgets import QApplication, QProgressBar, QLabel, QDockWidget
 from PyQt5.QtCore import QTimer
 from pyqtgraph.Qt import QtCore
-from feathercom import *
 from LEDwidget import LEDWidget
+from acquisition import AcquisitionWorker
+from rolling import RollingWindow
+from plotbuffer import PlotBuffer
+from recorder import Recorder, ColumnarRecorder, COLUMNAR_EXTENSION, next_filename
+from calibration import CalibrationJob
+from physics import density, dynamic_pressure, velocity
+from metrics import METRICS, MetricsServer
+from spectrum import StreamingSpectrum
 import numpy as np
 # setting pyqtgraph configuration options
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
 
-
-ui_class, base_class = pg.Qt.loadUiType("python_files/desginer_ui.ui")
+UI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "desginer_ui.ui")  # found from any cwd
+
+
+def load_ui(ui_file=UI_FILE):                                        # (form class, base class) of a designer file
+    # uic output is cached as python in __pycache__ and only regenerated when the .ui is newer, so a normal start
+    # imports a module instead of parsing xml and compiling the generated code again
+    name = "ui_" + os.path.splitext(os.path.basename(ui_file))[0]
+    generated = os.path.join(os.path.dirname(ui_file), "__pycache__", name + ".py")
+    try:
+        if not os.path.exists(generated) or os.path.getmtime(generated) < os.path.getmtime(ui_file):
+            from PyQt5 import uic                                    # only needed when the .ui has changed
+            os.makedirs(os.path.dirname(generated), exist_ok=True)
+            base = ElementTree.parse(ui_file).getroot().find("widget").get("class")
+            with open(generated + ".tmp", "w", encoding="utf-8") as file:
+                uic.compileUi(ui_file, file)
+                file.write(f"\nBASE_CLASS = {base!r}\n")
+            os.replace(generated + ".tmp", generated)               # never leave a half written module behind
+        spec = importlib.util.spec_from_file_location(name, generated)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except OSError:                                                  # read-only install: compile in memory
+        return pg.Qt.loadUiType(ui_file)
+    form_class = next(value for key, value in vars(module).items() if key.startswith("Ui_"))
+    return form_class, getattr(QtWidgets, module.BASE_CLASS)
+
+
+ui_class, base_class = load_ui()
+GUI_TICK_SECONDS = METRICS.histogram("gui_tick_seconds", "Duration of one GUI refresh (update_data)")
+RECONNECT_DELAY_MS = 2000                                           # wait after the acquisition worker dies
 
 
 class MainWindow(ui_class, base_class):
-
-    def __init__(self, fixed_mode=False, pwmRange_mode=False):
+    connection_finished = QtCore.pyqtSignal(object)                 # None once connected, else the exception
+
+    def __init__(self, fixed_mode=False, pwmRange_mode=False, stream_rate=None, binary=False, window_size=10,
+                 plot_window=None, record_format="csv", compress=False, tare_samples=None, tare_sem=None,
+                 console_port='COM14', data_port='COM15', simulate=False, velocity_mode=False, pid_gains=None,
+                 averaging=1, sensor_intervals=None, humidity_correction=False, capture=False, replay=None,
+                 replay_speed=1.0, metrics=False, metrics_port=None, spectrum=False, spectrum_block=1024,
+                 characterization=None):
         super().__init__()
 
         # Plot Creation and Initialization
         self.setupUi(self)
         self.plot_start_time = None
+        self.latest_sample_time = None                              # when the feather measured the newest sample
         self.plot_timer = QTimer(self)
         self.livePlot.plot()  # create a pyqtgraph plot object
         self.livePlot.setTitle("Velocity vs Time")
@@ -36,13 +79,13 @@ class MainWindow(ui_class, base_class):
         self.livePlot.setLabel('bottom', 'Time', 's')
 
         # Plot Curve Drawing
-        self.x_values = []
-        self.y_actual = []
-        self.y_desired = []
+        self.plot_window = plot_window                              # seconds shown when scrolling, None = whole run
+        self.actual_points = PlotBuffer(max_age=plot_window)        # preallocated time/velocity buffer
         self.pen1 = pg.mkPen("#e7b33c", width=2, style=pg.QtCore.Qt.SolidLine)
         self.pen2 = pg.mkPen("#5ea6bd", width=2, style=QtCore.Qt.DotLine)
-        self.livePlot.actualCurve = self.livePlot.plot(self.x_values, self.y_actual)    # plot actual velocity
-        self.livePlot.actualCurve.setPen(self.pen1)
+        self.livePlot.actualCurve = self.livePlot.plot(pen=self.pen1)   # single curve reused for every update
+        self.livePlot.actualCurve.setClipToView(True)               # only draw points inside the visible range
+        self.livePlot.actualCurve.setDownsampling(auto=True, method='peak')
 
         # Start, Stop, Pause, Resume plotting
         self.pushButton.clicked.connect(self.start_plot)
@@ -57,12 +100,41 @@ class MainWindow(ui_class, base_class):
         self.record_temp = False
         self.record_pressure = False
         self.output_folder = "data_output"
-        self.recorded_data = []
+        self.recorder = None                                        # streams raw samples to disk while plotting
+        self.record_format = record_format                          # "csv" or "columnar"
+        self.compress = compress                                    # compress columnar recordings when closed
         os.makedirs(self.output_folder, exist_ok=True)
 
-        # Serial Port Settings
-        self.console_port = serial.Serial('COM14', 115200)           # console port (write)
-        self.data_port = serial.Serial('COM15', 115200)             # data port (read)
+        # Serial Port Settings: opened on a background thread so the window shows before the hardware answers
+        self.simulate = simulate                                    # simulated feather, no hardware needed
+        self.replay = replay                                        # capture file played back instead of a feather
+        self.replay_speed = replay_speed                            # 1 = real time, 0 = as fast as possible
+        self.capture = capture                                      # tee the raw data port bytes to a capture file
+        self.capture_file = None
+        self.console_port_name = console_port
+        self.data_port_name = data_port
+        self.console_port = None                                    # set once connected
+        self.data_port = None
+        self.acquisition = None                                     # started once both ports are open
+        self.closing = False
+        self.stream_rate = stream_rate
+        self.binary = binary
+        self.averaging = averaging                                  # lwlp reads the feather averages per sample
+        self.sensor_intervals = sensor_intervals                    # ms between [bmp, aht] reads, None = every sample
+        self.velocity_mode = velocity_mode                          # manual entry is a velocity setpoint in m/s
+        if velocity_mode:
+            from control import VelocityController                  # simple_pid is only needed in velocity mode
+            from characterization import load_characterization
+            self.characterization = load_characterization(characterization) if characterization else None
+            self.controller = VelocityController(*(pid_gains or ()), feed_forward=self.characterization)
+        else:
+            self.characterization = None
+            self.controller = None
+        self.characterization_file = characterization              # duty to velocity map for the feed-forward
+        self.connection_label = QLabel()
+        self.statusbar.addPermanentWidget(self.connection_label)
+        self.connection_finished.connect(self.finish_connect)
+        self.connect_hardware()
 
         # Mode Settings
         self.pwmRange_mode = pwmRange_mode                          # Ramps PWM 0-100% if True (for troubleshooting)                         
@@ -78,53 +150,170 @@ class MainWindow(ui_class, base_class):
             self.label.setText("OFF")
             self.label.setStyleSheet("text-transform: uppercase;")
 
-        # Other Settings
+        # Calibration: averaged from the acquisition stream without blocking the GUI
         self.density = 1.0
-        self.hum_window = []
-        self.dens_window = []
-        self.temp_window = []
-        self.press_window = []
-        self.vel_window = []  
-        self.dp_window = []                                         # List to store velocity values
-        self.window_size = 10                                       # Size of the moving average window                             
+        self.pressure = None                                        # set when init_values finishes
+        self.humidity = None
+        self.temperature = None
+        self.initDP = None                                          # set when the first tare finishes
+        self.initDP_sem = None                                      # standard error of the tare's mean dp
+        self.humidity_correction = humidity_correction              # density of humid rather than dry air
+        self.env_job = None                                         # running environmental calibration, if any
+        self.tare_job = None                                        # running tare, if any
+        self.tare_samples = tare_samples                            # finish a tare after this many samples
+        self.tare_sem = tare_sem                                    # or once the mean dp's std. error is this small
+        self.calibration_progress = QProgressBar()
+        self.calibration_progress.setMaximumWidth(200)
+        self.statusbar.addPermanentWidget(self.calibration_progress)
+        self.calibration_progress.hide()
+
+        # Other Settings
+        self.window_size = window_size                              # Size of the moving average window                             
+        self.env_window = RollingWindow(self.window_size, 4)        # density, humidity, temperature, pressure columns
+        self.dp_window = RollingWindow(self.window_size)            # differential pressure window
         self.sendDuty.clicked.connect(self.specific_entry)          # send button calls send duty% function
         self.manualDuty.editingFinished.connect(self.specific_entry)# value sent if 'enter'key hit
         self.tareVelocity.clicked.connect(self.tare_vel)            # tare button calls tare function
         self.current_pwm = 0
+
+        # Spectrum: Welch psd and turbulence intensity of the full rate velocity, once tared
+        self.spectrum = StreamingSpectrum(spectrum_block) if spectrum else None
+        if self.spectrum is not None:
+            self.setup_spectrum_plot()
+
+        # Diagnostics: timings are only taken with metrics on, the panel and http endpoint read them
+        self.metrics_server = None
+        self.metrics_panel = None
+        if metrics or metrics_port is not None:
+            METRICS.enabled = True
+            METRICS.gauge("recorder_backlog", "Row batches waiting to be written to disk",
+                          lambda: self.recorder.backlog if self.recorder is not None else 0)
+            self.setup_metrics_panel()
+            if metrics_port is not None:
+                self.metrics_server = MetricsServer(METRICS, metrics_port)
+                self.metrics_server.start()
+                print(f"Metrics at http://{self.metrics_server.server_address[0]}:"
+                      f"{self.metrics_server.server_address[1]}/metrics")
         self.setup_timer()  
         self.init_values()
         self.tare_vel() 
 
 
-    def init_values(self):
-        duration = 5
-        dens_vals = []
-        press_vals = []
-        hum_vals = []
-        temp_vals = []
-
-        start_time = time.time()
-        while time.time() - start_time < duration:                                                           
-            data = self.get_data(self.console_port, self.data_port)  
-            hum = data[3]
-            temp_K = data[1] + 273.15                                            
-            press_Pa = data[0] * 100 
-            dens = press_Pa / (287.058 * temp_K)
-            dens_vals.append(dens)
-            press_vals.append(press_Pa)
-            hum_vals.append(hum)
-            temp_vals.append(temp_K - 273.15)
-            print("Initializing Environmental Conditions ...")
-
-        if dens_vals:    
-            self.density = sum(dens_vals) / len(dens_vals) 
-            self.pressure = sum(press_vals) / len(press_vals)
-            self.humidity = sum(hum_vals) / len(hum_vals)
-            self.temperature = sum(temp_vals) / len(temp_vals)
-            print("Average Density: ", self.density)
-            print("Average Pressure: ", self.pressure)
-            print("Average Humidity: ", self.humidity)
-            print("Average Temperature: ", self.temperature)
+    def connect_hardware(self):                                      # opens the ports without blocking the event loop
+        if self.closing:
+            return
+        if self.replay is not None:
+            source = os.path.basename(self.replay)
+        elif self.simulate:
+            source = "simulated feather"
+        else:
+            source = f"{self.console_port_name}/{self.data_port_name}"
+        self.connection_label.setText(f"Connecting to {source} ...")
+        self.connection_label.setStyleSheet("color: #b07800;")
+        threading.Thread(target=self.open_ports, name="connect", daemon=True).start()
+
+
+    def open_ports(self):                                            # runs on the connect thread
+        try:
+            if self.replay is not None:
+                from capture import open_replay_ports                # sample times shifted to now, as if live
+                self.console_port, self.data_port = open_replay_ports(self.replay, self.replay_speed, rebase=True)
+            elif self.simulate:
+                from simulator import open_simulated_ports
+                self.console_port, self.data_port = open_simulated_ports()
+            else:
+                import serial
+                self.console_port = serial.Serial(self.console_port_name, 115200)  # console port (write)
+                self.data_port = serial.Serial(self.data_port_name, 115200)        # data port (read)
+            if self.capture and self.replay is None:
+                from capture import CapturePort, CAPTURE_EXTENSION
+                self.capture_file = next_filename(self.output_folder, "capture", CAPTURE_EXTENSION)
+                self.data_port = CapturePort(self.data_port, self.capture_file, metadata={
+                    "binary": self.binary, "stream_rate": self.stream_rate, "averaging": self.averaging,
+                    "sensor_intervals": self.sensor_intervals, "port": self.data_port_name,
+                })
+        except Exception as error:                                   # e.g. serial.SerialException, port not found
+            if self.console_port is not None:
+                self.console_port.close()
+                self.console_port = None
+            self.connection_finished.emit(error)                     # queued to the GUI thread
+            return
+        self.connection_finished.emit(None)
+
+
+    def finish_connect(self, error):                                 # back on the GUI thread
+        if error is not None:
+            print("Connection failed:", error)
+            self.connection_label.setText(f"Connection failed: {error}")
+            self.connection_label.setStyleSheet("color: #c0392b;")
+            return
+        if self.closing:                                             # window closed while the ports were opening
+            self.close_ports()
+            return
+        clock = time.time
+        if self.replay is not None:                                  # decode the capture as it was recorded
+            self.binary = self.data_port.metadata.get("binary", False)
+            self.stream_rate = 0                                     # read the bytes as they are released
+            clock = self.data_port.time                              # stamp frames with their recorded times
+        # the worker owns both ports from here on
+        self.acquisition = AcquisitionWorker(self.console_port, self.data_port, stream_rate=self.stream_rate,
+                                             binary=self.binary, controller=self.controller,
+                                             averaging=self.averaging, sensor_intervals=self.sensor_intervals,
+                                             clock=clock)
+        self.acquisition.start()
+        if METRICS.enabled:
+            self.acquisition.register_metrics()
+        if self.replay is not None:
+            self.connection_label.setText(f"Replaying {os.path.basename(self.replay)} at {self.replay_speed:g}x")
+        elif self.simulate:
+            self.connection_label.setText("Simulated feather")
+        else:
+            self.connection_label.setText(f"Connected to {self.console_port_name}/{self.data_port_name}")
+        if self.capture_file is not None:
+            self.connection_label.setText(self.connection_label.text() + f", capturing to {self.capture_file}")
+        self.connection_label.setStyleSheet("color: #2e8b57;")
+
+
+    def worker_stopped(self):                                        # shows why acquisition stopped, then reconnects
+        error = self.acquisition.error
+        self.acquisition = None
+        self.close_ports()
+        self.console_port = None
+        self.data_port = None
+        if self.replay is not None and isinstance(error, EOFError):  # the end of the capture
+            self.connection_label.setText(f"Replay of {os.path.basename(self.replay)} finished")
+            self.connection_label.setStyleSheet("color: #555555;")
+            return
+        print("Acquisition stopped:", repr(error))
+        self.connection_label.setText(f"Acquisition stopped: {error!r}")
+        self.connection_label.setStyleSheet("color: #c0392b;")
+        if self.replay is None:                                      # a replay would start over, so it stays stopped
+            self.connection_label.setText(f"{self.connection_label.text()}, reconnecting ...")
+            QTimer.singleShot(RECONNECT_DELAY_MS, self.connect_hardware)
+
+
+    def close_ports(self):
+        for port in (self.console_port, self.data_port):
+            if port is not None:
+                port.close()
+        if hasattr(self.console_port, "feather"):                    # stop the simulated feather's thread
+            self.console_port.feather.stop()
+
+
+    def init_values(self):                                           # averages env. conditions over the next 5 s
+        self.env_job = CalibrationJob(4, max_duration=5)             # density, pressure, humidity, temperature
+        self.update_calibration_status()
+
+
+    def finish_init_values(self):
+        self.density, self.pressure, self.humidity, self.temperature = self.env_job.mean()
+        self.env_job = None
+        if self.controller is not None:
+            self.controller.density = self.density
+        print("Average Density: ", self.density)
+        print("Average Pressure: ", self.pressure)
+        print("Average Humidity: ", self.humidity)
+        print("Average Temperature: ", self.temperature)
 
         self.tempLCD.display("{:.1f}".format(self.temperature))                        
         self.pressureLCD.display("{:.1f}".format(self.pressure/1000))                    
@@ -137,6 +326,7 @@ class MainWindow(ui_class, base_class):
 
         if not self.plot_timer.isActive():
             self.plot_start_time = time.time()
+            self.start_recording()
             self.plot_timer.start(ms)
             self.plot_timer.timeout.connect(self.update_plot)
 
@@ -152,75 +342,120 @@ class MainWindow(ui_class, base_class):
     def reset_plot(self):
         self.save_data()
         self.plot_timer.stop()
-        self.x_values = []
-        self.y_actual = []
-        self.y_desired = []
-        self.recorded_data = []
-        self.livePlot.clear()
+        self.actual_points.clear()
+        self.livePlot.actualCurve.setData([], [])
         
 
     def update_plot(self):
-        elapsed_time = time.time() - self.plot_start_time
-        temp = self.tempLCD.value()
-        hum = self.humLCD.value()
-        pressure = self.pressureLCD.value()
-        density = self.densityLCD.value()
+        sample_time = time.time() if self.latest_sample_time is None else self.latest_sample_time
+        elapsed_time = sample_time - self.plot_start_time           # plotted at the time the LCD value was measured
         actual_vel = self.actualLCD.value()
-        duty_percent = self.desiredLCD.value()
 
-        self.x_values.append(elapsed_time)
-        self.y_actual.append(actual_vel)
+        self.actual_points.append(elapsed_time, actual_vel)
+        self.livePlot.actualCurve.setData(*self.actual_points.data(), skipFiniteCheck=True)
+        if self.plot_window is None:
+            self.livePlot.setXRange(*self.actual_points.x_range())
+        else:
+            self.livePlot.setXRange(max(elapsed_time - self.plot_window, 0), elapsed_time)
 
-        self.livePlot.clear()
-        self.livePlot.plot(self.x_values, self.y_actual, pen=self.pen1)
-        self.livePlot.setXRange(min(self.x_values), max(self.x_values))
-
-        # Data Recording 
-        recorded_data_point = {
-            "time": elapsed_time,
-            "velocity": actual_vel,
-            "duty": duty_percent,
-        }
 
+    def start_recording(self):                                       # opens a new recording and starts its writer thread
+        fieldnames = ["time", "velocity", "duty", "diff_pressure"]
         if self.checkBox.isChecked():
-            recorded_data_point["humidity"] = hum
-
+            fieldnames.append("humidity")
         if self.checkBox_2.isChecked():
-            recorded_data_point["pressure"] = pressure
-
+            fieldnames.append("pressure")
         if self.checkBox_3.isChecked():
-            recorded_data_point["temp"] = temp
-
+            fieldnames.append("temp")
         if self.checkBox_4.isChecked():
-            recorded_data_point["density"] = density
+            fieldnames.append("density")
+
+        if self.record_format == "columnar":
+            metadata = {
+                "start_time": self.plot_start_time,
+                "initDP": self.initDP,
+                "initDP_sem": self.initDP_sem,
+                "humidity_correction": self.humidity_correction,
+                "density": self.density,                             # from init_values
+                "pressure": self.pressure,
+                "humidity": self.humidity,
+                "temperature": self.temperature,
+                "fixed_mode": self.fixed_mode,
+                "pwmRange_mode": self.pwmRange_mode,
+                "stream_rate": self.stream_rate,                     # None when polling one sample per request
+                "binary": self.binary,
+                "averaging": self.averaging,
+                "sensor_intervals": self.sensor_intervals,
+                "window_size": self.window_size,
+                "capture": self.capture_file,                        # raw bytes of this run, if captured
+                "replay": self.replay,
+            }
+            filename = next_filename(self.output_folder, extension=COLUMNAR_EXTENSION)
+            self.recorder = ColumnarRecorder(filename, fieldnames, dtypes={"duty": "<f4"}, metadata=metadata,
+                                             compress=self.compress)
+        else:
+            self.recorder = Recorder(next_filename(self.output_folder), fieldnames)
+        self.recorder.start()
+
 
-        self.recorded_data.append(recorded_data_point)
+    def record_samples(self, times, data):                           # queues one csv row per raw sample
+        recent = times >= self.plot_start_time                       # skip samples queued before Start was pressed
+        times, data = times[recent], data[recent]
+        press_Pa = data[:, 0] * 100
+        if self.fixed_mode:
+            dens_kgm3 = np.full(len(data), self.density)
+        else:
+            dens_kgm3 = density(press_Pa, data[:, 1], data[:, 3] if self.humidity_correction else None)
+        vel = velocity(dynamic_pressure(data[:, 2], self.initDP), dens_kgm3)   # nan until the first tare
+        duty_percent = self.desiredLCD.value()
+        if duty_percent == 0:                                        # matches the velocity LCD
+            vel[:] = 0
+
+        columns = {
+            "time": times - self.plot_start_time,
+            "velocity": vel,
+            "duty": np.full(len(data), duty_percent),
+            "diff_pressure": data[:, 2],
+            "humidity": data[:, 3],
+            "pressure": press_Pa / 1000,                             # kPa, as on the LCD
+            "temp": data[:, 1],
+            "density": dens_kgm3,
+        }
+        try:
+            self.recorder.write_rows(np.column_stack([columns[name] for name in self.recorder.fieldnames]))
+        except Exception as error:                                   # the writer stopped, e.g. the disk is full
+            print(f"Recording to {self.recorder.filename} failed: {error}")
+            self.recorder = None
 
 
     def save_data(self):
-        if not self.recorded_data:
+        if self.recorder is None:
             print("no data")
             return 
-        
-        record_counter = 1
-        while True:
-            filename = os.path.join(self.output_folder, f"recorded_data_{record_counter}.csv")
-            if not os.path.exists(filename):
-                break
-            record_counter += 1
-
-        with open(filename, mode='w', newline='') as file:
-            fieldnames = ["time", "velocity", "duty", "pressure", "humidity", "temp"]
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
 
-            for data_point in self.recorded_data:
-                writer.writerow(data_point)
-        print(f"Data saved to: {filename}")
+        if isinstance(self.recorder, ColumnarRecorder):              # saved to meta.json on close
+            self.recorder.metadata.update(initDP=self.initDP, initDP_sem=self.initDP_sem)   # tare may end mid-run
+            if self.acquisition is not None:                         # link statistics
+                self.recorder.metadata.update(lost_frames=self.acquisition.lost,
+                                              dropped_samples=self.acquisition.dropped,
+                                              clock_drift=self.acquisition.clock.drift)
+        try:
+            self.recorder.close()                                    # writes any queued rows, syncs and closes
+        except Exception as error:
+            print(f"Recording to {self.recorder.filename} failed: {error}")
+        else:
+            print(f"Data saved to: {self.recorder.filename}")
+        self.recorder = None
 
 
     def specific_entry(self):
         number = self.manualDuty.value()                             # saves the number that is input by the user for Duty Cycle
+        if self.velocity_mode:                                       # number is a velocity setpoint for the controller
+            self.controller.setpoint = number
+            if self.controller.estimate is not None:                 # jumped to the characterized duty
+                self.statusbar.showMessage("Feed-forward: {:.1f} % duty for {:g} m/s".format(
+                    self.controller.estimate * 100, number), 5000)
+            return
         self.desiredLCD.display(number)                              # sets manual numbered entered as the Duty Cycle LCD value        
         
         if self.pwmRange_mode:                                       # only active if pwm range is enabled, starts a 10s timer
@@ -241,87 +476,191 @@ class MainWindow(ui_class, base_class):
             self.pwmRange_Timer.stop()                              # stops timer when pwm reaches 100%
 
 
-    def tare_vel(self):
-       duration = 10
-       dp_values = []
-       start_time = time.time()
-       while time.time() - start_time < duration:                    # 10 second while loop
-            data = self.get_data(self.console_port, self.data_port)  # gets data
-            dp = data[2]                                             # gets diff. pressure from get_data function
-            dp_values.append(dp)                                     # saves the collected dp value
-            print("Taring Velocity ...")
-
-       if dp_values:    
-            self.initDP = sum(dp_values) / len(dp_values)            # takes the average dp value and sets initDP = to 
-            print("Average DP Value:", self.initDP)                  
-            self.dp_window = [self.initDP] * self.window_size
+    def tare_vel(self):                                              # starts a tare, or cancels the running one
+        if self.tare_job is not None:
+            self.tare_job.cancel()                                   # keeps the previous initDP
+            self.tare_job = None
+            self.tareVelocity.setText("Tare Velocity")
+        else:
+            self.tare_job = CalibrationJob(max_samples=self.tare_samples, target_sem=self.tare_sem,
+                                           max_duration=10)          # at most 10 s of diff. pressure
+            self.tareVelocity.setText("Cancel Tare")
+        self.update_calibration_status()
+
+
+    def finish_tare(self):
+        self.initDP = self.tare_job.mean()[0]                        # takes the average dp value and sets initDP = to 
+        self.initDP_sem = self.tare_job.sem()[0]
+        self.tare_job = None
+        if self.controller is not None:
+            self.controller.init_dp = self.initDP
+        self.tareVelocity.setText("Tare Velocity")
+        print("Average DP Value:", self.initDP)                  
+        self.dp_window.fill(self.initDP)
+        if self.spectrum is not None:                                # velocities before the tare are on another scale
+            self.spectrum.clear()
+
+
+    def update_calibration(self, times, data):                       # feeds running calibrations with new samples
+        if self.env_job is not None:
+            press_Pa = data[:, 0] * 100
+            dens = density(press_Pa, data[:, 1], data[:, 3] if self.humidity_correction else None)
+            if self.env_job.add(times, np.column_stack((dens, press_Pa, data[:, 3], data[:, 1]))):
+                self.finish_init_values()
+        if self.tare_job is not None:
+            if self.tare_job.add(times, data[:, 2]):
+                self.finish_tare()
+        self.update_calibration_status()
+
+
+    def update_calibration_status(self):                             # progress bar and message in the status bar
+        jobs = [(job, text) for job, text in ((self.env_job, "Initializing Environmental Conditions ..."),
+                                              (self.tare_job, "Taring Velocity ...")) if job is not None]
+        if jobs:
+            self.statusbar.showMessage(" ".join(text for job, text in jobs))
+            self.calibration_progress.setValue(int(100 * min(job.progress() for job, text in jobs)))
+            self.calibration_progress.show()
+        else:
+            self.statusbar.clearMessage()
+            self.calibration_progress.hide()
 
 
     def setup_timer(self):                                           # timer setup for data collection and updates
         self.timer = QTimer(self)
-        self.timer.timeout.connect(self.update_data)
-        self.timer.start(200)                                         #200 ms delay on data collection (limited by sensor comm)
+        self.timer.timeout.connect(self.update_data_timed if METRICS.enabled else self.update_data)
+        self.timer.start(200)                                         #200 ms GUI refresh; sampling runs on the acquisition thread
+
+
+    def setup_spectrum_plot(self):                                   # log-log psd in a dock beside the velocity plot
+        self.spectrumPlot = pg.PlotWidget()
+        self.spectrumPlot.setLogMode(x=True, y=True)
+        self.spectrumPlot.showGrid(x=True, y=True)
+        self.spectrumPlot.setLabel('left', 'PSD', '(m/s)^2/Hz')
+        self.spectrumPlot.setLabel('bottom', 'Frequency', 'Hz')
+        self.spectrumPlot.setTitle("Velocity spectrum")
+        self.spectrumCurve = self.spectrumPlot.plot(pen=self.pen1)
+        dock = QDockWidget("Spectrum", self)
+        dock.setWidget(self.spectrumPlot)
+        dock.setMinimumWidth(400)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, dock)
+
+
+    def update_spectrum(self, times, data):                          # feeds full rate velocities to the spectrum
+        if self.fixed_mode:
+            dens_kgm3 = self.density
+        else:
+            dens_kgm3 = density(data[:, 0] * 100, data[:, 1], data[:, 3] if self.humidity_correction else None)
+        if not self.spectrum.extend(times, velocity(dynamic_pressure(data[:, 2], self.initDP), dens_kgm3)):
+            return                                                   # redraw only when a block completes
+        frequencies, psd = self.spectrum.psd()
+        self.spectrumCurve.setData(frequencies[1:], psd[1:])         # no dc bin on a log axis
+        self.spectrumPlot.setTitle("TI {:.2f} %   u' {:.3f} m/s   U {:.2f} m/s   ({:.0f} Hz)".format(
+            self.spectrum.turbulence_intensity() * 100, self.spectrum.rms(), self.spectrum.mean(),
+            self.spectrum.sample_rate))
+
+
+    def setup_metrics_panel(self):                                   # dockable text panel refreshed once a second
+        self.metrics_panel = QLabel()
+        self.metrics_panel.setStyleSheet("font-family: monospace;")
+        self.metrics_panel.setMinimumWidth(260)
+        dock = QDockWidget("Diagnostics", self)
+        dock.setWidget(self.metrics_panel)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, dock)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.update_metrics_panel)
+        self.metrics_timer.start(1000)
+
+
+    def update_metrics_panel(self):
+        values = METRICS.snapshot()
+
+        def ms(name):                                                # 'p50 / p99' of a histogram in ms
+            histogram = values.get(name)
+            if histogram is None or not histogram.count:
+                return "-"
+            return f"{histogram.quantile(0.5) * 1e3:.2f} / {histogram.quantile(0.99) * 1e3:.2f}"
+
+        def count(name):
+            return f"{values[name]:.0f}" if name in values else "-"
+
+        self.metrics_panel.setText("\n".join([
+            f"{'samples/s':<16}{values.get('acquisition_samples_per_second', 0):>20.1f}",
+            f"{'request ms':<16}{ms('feather_request_seconds'):>20}",
+            f"{'parse ms':<16}{ms('feather_parse_seconds'):>20}",
+            f"{'GUI tick ms':<16}{ms('gui_tick_seconds'):>20}",
+            f"{'queue depth':<16}{count('acquisition_queue_depth'):>20}",
+            f"{'lost frames':<16}{count('acquisition_lost_frames_total'):>20}",
+            f"{'dropped':<16}{count('acquisition_dropped_samples_total'):>20}",
+            f"{'bad frames':<16}{count('feather_bad_frames_total'):>20}",
+            f"{'recorder backlog':<16}{count('recorder_backlog'):>20}",
+            "(p50 / p99)",
+        ]))
+
+
+    def update_data_timed(self):                                     # update_data with its duration recorded
+        start = time.perf_counter()
+        self.update_data()
+        GUI_TICK_SECONDS.observe(time.perf_counter() - start)
 
 
     def update_data(self):
-        data = self.get_data(self.console_port, self.data_port)      # calls the get_data function
-        if self.fixed_mode:                                            # checks if fixed_mode is true/fale
-            self.update_lcds_FIXED(data)                               # calls update_lcds_FIXED if true
-        else:
-            self.update_lcds(data)                                   # calls update_lcd if false
-
+        if self.acquisition is None:                                 # still connecting
+            return
+        times, data = self.get_data()                                  # drains every sample queued since the last tick
+        if len(data):
+            self.latest_sample_time = times[-1]
+            self.update_calibration(times, data)
+            if self.fixed_mode:                                        # checks if fixed_mode is true/fale
+                self.update_lcds_FIXED(data)                           # calls update_lcds_FIXED if true
+            else:
+                self.update_lcds(data)                               # calls update_lcd if false
+            if self.recorder is not None and self.plot_timer.isActive():   # not while paused
+                self.record_samples(times, data)
+            if self.spectrum is not None and self.initDP is not None:
+                self.update_spectrum(times, data)
+        if not self.acquisition.is_alive() and not self.closing:    # the worker died, its last samples are in
+            self.worker_stopped()
+            return
+
+        if self.velocity_mode:                                       # the controller drives the fan, show its duty
+            self.desiredLCD.display("{:.1f}".format(self.controller.duty * 100))
+            return
         signal = int((self.desiredLCD.value()/100) * 65535)          # calculates signal based on 12 bit reso.(65535 values)
-        send_pwm(self.console_port, signal)                          # calls the send_pwm function to send pwm to fan
-
-
-    def get_data(self,console_port,data_port):                       # get_data function
-        data_packet = request_data(console_port, data_port, 1)       # requests data_packet from the feather via ports
-        return (
-            float(data_packet[0][0]),                                # pressure
-            float(data_packet[0][3]),                                # temperature
-            float(data_packet[0][4]),                                # diff_pressure
-            float(data_packet[0][2]),                                # humidity
-        )
-
-
-    def update_lcds(self, data):                                     # update_lcds function
-        temp_C = data[1]                                             # uses data from update_data update lcds
-        temp_K = temp_C + 273.15                                     # temp converted into Kelvin
-        press_Pa = data[0] * 100                                     # pressure converted into Pascals
+        self.acquisition.set_pwm(signal)                             # acquisition thread sends pwm to fan
+
+
+    def get_data(self):                                              # get_data function, returns (times, data)
+        queued = self.acquisition.drain()                            # samples queued by the acquisition thread
+        if not queued:
+            return np.empty(0), np.empty((0, 4))
+        times = np.array([host_time for host_time, sample in queued])
+        samples = np.array([sample for host_time, sample in queued])
+        return times, samples[:, [
+            0,                                                       # pressure
+            3,                                                       # temperature
+            4,                                                       # diff_pressure
+            2,                                                       # humidity
+        ]]
+
+
+    def update_lcds(self, data):                                     # update_lcds function, one row per sample
+        temp_C = data[:, 1]                                          # uses data from update_data update lcds
+        press_Pa = data[:, 0] * 100                                  # pressure converted into Pascals
         press_Kpa = press_Pa / 1000                                  # pressure converted into KPa
-        dp = data[2]
-        dens_kgm3 = press_Pa / (287.058 * temp_K)                   
-        hum = data[3]
+        dp = data[:, 2]
+        hum = data[:, 3]
+        dens_kgm3 = density(press_Pa, temp_C, hum if self.humidity_correction else None)
         
-        self.dens_window.append(dens_kgm3)
-        self.hum_window.append(hum)
-        self.temp_window.append(temp_C)
-        self.press_window.append(press_Kpa)
-        self.dp_window.append(dp)
-
-        if len(self.dens_window) > self.window_size:
-            self.dens_window.pop(0)
-        if len(self.hum_window) > self.window_size:
-            self.hum_window.pop(0)
-        if len(self.temp_window) > self.window_size:
-            self.temp_window.pop(0)
-        if len(self.press_window) > self.window_size:
-            self.press_window.pop(0)
-        if len(self.dp_window) > self.window_size:
-            self.dp_window.pop(0)
-
-        avg_dens = sum(self.dens_window) / len(self.dens_window) if self.dens_window else 0
-        avg_hum = sum(self.hum_window) / len(self.hum_window) if self.hum_window else 0
-        avg_temp = sum(self.temp_window) / len(self.temp_window) if self.temp_window else 0
-        avg_press = sum(self.press_window) / len(self.press_window) if self.press_window else 0                           
-        avg_dp = sum(self.dp_window) / len(self.dp_window) if self.dp_window else 0
+        self.env_window.extend(np.column_stack((dens_kgm3, hum, temp_C, press_Kpa)))
+        self.dp_window.extend(dp)
+
+        avg_dens, avg_hum, avg_temp, avg_press = self.env_window.mean()
+        avg_dp = self.dp_window.mean()[0]
                 
-        magnitude_vel = np.sqrt(abs(2 * (avg_dp-self.initDP) / avg_dens))
-        is_neg_vel = (avg_dp-self.initDP) < 0
-        if self.desiredLCD.value() == 0:
+        if self.desiredLCD.value() == 0 or self.initDP is None:    # no velocity until the first tare finishes
             avg_vel = 0
         else:
-            avg_vel = magnitude_vel * (-1 if is_neg_vel else 1)
+            avg_vel = velocity(avg_dp - self.initDP, avg_dens)
 
         self.tempLCD.display("{:.1f}".format(avg_temp))                               # display temp on LCD
         self.pressureLCD.display("{:.1f}".format(avg_press))                          # display pressure on LCD
@@ -332,35 +671,107 @@ class MainWindow(ui_class, base_class):
 
     def update_lcds_FIXED(self, data):                               # function for fixed mode
         dens_kgm3 = self.density
-        dp = data[2]
-        self.dp_window.append(dp)
-        if len(self.dp_window) > self.window_size:
-            self.dp_window.pop(0)
-
-        avg_dp = sum(self.dp_window) / len(self.dp_window) if self.dp_window else 0
-        magnitude_vel = np.sqrt(abs(2 * (avg_dp-self.initDP) / dens_kgm3))
-        is_neg_vel = (avg_dp-self.initDP) < 0
-        if self.desiredLCD.value() == 0:
+        dp = data[:, 2]
+        self.dp_window.extend(dp)
+
+        avg_dp = self.dp_window.mean()[0]
+        if self.desiredLCD.value() == 0 or self.initDP is None or self.pressure is None:   # wait for calibration
             avg_vel = 0
         else:
-            avg_vel = magnitude_vel * (-1 if is_neg_vel else 1)
+            avg_vel = velocity(avg_dp - self.initDP, dens_kgm3)
 
         self.actualLCD.display("{:.2f}".format(avg_vel))
 
 
     def quit(self):
+        if self.recorder is not None:                                # keep whatever was recorded so far
+            self.save_data()
+        if self.controller is not None:
+            self.controller.setpoint = 0
+        if self.characterization is not None and self.characterization.changed:   # sweeps found stale
+            self.characterization.save(self.characterization_file)
+        self.closing = True
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.acquisition is None:                                 # never connected, or still connecting
+            return
         signal = 0
-        send_pwm(self.console_port, signal)
+        self.acquisition.set_pwm(signal)                             # written by the worker before it exits
+        self.acquisition.stop()
+        if self.acquisition.is_alive():                              # still using the ports, so leave them open
+            print("Acquisition worker did not stop, ports left open")
+            return
+        self.close_ports()                                           # flushes any capture to disk
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--fixed_mode', action='store_true', help='Use average update')
     parser.add_argument('--pwmRange_mode', action='store_true', help='Ramps up PWM')
+    parser.add_argument('--stream_rate', type=float, default=None,
+                        help='Stream samples at this rate in Hz (0 = as fast as possible) instead of polling')
+    parser.add_argument('--binary', action='store_true', help='Use crc-checked binary frames instead of ascii')
+    parser.add_argument('--averaging', type=int, default=1,
+                        help='Differential pressure reads the feather averages into each sample')
+    parser.add_argument('--sensor_intervals', type=int, nargs=2, default=None, metavar=('BMP_MS', 'AHT_MS'),
+                        help='Read the ambient sensors on their own interval and reuse their values in between')
+    parser.add_argument('--humidity_correction', action='store_true',
+                        help='Correct the air density for the measured humidity')
+    parser.add_argument('--record_format', choices=['csv', 'columnar'], default='csv',
+                        help='Record to csv or to a directory of memory-mappable binary columns')
+    parser.add_argument('--compress', action='store_true', help='Compress columnar recordings when they are closed')
+    parser.add_argument('--console_port', default='COM14', help='Serial port of the feather console')
+    parser.add_argument('--data_port', default='COM15', help='Serial port of the feather data channel')
+    parser.add_argument('--discover', action='store_true',
+                        help='Find the feather by its USB id instead of using --console_port and --data_port')
+    parser.add_argument('--simulate', action='store_true', help='Run against a simulated feather instead of hardware')
+    parser.add_argument('--capture', action='store_true',
+                        help='Save every raw byte from the data port with its receive time to a capture file')
+    parser.add_argument('--replay', default=None, help='Play back a capture file instead of connecting to a feather')
+    parser.add_argument('--replay_speed', type=float, default=1.0,
+                        help='Playback speed of --replay: 1 for real time, N for N times faster, 0 as fast as possible')
+    parser.add_argument('--velocity_mode', action='store_true',
+                        help='Treat the manual entry as a velocity setpoint in m/s held by a PID controller')
+    parser.add_argument('--pid', type=float, nargs=3, default=None, metavar=('KP', 'KI', 'KD'),
+                        help='PID gains for --velocity_mode, in duty fraction per m/s')
+    parser.add_argument('--characterization', default=None,
+                        help='Duty to velocity map from headless.py characterize steps; --velocity_mode setpoints '
+                             'then start at the duty it estimates')
+    parser.add_argument('--spectrum', action='store_true',
+                        help='Show the velocity spectrum and turbulence intensity from the full rate samples')
+    parser.add_argument('--spectrum_block', type=int, default=1024,
+                        help='Samples per FFT block of --spectrum; the resolution is sample rate / block')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Time the data path and show the results in a diagnostics panel')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Also serve the metrics in Prometheus text format at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--tare_samples', type=int, default=None, help='Finish a tare after this many samples')
+    parser.add_argument('--tare_sem', type=float, default=None,
+                        help='Finish a tare once the standard error of the mean diff. pressure is below this')
+    parser.add_argument('--window_size', type=int, default=10, help='Samples in the moving average window')
+    parser.add_argument('--plot_window', type=float, default=None,
+                        help='Scroll the plot over this many seconds instead of showing the whole run')
     args = parser.parse_args()
+    if args.discover and not (args.simulate or args.replay):
+        from devices import find_feathers
+        feathers = find_feathers()
+        if not feathers:
+            sys.exit("No feathers found")
+        args.console_port, args.data_port = feathers[0].console, feathers[0].data
 
     app = QApplication(sys.argv)
-    window = MainWindow(fixed_mode=args.fixed_mode, pwmRange_mode=args.pwmRange_mode)
+    window = MainWindow(fixed_mode=args.fixed_mode, pwmRange_mode=args.pwmRange_mode, stream_rate=args.stream_rate,
+                        binary=args.binary, averaging=args.averaging,
+                        sensor_intervals=args.sensor_intervals, humidity_correction=args.humidity_correction,
+                        window_size=args.window_size,
+                        plot_window=args.plot_window, record_format=args.record_format,
+                        compress=args.compress, tare_samples=args.tare_samples, tare_sem=args.tare_sem,
+                        console_port=args.console_port, data_port=args.data_port, simulate=args.simulate,
+                        capture=args.capture, replay=args.replay, replay_speed=args.replay_speed,
+                        metrics=args.metrics, metrics_port=args.metrics_port, spectrum=args.spectrum,
+                        spectrum_block=args.spectrum_block,
+                        velocity_mode=args.velocity_mode, pid_gains=args.pid,
+                        characterization=args.characterization)
     app.aboutToQuit.connect(window.quit)
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,231 @@
+"""
+This module contains the background acquisition worker that owns the serial link to the Adafruit feather
+
+...
+The worker polls the feather continuously on its own thread and pushes timestamped samples into a bounded queue.
+The GUI drains that queue at its own refresh rate, so a slow serial round-trip never freezes plotting or buttons.
+
+Frames are requested in extended ascii form, or with binary set as crc-checked binary frames. Both carry the
+feather's sequence number and device time: samples are stamped with their device time mapped onto the host clock
+(see timing.ClockSync) and gaps in the sequence are counted in 'lost'. With a stream rate set, the worker puts the
+feather in streaming mode instead of requesting each sample. With averaging above 1, the feather averages that
+many differential pressure reads into every sample, and with sensor_intervals set it reads the slow ambient sensors on
+their own schedule and reports how old their cached values are. Given a controller, the worker runs it on every
+sample and sends its pwm commands itself. A <P,...> command is only written when the value actually changes; when
+polling, it is batched with the next data request as <P,v;D,1>, so setting the fan costs no extra write. The worker
+sets a read timeout on the data port, so stop() is noticed even when the feather has gone quiet.
+
+Classes:
+
+    AcquisitionWorker(console_port, data_port, maxlen, stream_rate, binary, controller, averaging,
+                      sensor_intervals, clock, read_timeout)
+        Thread that requests samples from the feather as fast as the link allows and queues them for the GUI
+
+"""
+import threading
+import time
+from collections import deque
+import numpy as np
+from feathercom import send_pwm, request_data_array, start_stream, stop_stream, stream_data
+from feathercom import set_frame_format, request_binary_data, stream_binary_data, set_averaging, set_sensor_intervals
+from feathercom import extended_to_records, EXTENDED_FIELDS, BINARY_FORMAT, EXTENDED_FORMAT, BAD_FRAMES
+from metrics import METRICS, Rate
+from timing import ClockSync, SequenceTracker
+
+
+class AcquisitionWorker(threading.Thread):
+    """
+    Polls the feather on a dedicated thread and stores samples in a bounded queue.
+
+    ...
+    Each queued item is a tuple (host_time, sample) where host_time is the time.time() at which the feather measured
+        the sample, estimated from its device time, and sample is a list of floats in the form:
+            [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+    The queue is a deque with a maximum length; append and popleft are atomic so no lock is needed. When the GUI
+        falls behind, the oldest samples are discarded and counted in 'dropped'.
+    """
+
+    def __init__(self, console_port, data_port, maxlen=10000, stream_rate=None, binary=False, controller=None,
+                 averaging=1, sensor_intervals=None, clock=time.time, read_timeout=0.1):
+        """
+        :param console_port: the port of the pc to send commands. Should be a serial port object using pyserial
+        :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+        :param maxlen: the maximum number of samples held before the oldest are dropped
+        :param stream_rate: samples per second to stream (0 = as fast as possible), or None to poll with <D,1>
+        :param binary: True to receive binary frames instead of extended ascii
+        :param controller: optional object with update(host_time, dp) returning a pwm value, e.g. VelocityController
+        :param averaging: the number of lwlp reads the feather averages into each sample
+        :param sensor_intervals: (bmp ms, aht ms) between ambient sensor reads, or None to read them for every sample
+        :param clock: returns the host time frames are received at, e.g. capture.ReplayPort.time when replaying
+        :param read_timeout: the data port read timeout in seconds, which bounds how long stop() waits for a read
+        """
+        super().__init__(daemon=True)
+        self.console_port = console_port
+        self.data_port = data_port
+        self.samples = deque(maxlen=maxlen)
+        self.stream_rate = stream_rate
+        self.binary = binary
+        self.controller = controller
+        self.averaging = averaging
+        self.sensor_intervals = sensor_intervals
+        self.clock_source = clock
+        self.read_timeout = read_timeout
+        self.reads_per_sample = None                        # lwlp reads in the latest sample, as reported
+        self.sensor_ages_ms = None                          # [bmp, aht] age of the latest sample's ambient values
+        self.last_pwm = None                                # last pwm value written to the feather
+        self.dropped = 0                                    # samples discarded because the queue was full
+        self.clock = ClockSync()                            # device time to host time
+        self.sequence = SequenceTracker()                   # frames received and lost on the link
+        self.error = None                                   # exception that stopped the worker, if any
+        self._pending_pwm = deque(maxlen=1)                 # latest pwm value waiting to be written by the worker
+        self._stop_event = threading.Event()
+
+    def set_pwm(self, pwm_val):
+        """
+        Queues a pwm value to be sent to the feather by the worker thread with its next data request, or between
+        streamed samples. It is only written if it differs from the last value sent.
+
+        :param pwm_val: a value between 0 and 65535 (16-bit resolution) corresponding to the duty cycle of the fan
+        :return: None
+        """
+        self._pending_pwm.append(pwm_val)
+
+    def drain(self):
+        """
+        Removes and returns every sample currently in the queue.
+
+        :return: a list of (host_time, sample) tuples, oldest first
+        """
+        drained = []
+        while True:
+            try:
+                drained.append(self.samples.popleft())
+            except IndexError:
+                return drained
+
+    def register_metrics(self, registry=METRICS, prefix="acquisition"):
+        """
+        Exposes the worker's counters as metrics read at scrape time, so they cost nothing on the acquisition thread.
+
+        :param registry: the metrics registry
+        :param prefix: the start of every metric name, distinct for each worker in one process
+        :return: None
+        """
+        def received():
+            return self.sequence.received
+
+        registry.counter(f"{prefix}_samples_total", "Frames received from the feather", received)
+        registry.gauge(f"{prefix}_samples_per_second", "Frames received per second", Rate(received))
+        registry.counter(f"{prefix}_lost_frames_total", "Frames missing from the sequence", lambda: self.lost)
+        registry.counter(f"{prefix}_dropped_samples_total", "Samples discarded from a full queue", lambda: self.dropped)
+        registry.gauge(f"{prefix}_queue_depth", "Samples waiting to be drained", lambda: len(self.samples))
+        registry.gauge(f"{prefix}_clock_drift", "Host seconds gained per device second", lambda: self.clock.drift)
+
+    def stop(self, timeout=1.0):
+        """
+        Asks the worker to finish its current request, write any pending pwm value and exit.
+
+        :param timeout: seconds to wait for the thread to finish
+        :return: None
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        try:
+            self.data_port.timeout = self.read_timeout      # lets the worker notice stop() while no data arrives
+            set_frame_format(self.console_port, BINARY_FORMAT if self.binary else EXTENDED_FORMAT)
+            set_averaging(self.console_port, self.averaging)
+            if self.sensor_intervals is not None:
+                set_sensor_intervals(self.console_port, *self.sensor_intervals)
+            if self.stream_rate is None:
+                self._poll()
+            else:
+                self._stream()
+            self._write_pending_pwm()
+        except Exception as error:                          # keep the failure visible to the GUI thread
+            self.error = error
+
+    @property
+    def lost(self):
+        """
+        :return: the number of frames the feather sent that never arrived, from gaps in their sequence numbers
+        """
+        return self.sequence.lost
+
+    def _poll(self):
+        while not self._stop_event.is_set():
+            pwm_val = self._take_pending_pwm()              # rides along with the request
+            if self.binary:
+                frames = request_binary_data(self.console_port, self.data_port, 1, pwm_val)
+            else:
+                frames = extended_to_records(request_data_array(self.console_port, self.data_port, 1,
+                                                                EXTENDED_FIELDS, pwm_val))
+            self._queue(self.clock_source(), frames)
+
+    def _stream(self):
+        start_stream(self.console_port, self.stream_rate)
+        if self.binary:
+            received = stream_binary_data(self.data_port)
+        else:
+            received = self._extended_stream()
+        for frames in received:
+            self._queue(self.clock_source(), frames)
+            self._write_pending_pwm()                       # the feather reads commands between streamed samples
+            if self._stop_event.is_set():
+                break
+        stop_stream(self.console_port)
+
+    def _extended_stream(self):
+        for sample in stream_data(self.data_port):
+            if not sample:                                  # the read timed out
+                yield extended_to_records([])
+                continue
+            try:
+                values = np.array(sample, dtype=float)
+            except ValueError:
+                values = None
+            if values is None or len(values) != EXTENDED_FIELDS:   # malformed, or left from an earlier format
+                if METRICS.enabled:
+                    BAD_FRAMES.inc()
+                continue
+            yield extended_to_records(values)
+
+    def _queue(self, host_time, frames):
+        if not len(frames):
+            return
+        self.sequence.add(frames["sequence"])
+        sample_times = self.clock.add(frames["device_ms"], host_time)
+        self.reads_per_sample = int(frames["count"][-1])
+        self.sensor_ages_ms = frames["age_ms"][-1].tolist()
+        for sample_time, values in zip(sample_times, frames["values"].tolist()):
+            if len(self.samples) == self.samples.maxlen:
+                self.dropped += 1
+            self.samples.append((sample_time, values))
+            if self.controller is not None:                 # closed loop on lwlp pressure
+                pwm_val = self.controller.update(sample_time, values[4])
+                if self.stream_rate is None:
+                    self._pending_pwm.append(pwm_val)       # sent with the next request
+                else:
+                    self._send_pwm(pwm_val)
+
+    def _take_pending_pwm(self):
+        try:
+            pwm_val = self._pending_pwm.popleft()
+        except IndexError:
+            return None
+        if pwm_val == self.last_pwm:
+            return None
+        self.last_pwm = pwm_val
+        return pwm_val
+
+    def _write_pending_pwm(self):
+        pwm_val = self._take_pending_pwm()
+        if pwm_val is not None:
+            send_pwm(self.console_port, pwm_val)
+
+    def _send_pwm(self, pwm_val):
+        if pwm_val != self.last_pwm:
+            send_pwm(self.console_port, pwm_val)
+            self.last_pwm = pwm_val
@@ -0,0 +1,459 @@
+"""
+This module benchmarks the host side data path without any hardware attached
+
+...
+Each stage of the pipeline is driven with synthetic data and timed tick by tick, where a tick is one call of the
+code under test (one request parsed, one GUI refresh, one batch recorded, ...). For every stage and parameter set
+the suite reports:
+
+    samples_per_s       samples processed per second of wall time
+    tick_ms             per-tick latency percentiles (p50, p90, p99, max) in milliseconds
+    memory_kb           memory still allocated after the run and its peak, measured in a second traced pass
+
+Stages:
+
+    parse               request_data, request_data_array, extended ascii and binary frames against a canned reply
+    window              RollingWindow.extend + mean against the window size
+    lcds                MainWindow.update_lcds and update_lcds_FIXED against the window size
+    plot                MainWindow.update_plot against the number of points already plotted
+    record              MainWindow.record_samples into csv and columnar recorders, including the final close
+    reprocess           physics.reprocess over a whole recording held in memory, against its length
+    acquisition         AcquisitionWorker against the simulated feather, polling and streaming, ascii and binary
+
+The lcds, plot and record stages call the real MainWindow methods on a stand-in object, so they need PyQt5 and
+pyqtgraph installed (no display is used) and must be run from the repository root, like the GUI. Results can be
+written as JSON and compared against an earlier run to catch regressions between commits.
+
+Usage:
+
+    python python_files/benchmark.py [--stages parse window ...] [--quick] [--output results.json]
+                                     [--compare baseline.json]
+
+"""
+import argparse
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+import numpy as np
+from feathercom import request_data, request_data_array, request_binary_data, BINARY_SYNC
+from feathercom import extended_to_records, EXTENDED_FIELDS
+from rolling import RollingWindow
+from plotbuffer import PlotBuffer
+from recorder import Recorder, ColumnarRecorder
+from acquisition import AcquisitionWorker
+from physics import reprocess
+from simulator import open_simulated_ports
+
+SAMPLE = [1013.2345703125, 23.4567, 45.678, 23.123, 12.345678, 24.5]
+STAGES = ["parse", "window", "lcds", "plot", "record", "reprocess", "acquisition"]
+
+
+class CannedPort:
+    """
+    Serves the same byte reply every time a command is written, like a feather answering <D,n>.
+
+    ...
+    read_until is implemented with bytes.find rather than pyserial's byte-at-a-time loop, so the timings for
+        request_data measure its parsing cost and flatter its real I/O cost.
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.buffer = b""
+        self.position = 0
+
+    def write(self, data):
+        self.buffer = self.reply
+        self.position = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer) - self.position
+
+    def read(self, size=1):
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def read_until(self, expected=b"\n"):
+        end = self.buffer.find(expected, self.position)
+        end = len(self.buffer) if end == -1 else end + len(expected)
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+
+class StubLCD:
+    """
+    Stands in for a QLCDNumber: remembers the last value displayed.
+    """
+
+    def __init__(self, value=0.0):
+        self._value = value
+
+    def display(self, value):
+        self._value = float(value)
+
+    def value(self):
+        return self._value
+
+
+def ascii_reply(num_samples):
+    """
+    :param num_samples: the number of frames
+    :return: the bytes of 'num_samples' ascii frames, as the feather would send them
+    """
+    return b"".join([bytes("<" + ",".join(str(value) for value in SAMPLE) + ">", "ascii")] * num_samples)
+
+
+def extended_reply(num_samples):
+    """
+    :param num_samples: the number of frames
+    :return: the bytes of 'num_samples' extended ascii frames, as the feather would send them
+    """
+    frames = []
+    for sequence in range(num_samples):
+        frames.append(bytes("<" + ",".join(str(value) for value in [*SAMPLE, sequence, sequence, 1, 0, 0]) + ">",
+                            "ascii"))
+    return b"".join(frames)
+
+
+def request_extended_data(console_port, data_port, num_samples):
+    """
+    The acquisition worker's ascii path: extended frames parsed and converted to a record array
+    """
+    return extended_to_records(request_data_array(console_port, data_port, num_samples, EXTENDED_FIELDS))
+
+
+def binary_reply(num_samples):
+    """
+    :param num_samples: the number of frames
+    :return: the bytes of 'num_samples' binary frames, as the feather would send them
+    """
+    frames = []
+    for sequence in range(num_samples):
+        payload = struct.pack("<6fIIIHH", *SAMPLE, sequence, sequence, 1, 0, 0)
+        frames.append(BINARY_SYNC + payload + struct.pack("<I", zlib.crc32(payload)))
+    return b"".join(frames)
+
+
+def sensor_batch(num_samples, rng):
+    """
+    :param num_samples: the number of rows
+    :param rng: a NumPy random generator
+    :return: an array in MainWindow.get_data's layout [pressure, temperature, diff_pressure, humidity]
+    """
+    base = np.array([1013.25, 22.0, 30.0, 40.0])
+    return base + rng.normal(0, [0.02, 0.01, 0.5, 0.1], (num_samples, 4))
+
+
+def gui_stub(window_size=10, plot_window=None, with_plot=False):
+    """
+    Builds a stand-in for MainWindow holding just the attributes its data path methods use.
+
+    :param window_size: the moving average window size
+    :param plot_window: MainWindow's plot_window
+    :param with_plot: True to attach a real pyqtgraph plot for update_plot
+    :return: a SimpleNamespace usable as 'self' for MainWindow methods
+    """
+    stub = SimpleNamespace(
+        window_size=window_size,
+        env_window=RollingWindow(window_size, 4),
+        dp_window=RollingWindow(window_size),
+        initDP=30.0, density=1.2, pressure=101325.0, fixed_mode=False, humidity_correction=False,
+        desiredLCD=StubLCD(50), actualLCD=StubLCD(), tempLCD=StubLCD(), pressureLCD=StubLCD(),
+        humLCD=StubLCD(), densityLCD=StubLCD(),
+        plot_window=plot_window, plot_start_time=time.time(), actual_points=PlotBuffer(max_age=plot_window),
+        latest_sample_time=None, recorder=None,
+    )
+    if with_plot:
+        import pyqtgraph as pg
+        stub.livePlot = pg.PlotWidget()
+        stub.livePlot.actualCurve = stub.livePlot.plot()
+        stub.livePlot.actualCurve.setClipToView(True)
+        stub.livePlot.actualCurve.setDownsampling(auto=True, method='peak')
+    return stub
+
+
+def time_ticks(tick, num_ticks):
+    """
+    :param tick: a function doing one tick of work
+    :param num_ticks: the number of ticks
+    :return: (total seconds, array of per-tick seconds)
+    """
+    durations = np.empty(num_ticks)
+    start = time.perf_counter()
+    for index in range(num_ticks):
+        tick_start = time.perf_counter()
+        tick()
+        durations[index] = time.perf_counter() - tick_start
+    return time.perf_counter() - start, durations
+
+
+def measure(stage, params, make_tick, num_ticks, samples_per_tick, finish=None):
+    """
+    Times a stage, then repeats it under tracemalloc to measure its memory.
+
+    :param stage: the stage name
+    :param params: a dict describing this configuration
+    :param make_tick: a function returning a fresh tick function, called once per pass
+    :param num_ticks: the number of ticks per pass
+    :param samples_per_tick: the number of samples one tick processes
+    :param finish: optional function taking the tick function, run after the ticks and included in the total time
+    :return: a result dict
+    """
+    tick = make_tick()
+    total, durations = time_ticks(tick, num_ticks)
+    if finish is not None:
+        finish_start = time.perf_counter()
+        finish(tick)
+        total += time.perf_counter() - finish_start
+
+    tracemalloc.start()
+    tick = make_tick()
+    time_ticks(tick, num_ticks)
+    if finish is not None:
+        finish(tick)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "stage": stage,
+        "params": params,
+        "samples_per_s": samples_per_tick * num_ticks / total,
+        "tick_ms": {
+            "p50": float(np.percentile(durations, 50) * 1e3),
+            "p90": float(np.percentile(durations, 90) * 1e3),
+            "p99": float(np.percentile(durations, 99) * 1e3),
+            "max": float(durations.max() * 1e3),
+        },
+        "memory_kb": {"retained": current / 1024, "peak": peak / 1024},
+    }
+
+
+def bench_parse(quick):
+    results = []
+    for num_samples in ([1, 100] if quick else [1, 100, 10000]):
+        num_ticks = max(5, (2000 if quick else 20000) // num_samples)
+        parsers = [
+            ("request_data", request_data, ascii_reply(num_samples)),
+            ("request_data_array", request_data_array, ascii_reply(num_samples)),
+            ("request_extended_data", request_extended_data, extended_reply(num_samples)),
+            ("request_binary_data", request_binary_data, binary_reply(num_samples)),
+        ]
+        for name, parser, reply in parsers:
+            def make_tick(parser=parser, reply=reply, num_samples=num_samples):
+                port = CannedPort(reply)
+                return lambda: parser(port, port, num_samples)
+            results.append(measure("parse", {"parser": name, "samples": num_samples}, make_tick, num_ticks,
+                                   num_samples))
+    return results
+
+
+def bench_window(quick):
+    results = []
+    batch = 20                                              # one 200 ms GUI tick at 100 samples/s
+    for window_size in ([10, 1000] if quick else [10, 1000, 10000]):
+        def make_tick(window_size=window_size):
+            window = RollingWindow(window_size, 4)
+            rows = sensor_batch(batch, np.random.default_rng(0))
+
+            def tick():
+                window.extend(rows)
+                window.mean()
+            return tick
+        results.append(measure("window", {"window_size": window_size, "batch": batch}, make_tick,
+                               500 if quick else 5000, batch))
+    return results
+
+
+def bench_lcds(quick):
+    from TunnelGUI import MainWindow
+    results = []
+    batch = 20
+    for method in (MainWindow.update_lcds, MainWindow.update_lcds_FIXED):
+        for window_size in ([10, 1000] if quick else [10, 1000, 10000]):
+            def make_tick(method=method, window_size=window_size):
+                stub = gui_stub(window_size)
+                data = sensor_batch(batch, np.random.default_rng(0))
+                return lambda: method(stub, data)
+            results.append(measure("lcds", {"method": method.__name__, "window_size": window_size, "batch": batch},
+                                   make_tick, 500 if quick else 5000, batch))
+    return results
+
+
+def bench_plot(quick):
+    from PyQt5.QtWidgets import QApplication
+    from TunnelGUI import MainWindow
+    app = QApplication.instance() or QApplication(["benchmark", "-platform", "offscreen"])
+    results = []
+    for run_length in ([1000, 10000] if quick else [1000, 10000, 100000]):
+        for plot_window in (None, 60.0):
+            def make_tick(run_length=run_length, plot_window=plot_window):
+                stub = gui_stub(plot_window=plot_window, with_plot=True)
+                stub.plot_start_time = time.time() - run_length * 0.2
+                for index in range(run_length):             # points already on the plot at 5 Hz
+                    stub.actual_points.append(index * 0.2, 5.0)
+                return lambda: MainWindow.update_plot(stub)
+            results.append(measure("plot", {"run_length": run_length, "plot_window": plot_window}, make_tick,
+                                   200 if quick else 1000, 1))
+    app.processEvents()
+    return results
+
+
+def bench_record(quick):
+    from TunnelGUI import MainWindow
+    results = []
+    batch = 20
+    fieldnames = ["time", "velocity", "duty", "diff_pressure", "humidity", "pressure", "temp", "density"]
+    with tempfile.TemporaryDirectory() as folder:
+        for name, recorder_class in (("csv", Recorder), ("columnar", ColumnarRecorder)):
+            counter = iter(range(1000))
+
+            def make_tick(recorder_class=recorder_class, name=name):
+                stub = gui_stub()
+                stub.recorder = recorder_class(os.path.join(folder, f"{name}_{next(counter)}"), fieldnames)
+                stub.recorder.start()
+                data = sensor_batch(batch, np.random.default_rng(0))
+                times = np.full(batch, time.time())
+
+                def tick():
+                    MainWindow.record_samples(stub, times, data)
+                tick.stub = stub
+                return tick
+
+            def finish(tick):
+                tick.stub.recorder.close()
+            results.append(measure("record", {"format": name, "batch": batch}, make_tick,
+                                   500 if quick else 5000, batch, finish))
+    return results
+
+
+def bench_reprocess(quick):
+    results = []
+    for num_samples in ([100000] if quick else [100000, 1000000]):  # 1e6 samples is about 3 h at 100 samples/s
+        for humidity_correction in (False, True):
+            def make_tick(num_samples=num_samples, humidity_correction=humidity_correction):
+                data = sensor_batch(num_samples, np.random.default_rng(0))
+                columns = {"diff_pressure": data[:, 2], "pressure": data[:, 0] / 10, "temp": data[:, 1],
+                           "humidity": data[:, 3]}
+                return lambda: reprocess(columns, 30.0, humidity_correction=humidity_correction, dp_sigma=0.5)
+            results.append(measure("reprocess", {"samples": num_samples, "humidity_correction": humidity_correction},
+                                   make_tick, 5 if quick else 20, num_samples))
+    return results
+
+
+def bench_acquisition(quick):
+    results = []
+    duration = 1.0 if quick else 3.0
+    for stream_rate in (None, 0):
+        for binary in (False, True):
+            console_port, data_port = open_simulated_ports(sample_time=0)
+            worker = AcquisitionWorker(console_port, data_port, stream_rate=stream_rate, binary=binary)
+            worker.start()
+            samples = []
+            end = time.monotonic() + duration
+            while time.monotonic() < end:                   # drain like the GUI timer so the queue never fills
+                time.sleep(0.05)
+                samples.extend(worker.drain())
+            worker.stop()
+            console_port.feather.stop()
+            times = np.array([host_time for host_time, sample in samples])
+            gaps = np.diff(times) if len(times) > 1 else np.zeros(1)
+            results.append({
+                "stage": "acquisition",
+                "params": {"mode": "poll" if stream_rate is None else "stream", "binary": binary},
+                "samples_per_s": len(samples) / duration,
+                "tick_ms": {                                # gaps between consecutive samples
+                    "p50": float(np.percentile(gaps, 50) * 1e3),
+                    "p90": float(np.percentile(gaps, 90) * 1e3),
+                    "p99": float(np.percentile(gaps, 99) * 1e3),
+                    "max": float(gaps.max() * 1e3),
+                },
+                "dropped": worker.dropped,
+                "lost": worker.lost,
+                "error": None if worker.error is None else repr(worker.error),
+            })
+    return results
+
+
+def environment():
+    """
+    :return: a dict describing the machine and commit the results came from
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+    }
+
+
+def result_key(result):
+    return result["stage"], json.dumps(result["params"], sort_keys=True)
+
+
+def print_results(results, baseline=None):
+    """
+    Prints one line per result, with the throughput ratio to a baseline run when given.
+
+    :param results: result dicts from the bench_* functions
+    :param baseline: a dict of result_key to result dict, or None
+    :return: None
+    """
+    print(f"{'stage':<12} {'params':<60} {'samples/s':>12} {'p50 ms':>9} {'p99 ms':>9} {'mem kB':>9}"
+          + (f" {'vs base':>8}" if baseline else ""))
+    for result in results:
+        params = ", ".join(f"{key}={value}" for key, value in result["params"].items())
+        line = (f"{result['stage']:<12} {params:<60} {result['samples_per_s']:>12.0f} "
+                f"{result['tick_ms']['p50']:>9.3f} {result['tick_ms']['p99']:>9.3f} "
+                f"{result.get('memory_kb', {}).get('retained', float('nan')):>9.1f}")
+        if baseline:
+            previous = baseline.get(result_key(result))
+            line += f" {result['samples_per_s'] / previous['samples_per_s']:>7.2f}x" if previous else f" {'new':>8}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the host side data path')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run')
+    parser.add_argument('--quick', action='store_true', help='Fewer sizes and ticks, for a fast check')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare throughput against')
+    args = parser.parse_args()
+
+    results = []
+    for stage in args.stages:
+        try:
+            results.extend(globals()[f"bench_{stage}"](args.quick))
+        except ImportError as error:                        # the GUI stages need PyQt5 and pyqtgraph
+            print(f"Skipping {stage}: {error}", file=sys.stderr)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {result_key(result): result for result in json.load(file)["results"]}
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump({"environment": environment(), "results": results}, file, indent=2)
+        print(f"Results saved to: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+This module contains calibration jobs that average samples taken from the live acquisition stream
+
+...
+A job does not read from the feather itself. The GUI (or any other consumer) passes it each batch of samples it
+drains from the acquisition worker, so calibrating never blocks the event loop. A job finishes when it has seen a
+fixed number of samples, when the standard error of every channel's mean drops below a target, or when its time
+limit runs out, whichever comes first. It can be cancelled at any time.
+
+Classes:
+
+    CalibrationJob(num_channels, max_samples, target_sem, min_samples, max_duration)
+        Running mean and standard error of one or more channels with configurable termination
+
+"""
+import numpy as np
+
+
+class CalibrationJob:
+    """
+    Running mean and standard error of one or more channels with configurable termination.
+
+    ...
+    Means and variances are merged batch by batch (Chan et al.), which stays accurate for large offsets such as
+        ambient pressure in Pa.
+    """
+
+    def __init__(self, num_channels=1, max_samples=None, target_sem=None, min_samples=10, max_duration=None):
+        """
+        :param num_channels: the number of columns in each batch of samples
+        :param max_samples: finish after this many samples, or None for no sample limit
+        :param target_sem: finish once the standard error of every channel's mean is at or below this, or None
+        :param min_samples: the fewest samples before target_sem is checked
+        :param max_duration: finish this many seconds after the first sample, or None for no time limit
+        """
+        if max_samples is None and target_sem is None and max_duration is None:
+            raise ValueError("a calibration job needs max_samples, target_sem or max_duration to finish")
+        self.num_channels = num_channels
+        self.max_samples = max_samples
+        self.target_sem = target_sem
+        self.min_samples = min_samples
+        self.max_duration = max_duration
+        self.count = 0
+        self.done = False
+        self.cancelled = False
+        self._mean = np.zeros(num_channels)
+        self._m2 = np.zeros(num_channels)                   # sum of squared deviations from the mean
+        self._start_time = None
+        self._last_time = None
+
+    @property
+    def active(self):
+        """
+        :return: True until the job has finished or been cancelled
+        """
+        return not (self.done or self.cancelled)
+
+    def cancel(self):
+        """
+        Stops the job. Further samples are ignored and its results should not be used.
+
+        :return: None
+        """
+        self.cancelled = True
+
+    def add(self, times, rows):
+        """
+        Adds a batch of samples and checks whether the job has finished.
+
+        :param times: the time in seconds of each sample, e.g. the acquisition worker's host times
+        :param rows: an array of shape (n, num_channels), or shape (n,) for a single channel job
+        :return: True if the job is finished
+        """
+        if not self.active:
+            return self.done
+        rows = np.asarray(rows, dtype=float).reshape(-1, self.num_channels)
+        if self.max_samples is not None:
+            rows = rows[:self.max_samples - self.count]     # ignore anything past the sample limit
+        if len(rows):
+            if self._start_time is None:
+                self._start_time = times[0]
+            self._last_time = times[len(rows) - 1]
+            self._merge(rows)
+
+        if self.max_samples is not None and self.count >= self.max_samples:
+            self.done = True
+        elif self.target_sem is not None and self.count >= self.min_samples and \
+                np.all(self.sem() <= self.target_sem):
+            self.done = True
+        elif self.max_duration is not None and self._start_time is not None and \
+                self._last_time - self._start_time >= self.max_duration:
+            self.done = True
+        return self.done
+
+    def mean(self):
+        """
+        :return: the mean of each channel, or zeros before any samples arrive
+        """
+        return self._mean.copy()
+
+    def std(self):
+        """
+        :return: the sample standard deviation of each channel, or zeros with fewer than two samples
+        """
+        if self.count < 2:
+            return np.zeros(self.num_channels)
+        return np.sqrt(self._m2 / (self.count - 1))
+
+    def sem(self):
+        """
+        :return: the standard error of each channel's mean, or infinity with fewer than two samples
+        """
+        if self.count < 2:
+            return np.full(self.num_channels, np.inf)
+        return self.std() / np.sqrt(self.count)
+
+    def progress(self):
+        """
+        Estimates how far the job is towards finishing, for a progress bar.
+
+        ...
+        Each termination rule gives its own fraction and the largest is reported. For target_sem the fraction is
+            (target / sem)^2, since the standard error falls with the square root of the sample count.
+
+        :return: a fraction between 0 and 1
+        """
+        if self.done:
+            return 1.0
+        fractions = [0.0]
+        if self.max_samples is not None:
+            fractions.append(self.count / self.max_samples)
+        if self.target_sem is not None and self.count >= 2:
+            fractions.append(np.min((self.target_sem / np.maximum(self.sem(), 1e-300)) ** 2))
+        if self.max_duration is not None and self._start_time is not None:
+            fractions.append((self._last_time - self._start_time) / self.max_duration)
+        return float(min(max(fractions), 1.0))
+
+    def _merge(self, rows):
+        count = len(rows)
+        mean = rows.mean(axis=0)
+        m2 = ((rows - mean) ** 2).sum(axis=0)
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean = self._mean + delta * count / total
+        self._m2 = self._m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
@@ -0,0 +1,421 @@
+"""
+This module records the raw byte stream from the feather's data port and plays it back through the host pipeline
+
+...
+CapturePort wraps an open data port. Every read is passed through unchanged and also appended to a capture file
+together with the host time it was received, so a run can be reproduced byte for byte, including corrupt or lost
+frames. ReplayPort stands in for both ports of a feather and serves a capture's bytes back with their original
+spacing, at N times real time, or as fast as they can be parsed. Commands written to it are ignored.
+
+AcquisitionWorker takes its host timestamps from a clock function. A replay hands it ReplayPort.time, so clock
+alignment, loss counting and everything downstream see the same times as the original run whatever the replay speed.
+
+Capture file format:
+
+    b"FCAP1\n"                          magic
+    one line of JSON                    metadata: start time, binary, stream rate and other settings of the run
+    records of "<dI" + payload          host time of the read (time.time()), payload length, payload bytes
+
+Classes:
+
+    CapturePort(port, filename, metadata, flush_interval)
+        Data port wrapper that tees every byte read to a capture file
+
+    ReplayPort(filename, speed, rebase)
+        Serves a capture's bytes back like a feather's ports
+
+Functions:
+
+    read_capture(filename)
+        Reads a capture's metadata and iterates over its records
+
+    open_replay_ports(filename, speed, rebase)
+        Opens a capture as a pair of feather ports, like simulator.open_simulated_ports
+
+    replay(filename, speed, window_size, tick, init_dp, tare_seconds, humidity_correction, recorder)
+        Runs a capture through the acquisition worker, windowing and velocity calculation
+
+    main()
+        Command line entry point
+
+Usage:
+
+    python python_files/capture.py data_output/capture_1.fcap [--speed 0] [--window_size 10] [--init_dp 31.2]
+                                   [--record_format columnar]
+
+    python python_files/TunnelGUI.py --capture                  records a capture alongside the usual recording
+    python python_files/TunnelGUI.py --replay data_output/capture_1.fcap [--replay_speed 4]
+
+"""
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+from acquisition import AcquisitionWorker
+from calibration import CalibrationJob
+from physics import density, velocity
+from recorder import Recorder, ColumnarRecorder, COLUMNAR_EXTENSION, next_filename
+from rolling import RollingWindow
+
+CAPTURE_MAGIC = b"FCAP1\n"
+CAPTURE_EXTENSION = ".fcap"
+RECORD_HEADER = struct.Struct("<dI")  # host time in seconds, payload length
+FAST_SPAN = 0.05  # seconds of capture released per read when replaying as fast as possible
+REPLAY_FIELDS = ["time", "velocity", "diff_pressure", "density", "humidity", "temp", "pressure", "samples"]
+
+
+class CapturePort:
+    """
+    Data port wrapper that tees every byte read to a capture file.
+
+    ...
+    Only read and read_until are intercepted; every other attribute is the wrapped port's. The file is flushed every
+        flush_interval seconds from the reading thread, so a crash loses at most that much of the capture.
+    """
+
+    def __init__(self, port, filename, metadata=None, flush_interval=1.0):
+        """
+        :param port: the open data port, e.g. a serial.Serial or simulator.SimulatedPort
+        :param filename: the capture file to create
+        :param metadata: a JSON serializable dict describing the run, e.g. the frame format and stream rate
+        :param flush_interval: the most seconds between flushes to disk
+        """
+        self.port = port
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.bytes_captured = 0
+        self._file = open(filename, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._file.write(json.dumps(dict(metadata or {}, start_time=time.time())).encode("utf-8") + b"\n")
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()                       # close may come from another thread than the reads
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    @property
+    def timeout(self):
+        """
+        :return: the wrapped port's read timeout, which is also set through the wrapper
+        """
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.port.timeout = timeout
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self._capture(data)
+        return data
+
+    def read_until(self, expected=b"\n", size=None):
+        data = self.port.read_until(expected, size) if size is not None else self.port.read_until(expected)
+        self._capture(data)
+        return data
+
+    def close(self):
+        """
+        Closes the capture file, then the wrapped port.
+
+        :return: None
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+        self.port.close()
+
+    def _capture(self, data):
+        if not data:
+            return
+        host_time = time.time()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD_HEADER.pack(host_time, len(data)))
+            self._file.write(data)
+            self.bytes_captured += len(data)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = time.monotonic()
+
+
+def read_capture(filename):
+    """
+    Reads a capture's metadata and iterates over its records
+
+    ...
+    A record cut short at the end of the file (the capture was not closed) is ignored.
+
+    :param filename: the capture file
+    :return: (metadata, records) where records yields (host_time, payload bytes) in the order they were read
+    """
+    file = open(filename, "rb")
+    if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        file.close()
+        raise ValueError(f"{filename} is not a capture file")
+    metadata = json.loads(file.readline())
+
+    def records():
+        with file:
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                host_time, length = RECORD_HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length:
+                    return
+                yield host_time, payload
+    return metadata, records()
+
+
+class ReplayPort:
+    """
+    Serves a capture's bytes back like a feather's ports.
+
+    ...
+    Each record is released once its recorded time, relative to the first record and divided by 'speed', has passed.
+        With speed 0 records are released as soon as they are read, FAST_SPAN seconds of capture at a time.
+    Released records keep their boundaries: in_waiting only counts the rest of the oldest unread record, and time()
+        is the recorded time of the record holding the last byte read. A consumer reading in_waiting bytes at a time
+        therefore sees the original reads with their original times whatever the speed or release batching. Reads
+        block like a serial port without a timeout; once the capture is used up, or the port is closed, they raise
+        EOFError.
+    """
+
+    def __init__(self, filename, speed=1.0, rebase=False):
+        """
+        :param filename: the capture file
+        :param speed: the playback speed, 1 for real time, or 0 for as fast as possible
+        :param rebase: True to shift the recorded times so the capture starts now, for consumers that compare sample
+            times against time.time() like the GUI
+        """
+        self.filename = filename
+        self.speed = speed
+        self.rebase = rebase
+        self.metadata, self._records = read_capture(filename)
+        self.host_time = None                               # recorded time of the record holding the last byte read
+        self.closed = False
+        self._buffer = bytearray()
+        self._bounds = deque()                              # (stream position of the end, host time) of each record
+        self._consumed = 0                                  # stream position of the start of _buffer
+        self._next = None                                   # the next record, not yet released
+        self._first_time = None                             # recorded time of the first record
+        self._start = None                                  # time.monotonic() when the first record was released
+        self._offset = 0.0                                  # added to recorded times by time()
+
+    @property
+    def in_waiting(self):
+        self._release()
+        return self._bounds[0][0] - self._consumed if self._bounds else 0
+
+    def time(self):
+        """
+        :return: the recorded host time of the record the last byte read came from, shifted to now if rebase is set
+        """
+        return (self.host_time if self.host_time is not None else time.time()) + self._offset
+
+    def write(self, data):
+        return len(data)                                    # commands to the feather are ignored
+
+    def read(self, size=1):
+        while len(self._buffer) < size:
+            wait = self._release()
+            if len(self._buffer) >= size:
+                break
+            if self.closed or wait is None:
+                if self._buffer:
+                    break
+                raise EOFError("capture closed" if self.closed else f"end of capture {self.filename}")
+            time.sleep(min(wait, 0.05))                     # wake up now and then to notice close()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._consumed += len(data)
+        while self._bounds and self._bounds[0][0] < self._consumed:   # records read to the end before this byte
+            self._bounds.popleft()
+        if self._bounds:
+            self.host_time = self._bounds[0][1]
+            if self._bounds[0][0] == self._consumed:
+                self._bounds.popleft()
+        return data
+
+    def read_until(self, expected=b"\n", size=None):
+        data = bytearray()
+        while not data.endswith(expected) and (size is None or len(data) < size):
+            data += self.read(1)
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        self._consumed += len(self._buffer)
+        self._buffer.clear()
+        self._bounds.clear()
+
+    def close(self):
+        self.closed = True
+
+    def _release(self):
+        # moves every record that is due into the buffer
+        # returns the seconds until the next record is due, or None at the end of the capture
+        batch_start = None
+        while True:
+            if self._next is None:
+                self._next = next(self._records, None)
+                if self._next is None:
+                    return None
+            host_time, payload = self._next
+            if self._first_time is None:
+                self._first_time, self._start = host_time, time.monotonic()
+                self._offset = time.time() - host_time if self.rebase else 0.0
+            if self.speed:
+                wait = self._start + (host_time - self._first_time) / self.speed - time.monotonic()
+                if wait > 0:
+                    return wait
+            else:
+                if batch_start is None:
+                    batch_start = host_time
+                elif host_time - batch_start > FAST_SPAN:
+                    return 0.0
+            self._buffer += payload
+            self._bounds.append((self._consumed + len(self._buffer), host_time))
+            self._next = None
+
+
+def open_replay_ports(filename, speed=1.0, rebase=False):
+    """
+    :param filename: the capture file
+    :param speed: the playback speed, 1 for real time, or 0 for as fast as possible
+    :param rebase: True to shift the recorded times so the capture starts now
+    :return: (console_port, data_port), both the same ReplayPort
+    """
+    port = ReplayPort(filename, speed, rebase)
+    return port, port
+
+
+def replay(filename, speed=0, window_size=10, tick=0.2, init_dp=None, tare_seconds=5.0, humidity_correction=False,
+           recorder=None):
+    """
+    Runs a capture through the acquisition worker, windowing and velocity calculation
+
+    ...
+    Samples are grouped into ticks of 'tick' seconds of sample time, and each tick is handled like one refresh of the
+        GUI: the rolling windows are extended with its samples and one row of window means is produced. Without an
+        init_dp, the differential pressure is tared over the first tare_seconds of samples, as the GUI does at start.
+
+    :param filename: the capture file
+    :param speed: the playback speed, 1 for real time, or 0 for as fast as possible
+    :param window_size: the moving average window size, as in the GUI
+    :param tick: seconds of sample time per GUI refresh
+    :param init_dp: the tare in Pa, or None to tare from the start of the capture
+    :param tare_seconds: seconds of samples averaged for the tare when init_dp is None
+    :param humidity_correction: True to correct the density for humidity
+    :param recorder: an optional started Recorder or ColumnarRecorder for the rows, with REPLAY_FIELDS
+    :return: a dict with the number of samples and ticks, the seconds of samples replayed, lost and dropped frames,
+        the tare and the wall time taken
+    """
+    port = ReplayPort(filename, speed)
+    worker = AcquisitionWorker(port, port, maxlen=1000000, stream_rate=0, binary=port.metadata.get("binary", False),
+                               clock=port.time)
+    env_window = RollingWindow(window_size, 4)             # density, humidity, temperature, pressure columns
+    dp_window = RollingWindow(window_size)
+    tare_job = None if init_dp is not None else CalibrationJob(max_duration=tare_seconds)
+    rows = []
+    counts = {"samples": 0, "ticks": 0}
+    span = {"start": None, "end": None}                     # sample times of the first and latest samples
+    pending = []                                            # samples of the tick still being filled
+
+    def process(queued, final=False):
+        # ticks are only processed once complete, so the result does not depend on how the worker's reads
+        # happened to split them, i.e. on the replay speed
+        pending.extend(queued)
+        if not pending:
+            return
+        times = np.array([sample_time for sample_time, sample in pending])
+        data = np.array([sample for sample_time, sample in pending])
+        if span["start"] is None:
+            span["start"] = times[0]
+        span["end"] = times[-1]
+        ticks = ((times - span["start"]) // tick).astype(int)
+        complete = len(ticks) if final else int(np.searchsorted(ticks, ticks[-1]))
+        for index in np.unique(ticks[:complete]):            # one GUI refresh per tick with samples in it
+            batch = ticks[:complete] == index
+            process_tick(index, times[:complete][batch], data[:complete][batch])
+        counts["samples"] += complete
+        del pending[:complete]
+
+    def process_tick(index, times, data):
+        nonlocal init_dp, tare_job
+        if tare_job is not None and tare_job.add(times, data[:, 4]):
+            init_dp = tare_job.mean()[0]
+            tare_job = None
+            dp_window.fill(init_dp)
+        press_Pa = data[:, 0] * 100
+        dens = density(press_Pa, data[:, 3], data[:, 2] if humidity_correction else None)
+        env_window.extend(np.column_stack((dens, data[:, 2], data[:, 3], press_Pa / 1000)))
+        dp_window.extend(data[:, 4])
+        avg_dens, avg_hum, avg_temp, avg_press = env_window.mean()
+        avg_dp = dp_window.mean()[0]
+        avg_vel = np.nan if init_dp is None else velocity(avg_dp - init_dp, avg_dens)
+        rows.append([(index + 1) * tick, avg_vel, avg_dp, avg_dens, avg_hum, avg_temp, avg_press, len(data)])
+        counts["ticks"] += 1
+
+    wall_start = time.perf_counter()
+    worker.start()
+    while worker.is_alive():
+        worker.join(0.05)
+        process(worker.drain())
+        if recorder is not None and rows:
+            recorder.write_rows(np.array(rows))
+            rows.clear()
+    process(worker.drain(), final=True)
+    if recorder is not None and rows:
+        recorder.write_rows(np.array(rows))
+    if worker.error is not None and not isinstance(worker.error, EOFError):
+        raise worker.error
+    duration = 0.0 if span["start"] is None else span["end"] - span["start"]
+    return dict(counts, duration=duration, lost=worker.lost, dropped=worker.dropped, init_dp=init_dp,
+                wall_seconds=time.perf_counter() - wall_start, metadata=port.metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a raw capture through the host pipeline')
+    parser.add_argument('capture', help='A capture file written with --capture')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Playback speed: 1 for real time, N for N times faster, 0 for as fast as possible')
+    parser.add_argument('--window_size', type=int, default=10, help='Samples in the moving average window')
+    parser.add_argument('--tick', type=float, default=0.2, help='Seconds of samples per GUI refresh')
+    parser.add_argument('--init_dp', type=float, default=None,
+                        help='Tare in Pa instead of taring over the start of the capture')
+    parser.add_argument('--tare_seconds', type=float, default=5.0, help='Seconds of samples averaged for the tare')
+    parser.add_argument('--humidity_correction', action='store_true', help='Correct the density for humidity')
+    parser.add_argument('--record_format', choices=['csv', 'columnar'], default='csv',
+                        help='Record to csv or to a directory of memory-mappable binary columns')
+    parser.add_argument('--output_folder', default='data_output', help='Folder for the replayed rows')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    if args.record_format == "columnar":
+        recorder = ColumnarRecorder(next_filename(args.output_folder, "replayed_data", COLUMNAR_EXTENSION),
+                                    REPLAY_FIELDS, dtypes={"samples": "<u4"},
+                                    metadata={"capture": args.capture, "window_size": args.window_size})
+    else:
+        recorder = Recorder(next_filename(args.output_folder, "replayed_data"), REPLAY_FIELDS)
+    recorder.start()
+    try:
+        result = replay(args.capture, args.speed, args.window_size, args.tick, args.init_dp, args.tare_seconds,
+                        args.humidity_correction, recorder)
+    finally:
+        recorder.close()
+    print(f"Replayed {result['samples']} samples ({result['duration']:.1f} s) in {result['wall_seconds']:.2f} s, "
+          f"lost {result['lost']}, dropped {result['dropped']}, tare {result['init_dp']}")
+    print(f"Data saved to: {recorder.filename}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+This module contains the duty cycle to velocity map used as the velocity controller's feed-forward
+
+...
+A characterization sweep steps the fan through a range of duty cycles, lets the air speed settle at each and records
+the mean velocity (see the "characterize" step of headless.py). The sweep is stored with the air density it was taken
+at, and a map holds any number of sweeps at different densities, saved to a JSON file between runs.
+
+When a velocity is requested, duty_for inverts the sweeps by linear interpolation and returns the duty cycle that
+should give it, interpolating between the two sweeps that bracket the current density. VelocityController jumps
+straight to that duty and lets its PID trim the remainder, instead of integrating up from the previous duty.
+
+The map only answers for conditions it has seen:
+
+    - density: sweeps taken more than density_tolerance (relative) away from the current density are not used, so
+      a map made on a cold morning gives no estimate on a hot afternoon until it is swept again.
+    - drift: once the controller has held a setpoint, check compares the duty it settled at with the estimate. A
+      sweep that is out by more than drift_tolerance (duty fraction) is marked stale and no longer used, e.g. after
+      the fan, the filter or the test section has changed.
+
+Classes:
+
+    CharacterizationMap(density_tolerance, drift_tolerance)
+        Duty to velocity sweeps indexed by air density, with interpolated lookup and staleness checks
+
+Functions:
+
+    load_characterization(filename, **kwargs)
+        Reads a map saved by CharacterizationMap.save, or returns an empty map if the file does not exist
+
+    main()
+        Command line entry point, listing the sweeps of a map
+
+Usage:
+
+    python python_files/characterization.py data_output/characterization.json [--density 1.19] [--clear_stale]
+
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+SAME_DENSITY = 0.005  # relative density difference below which a new sweep replaces an old one
+
+
+class CharacterizationMap:
+    """
+    Duty to velocity sweeps indexed by air density, with interpolated lookup and staleness checks.
+
+    ...
+    Each sweep is a dict with 'density' in kg/m^3, 'time' (time.time() of the sweep), 'duty' (fractions of full
+        scale), 'velocity' (m/s, ascending) and 'stale'. Duties are fractions from 0 to 1, as VelocityController.duty.
+    The controller calls duty_for and check from the acquisition thread. Both only read the sweep list or flip a
+        sweep's 'stale' flag, so the map can be saved from another thread at any time.
+    """
+
+    def __init__(self, density_tolerance=0.02, drift_tolerance=0.05):
+        """
+        :param density_tolerance: the largest relative density difference at which a sweep is used
+        :param drift_tolerance: the largest difference in duty fraction between a settled duty and its estimate
+        """
+        self.density_tolerance = density_tolerance
+        self.drift_tolerance = drift_tolerance
+        self.sweeps = []
+        self.changed = False                                # sweeps added or marked stale since loading or saving
+
+    def add_sweep(self, density, duty, velocity, sweep_time=None):
+        """
+        Adds the settled points of a sweep, replacing any sweep taken at the same density.
+
+        ...
+        Points are sorted by duty and only those that raise the velocity are kept, so the sweep can be inverted:
+            below the stall duty every point reads about 0 m/s and the first of them stands for all.
+
+        :param density: the air density during the sweep in kg/m^3
+        :param duty: the duty fraction of each point
+        :param velocity: the settled mean velocity of each point in m/s
+        :param sweep_time: the time.time() of the sweep, now if None
+        :return: the sweep dict
+        :raises ValueError: if fewer than two points raise the velocity
+        """
+        order = np.argsort(duty)
+        duty = np.asarray(duty, dtype=float)[order]
+        velocity = np.asarray(velocity, dtype=float)[order]
+        keep = np.isfinite(velocity)
+        duty, velocity = duty[keep], velocity[keep]
+        rising = np.concatenate(([True], velocity[1:] > np.maximum.accumulate(velocity)[:-1]))
+        if rising.sum() < 2:
+            raise ValueError("a sweep needs at least two points with rising velocity")
+        sweep = {"density": float(density), "time": time.time() if sweep_time is None else sweep_time,
+                 "duty": duty[rising].tolist(), "velocity": velocity[rising].tolist(), "stale": False}
+        self.sweeps = [old for old in self.sweeps
+                       if abs(old["density"] - density) > SAME_DENSITY * density] + [sweep]
+        self.sweeps.sort(key=lambda old: old["density"])
+        self.changed = True
+        return sweep
+
+    def usable(self, density):
+        """
+        :param density: the current air density in kg/m^3
+        :return: the sweeps that are not stale and within density_tolerance of 'density', by ascending density
+        """
+        return [sweep for sweep in self.sweeps if not sweep["stale"]
+                and abs(sweep["density"] - density) <= self.density_tolerance * density]
+
+    def bracket(self, density):
+        """
+        :param density: the current air density in kg/m^3
+        :return: the usable sweeps nearest below and above 'density', one or none if there are fewer
+        """
+        sweeps = self.usable(density)
+        below = [sweep for sweep in sweeps if sweep["density"] <= density]
+        above = [sweep for sweep in sweeps if sweep["density"] > density]
+        return below[-1:] + above[:1]
+
+    def duty_for(self, velocity, density):
+        """
+        :param velocity: the requested velocity in m/s
+        :param density: the current air density in kg/m^3
+        :return: the estimated duty fraction, or None without a usable sweep or above the fastest point swept
+        """
+        bracket = self.bracket(density)
+        estimates = []
+        for sweep in bracket:
+            if velocity > sweep["velocity"][-1]:            # no extrapolating past what the fan was seen to do
+                return None
+            estimates.append(float(np.interp(velocity, sweep["velocity"], sweep["duty"])))
+        if not estimates:
+            return None
+        if len(estimates) == 1:
+            return estimates[0]
+        low, high = bracket[0]["density"], bracket[1]["density"]
+        return estimates[0] + (estimates[1] - estimates[0]) * (density - low) / (high - low)
+
+    def check(self, velocity, duty, density):
+        """
+        Compares the duty a setpoint settled at with the map's estimate and marks the sweeps used stale if they
+        are out by more than drift_tolerance.
+
+        :param velocity: the velocity held in m/s
+        :param duty: the duty fraction it was held at
+        :param density: the current air density in kg/m^3
+        :return: True if the estimate was within drift_tolerance, or there was none
+        """
+        estimate = self.duty_for(velocity, density)
+        if estimate is None or abs(duty - estimate) <= self.drift_tolerance:
+            return True
+        for sweep in self.bracket(density):
+            sweep["stale"] = True
+        self.changed = True
+        return False
+
+    def save(self, filename):
+        """
+        Writes the map to a JSON file, replacing it in one step.
+
+        :param filename: the file to write
+        :return: None
+        """
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"density_tolerance": self.density_tolerance, "drift_tolerance": self.drift_tolerance,
+                       "sweeps": list(self.sweeps)}, file, indent=1)
+        os.replace(temporary, filename)
+        self.changed = False
+
+
+def load_characterization(filename, **kwargs):
+    """
+    Reads a map saved by CharacterizationMap.save, or returns an empty map if the file does not exist
+
+    :param filename: the JSON file
+    :param kwargs: CharacterizationMap options, overriding those saved in the file
+    :return: the CharacterizationMap
+    """
+    if not os.path.exists(filename):
+        return CharacterizationMap(**kwargs)
+    with open(filename) as file:
+        saved = json.load(file)
+    options = {name: saved[name] for name in ("density_tolerance", "drift_tolerance") if name in saved}
+    options.update(kwargs)
+    characterization = CharacterizationMap(**options)
+    characterization.sweeps = saved.get("sweeps", [])
+    return characterization
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the sweeps of a characterization map')
+    parser.add_argument('filename', help='A map written by headless.py characterize steps')
+    parser.add_argument('--density', type=float, default=None,
+                        help='Also show the duty estimated at this density for each whole m/s')
+    parser.add_argument('--clear_stale', action='store_true', help='Remove the stale sweeps from the file')
+    args = parser.parse_args()
+
+    characterization = load_characterization(args.filename)
+    for sweep in characterization.sweeps:
+        print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(sweep['time']))}  "
+              f"density {sweep['density']:.4f} kg/m^3  {len(sweep['duty'])} points  "
+              f"up to {sweep['velocity'][-1]:.2f} m/s{'  stale' if sweep['stale'] else ''}")
+    if args.density is not None:
+        for target in range(1, int(max((sweep["velocity"][-1] for sweep in characterization.sweeps), default=0)) + 1):
+            estimate = characterization.duty_for(target, args.density)
+            print(f"{target:4d} m/s  " + ("-" if estimate is None else f"{estimate * 100:.1f} %"))
+    if args.clear_stale:
+        characterization.sweeps = [sweep for sweep in characterization.sweeps if not sweep["stale"]]
+        characterization.save(args.filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+This module contains the closed-loop velocity controller run by the acquisition worker
+
+...
+The controller turns each differential pressure sample into a velocity using the tare (initDP) and air density found
+by the GUI's calibration, and drives the fan duty cycle towards a velocity setpoint with a simple_pid PID controller.
+It runs on the acquisition thread at the full sample rate rather than on the GUI timer.
+
+    - Anti-windup: simple_pid clamps the integral term to the output limits.
+    - Rate limiting: the duty cycle moves by at most max_rate (fraction of full scale) per second.
+    - Quantization: the command is rounded to 'steps' levels, so small fluctuations do not produce a new <P,...>.
+    - Feed-forward: with a characterization map, a new setpoint jumps straight to the duty the map estimates for it
+      at the current density. The duty is held there while the air speed catches up, until the velocity first
+      enters settle_band of the setpoint or hold_time has passed, and the PID then takes over from it; a PID running
+      during the fan's lag would integrate the transient and overshoot. Once the velocity has stayed within
+      settle_band for settle_time, the settled duty is checked against the estimate, which marks the map's sweeps
+      stale if they no longer fit (see characterization.py).
+
+Classes:
+
+    VelocityController(kp, ki, kd, max_rate, filter_alpha, steps, feed_forward, settle_band, settle_time,
+                       hold_time)
+        PID controller from differential pressure samples to a fan pwm value
+
+"""
+import threading
+from simple_pid import PID
+from physics import velocity
+
+
+class VelocityController:
+    """
+    PID controller from differential pressure samples to a fan pwm value.
+
+    ...
+    density and init_dp are plain attributes the GUI updates when its calibration finishes. Until init_dp is set,
+        or while the setpoint is 0, the controller commands the fan off. The feed-forward estimate is taken when the
+        setpoint is set, so it needs init_dp and density to be in place first.
+    update runs on the acquisition thread while the GUI or a profile sets the setpoint, so both hold a lock and a
+        setpoint change never lands halfway through a PID step.
+    """
+
+    def __init__(self, kp=0.02, ki=0.05, kd=0.0, max_rate=0.5, filter_alpha=0.2, steps=1000, feed_forward=None,
+                 settle_band=0.02, settle_time=3.0, hold_time=10.0):
+        """
+        :param kp: proportional gain, duty fraction per m/s of error
+        :param ki: integral gain, duty fraction per m/s of error per second
+        :param kd: derivative gain, duty fraction per m/s^2
+        :param max_rate: the largest change in duty fraction per second
+        :param filter_alpha: smoothing factor of the exponential filter applied to the differential pressure
+        :param steps: the number of distinct duty levels commanded between off and full
+        :param feed_forward: a characterization.CharacterizationMap to jump to new setpoints with, or None
+        :param settle_band: the relative velocity error within which the velocity counts as settled
+        :param settle_time: seconds the velocity must stay settled before the feed-forward estimate is checked
+        :param hold_time: the longest time in seconds the feed-forward duty is held before the PID takes over
+        """
+        self.pid = PID(kp, ki, kd, setpoint=0, sample_time=None, output_limits=(0, 1))
+        self.max_rate = max_rate
+        self.filter_alpha = filter_alpha
+        self.steps = steps
+        self.density = 1.2                                  # kg/m^3, replaced by the GUI's calibration
+        self.init_dp = None                                 # tare value, set by the GUI's calibration
+        self.duty = 0.0                                     # current duty fraction before quantization
+        self.velocity = 0.0                                 # latest filtered velocity in m/s
+        self.feed_forward = feed_forward
+        self.settle_band = settle_band
+        self.settle_time = settle_time
+        self.hold_time = hold_time
+        self.estimate = None                                # feed-forward duty for the setpoint, until checked
+        self.settled_since = None                           # time the velocity entered the settle band
+        self.hold_until = None                              # end of the feed-forward hold, set by the next update
+        self._dp = None
+        self._last_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def setpoint(self):
+        """
+        :return: the target velocity in m/s
+        """
+        return self.pid.setpoint
+
+    @setpoint.setter
+    def setpoint(self, velocity):
+        with self._lock:
+            if velocity <= 0 < self.pid.setpoint:
+                self.pid.reset()
+            if velocity != self.pid.setpoint:
+                self.settled_since = None
+                self.estimate = None
+                if self.feed_forward is not None and self.init_dp is not None and velocity > 0:
+                    self.estimate = self.feed_forward.duty_for(velocity, self.density)
+                if self.estimate is not None:               # PID off until the air speed has caught up
+                    self.duty = self.estimate
+                    self.pid.set_auto_mode(False)
+                    self.hold_until = None
+                elif not self.pid.auto_mode:                # a new setpoint during a hold, without an estimate
+                    self.pid.set_auto_mode(True, last_output=self.duty)
+            self.pid.setpoint = max(velocity, 0)
+
+    def update(self, now, dp):
+        """
+        Adds one differential pressure sample and returns the pwm value to command.
+
+        ...
+        Samples that share a timestamp (several frames from one read) only update the filter; the PID step runs when
+            time has moved on.
+
+        :param now: the sample time in seconds
+        :param dp: the differential pressure in the same units as init_dp
+        :return: a pwm value between 0 and 65535
+        """
+        with self._lock:
+            self._dp = dp if self._dp is None else self._dp + self.filter_alpha * (dp - self._dp)
+            if self.init_dp is None or self.setpoint <= 0:
+                self.duty = 0.0
+                self._last_time = now
+                return 0
+
+            self.velocity = velocity(self._dp - self.init_dp, self.density)
+            if self._last_time is None:
+                self._last_time = now
+            dt = now - self._last_time
+            if not self.pid.auto_mode:
+                if self.hold_until is None:
+                    self.hold_until = now + self.hold_time
+                if abs(self.velocity - self.setpoint) <= self.settle_band * self.setpoint or now >= self.hold_until:
+                    self.pid.set_auto_mode(True, last_output=self.duty)   # the integral starts at the held duty
+                self._last_time = now
+                return self.pwm()
+            if dt > 0:
+                output = self.pid(self.velocity, dt=dt)
+                step = self.max_rate * dt
+                self.duty = min(max(output, self.duty - step), self.duty + step)
+                self._last_time = now
+                if self.estimate is not None:
+                    self._check_estimate(now)
+            return self.pwm()
+
+    def pwm(self):
+        """
+        :return: the current duty cycle rounded to 'steps' levels, as a pwm value between 0 and 65535
+        """
+        return int(round(self.duty * self.steps) * 65535 / self.steps)
+
+    def _check_estimate(self, now):
+        if abs(self.velocity - self.setpoint) > self.settle_band * self.setpoint:
+            self.settled_since = None
+        elif self.settled_since is None:
+            self.settled_since = now
+        elif now - self.settled_since >= self.settle_time:
+            if not self.feed_forward.check(self.setpoint, self.duty, self.density):
+                print(f"Characterization drifted: {self.setpoint:g} m/s settled at {self.duty * 100:.1f} % "
+                      f"duty, {self.estimate * 100:.1f} % expected. Run a new characterization sweep.")
+            self.estimate = None                            # once per setpoint
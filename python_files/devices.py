@@ -0,0 +1,316 @@
+"""
+This module discovers Adafruit feathers on the USB bus and runs several of them from one process
+
+...
+A feather running feather_backup/code.py enumerates as one USB device with two CDC interfaces: the console, which
+receives commands, and the data channel, which carries the frames. find_feathers lists the serial ports by USB vendor
+and product id and pairs the two interfaces of each board by its serial number.
+
+DeviceManager opens every feather at once, runs one AcquisitionWorker thread per board and merges what they queue
+into one time-ordered array tagged with the device index, which can be written straight to a single Recorder or
+ColumnarRecorder. Each board is drained at the caller's own rate, so N tunnels cost N worker threads plus one
+consumer rather than N GUIs.
+
+Classes:
+
+    FeatherPorts(name, serial_number, console, data)
+        The pair of serial port names belonging to one feather
+
+    DeviceManager(stream_rate, binary, maxlen, **worker_kwargs)
+        Runs one acquisition worker per feather and aggregates their samples
+
+Functions:
+
+    find_feathers(vid, pid)
+        Lists the feathers connected to this computer
+
+    main()
+        Command line runner recording every connected feather to one file with a text dashboard
+
+Usage:
+
+    python python_files/devices.py [--list] [--stream_rate 100] [--binary] [--record_format columnar]
+                                   [--simulate 3]
+
+"""
+import argparse
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import serial
+from serial.tools import list_ports
+from acquisition import AcquisitionWorker
+from recorder import Recorder, ColumnarRecorder, COLUMNAR_EXTENSION, next_filename
+from simulator import open_simulated_ports
+
+ADAFRUIT_VID = 0x239A  # USB vendor id of Adafruit boards, CircuitPython included
+AGGREGATE_FIELDS = ["device", "time", "bmp_pressure", "bmp_temp", "aht_humidity", "aht_temp", "lwlp_pressure",
+                    "lwlp_temp"]
+
+FeatherPorts = namedtuple("FeatherPorts", ["name", "serial_number", "console", "data"])
+
+
+def find_feathers(vid=ADAFRUIT_VID, pid=None):
+    """
+    Lists the feathers connected to this computer
+
+    ...
+    Ports are grouped by USB serial number. Within a board, the interface named "data" (CircuitPython names its
+        interfaces "CircuitPython CDC control" and "CircuitPython CDC2 data") is the data channel; when the operating
+        system does not report interface names, the port with the lower interface number is the console.
+
+    :param vid: the USB vendor id to match
+    :param pid: the USB product id to match, or None for any board from that vendor
+    :return: a list of FeatherPorts sorted by serial number, leaving out boards without both interfaces enabled
+    """
+    boards = {}
+    for port in list_ports.comports():
+        if port.vid != vid or (pid is not None and port.pid != pid):
+            continue
+        boards.setdefault(port.serial_number or port.location or port.device, []).append(port)
+
+    feathers = []
+    for serial_number, ports in sorted(boards.items()):
+        if len(ports) < 2:                                  # usb_cdc.enable(data=True) missing from boot.py
+            continue
+        ports.sort(key=lambda port: (port.location or "", port.device))
+        data = [port for port in ports if "data" in (port.interface or "").lower()]
+        data_port = data[0] if data else ports[1]
+        console_port = next(port for port in ports if port is not data_port)
+        feathers.append(FeatherPorts(f"feather_{serial_number}", serial_number, console_port.device,
+                                     data_port.device))
+    return feathers
+
+
+class DeviceManager:
+    """
+    Runs one acquisition worker per feather and aggregates their samples.
+
+    ...
+    Devices are numbered in the order they are added; the number is the 'device' column of the aggregated rows and
+        the index into 'names' and 'workers'.
+    """
+
+    def __init__(self, stream_rate=None, binary=False, maxlen=10000, **worker_kwargs):
+        """
+        :param stream_rate: samples per second each feather streams, or None to poll
+        :param binary: True to receive binary frames
+        :param maxlen: the most samples each worker holds before dropping the oldest
+        :param worker_kwargs: further AcquisitionWorker options, e.g. averaging or sensor_intervals
+        """
+        self.worker_kwargs = dict(worker_kwargs, stream_rate=stream_rate, binary=binary, maxlen=maxlen)
+        self.names = []
+        self.workers = []
+        self._ports = []
+
+    def add(self, name, console_port, data_port):
+        """
+        Adds a feather whose ports are already open. Its worker starts with start(), or at once if already started.
+
+        :param name: a label for the device
+        :param console_port: the console port object
+        :param data_port: the data port object
+        :return: the device number
+        """
+        worker = AcquisitionWorker(console_port, data_port, **self.worker_kwargs)
+        self.names.append(name)
+        self.workers.append(worker)
+        self._ports.append((console_port, data_port))
+        if any(other.is_alive() for other in self.workers[:-1]):
+            worker.start()
+        return len(self.workers) - 1
+
+    def open(self, feathers, baudrate=115200):
+        """
+        Opens several feathers at once, so one slow port does not hold up the rest.
+
+        ...
+        If any port fails to open, every port that did open is closed again before the error is raised, so a retry
+            does not find them busy.
+
+        :param feathers: a list of FeatherPorts, e.g. from find_feathers()
+        :param baudrate: the serial baud rate (ignored by USB CDC, kept for pyserial)
+        :return: the list of device numbers
+        """
+        def open_ports(feather):
+            console_port = serial.Serial(feather.console, baudrate)
+            try:
+                return console_port, serial.Serial(feather.data, baudrate)
+            except Exception:
+                console_port.close()
+                raise
+
+        with ThreadPoolExecutor(max_workers=max(len(feathers), 1)) as executor:
+            futures = [executor.submit(open_ports, feather) for feather in feathers]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            for future in futures:
+                if future.exception() is None:
+                    for port in future.result():
+                        port.close()
+            raise errors[0]
+        return [self.add(feather.name, *future.result()) for feather, future in zip(feathers, futures)]
+
+    def discover(self, vid=ADAFRUIT_VID, pid=None):
+        """
+        Finds and opens every connected feather.
+
+        :param vid: the USB vendor id to match
+        :param pid: the USB product id to match, or None for any
+        :return: the list of device numbers
+        """
+        return self.open(find_feathers(vid, pid))
+
+    def add_simulated(self, count, **kwargs):
+        """
+        Adds simulated feathers, for running the manager without hardware.
+
+        :param count: the number of feathers
+        :param kwargs: passed to open_simulated_ports
+        :return: the list of device numbers
+        """
+        return [self.add(f"simulated_{index}", *open_simulated_ports(**kwargs)) for index in range(count)]
+
+    def start(self):
+        """
+        Starts every worker not already running.
+
+        :return: None
+        """
+        for worker in self.workers:
+            if worker.ident is None:
+                worker.start()
+
+    def set_pwm(self, device, pwm_val):
+        """
+        :param device: the device number
+        :param pwm_val: a value between 0 and 65535
+        :return: None
+        """
+        self.workers[device].set_pwm(pwm_val)
+
+    def drain(self):
+        """
+        Removes every queued sample from every worker and merges them in time order.
+
+        ...
+        Rows are ordered within one call; a device with a slower link can still deliver rows older than the last
+            row of the previous call.
+
+        :return: an array of shape (n, 8) with rows in the form of AGGREGATE_FIELDS:
+            [device, time, bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+        """
+        batches = []
+        for device, worker in enumerate(self.workers):
+            queued = worker.drain()
+            if queued:
+                batch = np.empty((len(queued), len(AGGREGATE_FIELDS)))
+                batch[:, 0] = device
+                batch[:, 1] = [sample_time for sample_time, sample in queued]
+                batch[:, 2:] = [sample for sample_time, sample in queued]
+                batches.append(batch)
+        if not batches:
+            return np.empty((0, len(AGGREGATE_FIELDS)))
+        rows = np.concatenate(batches)
+        return rows[np.argsort(rows[:, 1], kind="stable")]
+
+    def status(self):
+        """
+        :return: a list with one dict per device holding its name, received, lost and dropped frame counts and error
+        """
+        return [{
+            "name": name,
+            "received": worker.sequence.received,
+            "lost": worker.lost,
+            "dropped": worker.dropped,
+            "error": worker.error,
+        } for name, worker in zip(self.names, self.workers)]
+
+    def stop(self, timeout=1.0):
+        """
+        Turns every fan off, stops the workers and closes the ports.
+
+        :param timeout: seconds to wait for each worker
+        :return: None
+        """
+        for worker in self.workers:
+            worker.set_pwm(0)
+            worker.stop(0)                                  # ask them all to stop first, then wait for each
+        for worker, (console_port, data_port) in zip(self.workers, self._ports):
+            worker.stop(timeout)
+            console_port.close()
+            data_port.close()
+            if hasattr(console_port, "feather"):
+                console_port.feather.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record every connected feather to one file')
+    parser.add_argument('--list', action='store_true', help='List the connected feathers and exit')
+    parser.add_argument('--pid', type=lambda value: int(value, 0), default=None, help='USB product id to match')
+    parser.add_argument('--stream_rate', type=float, default=None,
+                        help='Stream samples at this rate in Hz (0 = as fast as possible) instead of polling')
+    parser.add_argument('--binary', action='store_true', help='Use crc-checked binary frames')
+    parser.add_argument('--record_format', choices=['csv', 'columnar'], default='csv',
+                        help='Record to csv or to a directory of memory-mappable binary columns')
+    parser.add_argument('--output_folder', default='data_output', help='Folder for the recording')
+    parser.add_argument('--simulate', type=int, default=0, help='Run this many simulated feathers instead')
+    args = parser.parse_args()
+
+    if args.list:
+        feathers = find_feathers(pid=args.pid)
+        for feather in feathers:
+            print(f"{feather.name}: console {feather.console}, data {feather.data}")
+        if not feathers:
+            print("No feathers found")
+        return
+
+    manager = DeviceManager(stream_rate=args.stream_rate, binary=args.binary)
+    if args.simulate:
+        manager.add_simulated(args.simulate)
+    else:
+        manager.discover(pid=args.pid)
+    if not manager.workers:
+        print("No feathers found")
+        return
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    if args.record_format == "columnar":
+        filename = next_filename(args.output_folder, extension=COLUMNAR_EXTENSION)
+        recorder = ColumnarRecorder(filename, AGGREGATE_FIELDS, dtypes={"device": "<u2"},
+                                    metadata={"devices": manager.names, "stream_rate": args.stream_rate})
+    else:
+        recorder = Recorder(next_filename(args.output_folder), AGGREGATE_FIELDS)
+    recorder.start()
+    manager.start()
+    print(f"Recording {len(manager.workers)} feathers to {recorder.filename}, Ctrl+C to stop")
+
+    try:
+        last_status = time.monotonic()
+        counts = np.zeros(len(manager.workers), dtype=int)
+        while True:
+            time.sleep(0.2)
+            rows = manager.drain()
+            if len(rows):
+                recorder.write_rows(rows)
+                counts += np.bincount(rows[:, 0].astype(int), minlength=len(counts))
+            if time.monotonic() - last_status >= 1.0:       # one dashboard line per device each second
+                elapsed = time.monotonic() - last_status
+                for device, status in enumerate(manager.status()):
+                    print(f"{status['name']:>24}: {counts[device] / elapsed:8.1f} samples/s, lost {status['lost']}, "
+                          f"dropped {status['dropped']}" + (f", error {status['error']!r}" if status['error'] else ""))
+                counts[:] = 0
+                last_status = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+        recorder.write_rows(manager.drain())
+        recorder.close()
+        print(f"Data saved to: {recorder.filename}")
+
+
+if __name__ == '__main__':
+    main()
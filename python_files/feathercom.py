@@ -7,10 +7,94 @@ Functions:
     send_pwm(console_port, pwm_val)
         Sends a command to the feather telling it to send a pwm signal to the fan
 
+    send_commands(console_port, commands)
+        Sends several commands to the feather in one batched frame and one write
+
     request_data(console_port, data_port, num_samples)
         Sends a command to the feather requesting lists containing all relevant sensor data
 
+    parse_frames(buffer, num_fields)
+        Parses every complete ascii frame in a byte buffer at once into a NumPy array
+
+    request_data_array(console_port, data_port, num_samples, num_fields, pwm_val)
+        Bulk equivalent of request_data, returning a NumPy array of shape (num_samples, num_fields)
+
+    start_stream(console_port, rate_hz)
+        Sends a command to the feather telling it to send samples continuously until stopped
+
+    stop_stream(console_port)
+        Sends a command to the feather telling it to stop streaming samples
+
+    stream_data(data_port)
+        Generator yielding each streamed sample as it arrives
+
+    set_binary(console_port, enabled)
+        Sends a command to the feather selecting binary or ascii frames
+
+    set_frame_format(console_port, frame_format)
+        Sends a command to the feather selecting ascii, binary or extended ascii frames
+
+    extended_to_records(data)
+        Converts parsed extended ascii frames into the same record array as decode_frames
+
+    set_averaging(console_port, lwlp_reads, ambient_reads)
+        Sends a command to the feather setting how many sensor reads are averaged into each sample
+
+    set_sensor_intervals(console_port, bmp_ms, aht_ms)
+        Sends a command to the feather setting how often the slow ambient sensors are read
+
+    decode_frames(buffer)
+        Decodes every complete binary frame in a byte buffer at once
+
+    request_binary_data(console_port, data_port, num_samples, pwm_val)
+        Binary equivalent of request_data, returning a NumPy record array
+
+    stream_binary_data(data_port)
+        Binary equivalent of stream_data, yielding record arrays of every frame received per read
+
+    decode_extended_frames(buffer)
+        Extended ascii equivalent of decode_frames, skipping malformed frames
+
+Classes:
+
+    FeatherClient(console_port, data_port, binary, timeout, poll_interval)
+        asyncio client with awaitable, pipelined requests and an async stream iterator
+
 """
+import asyncio
+import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import METRICS
+from timing import counter_step
+
+NUM_FIELDS = 6  # [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+EXTENDED_FIELDS = NUM_FIELDS + 5  # plus sequence, device time in ms, lwlp read count, bmp age and aht age in ms
+
+ASCII_FORMAT = 0  # <six values>, as the original firmware sent
+BINARY_FORMAT = 1  # crc-checked frames of BINARY_DTYPE
+EXTENDED_FORMAT = 2  # <EXTENDED_FIELDS values>, the fields of BINARY_DTYPE in the same order
+ASCII_FRAME = re.compile(rb"<([^<>]*)>")
+
+BINARY_SYNC = b"\xa5\x5a"  # marks the start of every binary frame
+BINARY_DTYPE = np.dtype([
+    ("sync", "S2"),
+    ("values", "<f4", (6,)),  # [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+    ("sequence", "<u4"),
+    ("device_ms", "<u4"),
+    ("count", "<u4"),  # lwlp reads averaged into the values
+    ("age_ms", "<u2", (2,)),  # age of the cached [bmp, aht] values
+    ("crc", "<u4"),  # crc32 of everything after the sync
+])
+BINARY_FRAME_SIZE = BINARY_DTYPE.itemsize
+
+# timed only while METRICS.enabled
+REQUEST_SECONDS = METRICS.histogram("feather_request_seconds", "Round trip of a <D,n> data request")
+PARSE_SECONDS = METRICS.histogram("feather_parse_seconds", "Time to parse one read's worth of frames")
+BAD_FRAMES = METRICS.counter("feather_bad_frames_total", "Frames dropped for a bad crc or malformed fields")
 
 
 def send_pwm(console_port, pwm_val):
@@ -29,6 +113,32 @@ def send_pwm(console_port, pwm_val):
     # print("Sending pwm value", pwm_val)
 
 
+def send_commands(console_port, commands):
+    """
+    Sends several commands to the feather in one batched frame and one write
+
+    ...
+    The frame is of the form <TYPE,VALUE;TYPE,VALUE;...>, e.g. <P,30000;D,1>, and the feather carries the commands out
+        in order. One write saves a USB round of the host's serial stack per command, and the commands cannot be split
+        by another thread's write.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param commands: a sequence of commands, each a sequence of its type and values, e.g. [("P", 30000), ("D", 1)]
+    :return: None
+    """
+    console_port.write(_command_frame(commands))
+
+
+def _command_frame(commands):
+    return bytes("<" + ";".join(",".join(str(part) for part in command) for command in commands) + ">", "ascii")
+
+
+def _data_request(num_samples, pwm_val):
+    if pwm_val is None:
+        return bytes(f"<D,{num_samples}>", "ascii")
+    return bytes(f"<P,{pwm_val};D,{num_samples}>", "ascii")           # duty first, so the samples see it
+
+
 def request_data(console_port, data_port, num_samples):
     """
     Sends a command to the feather requesting 'num_samples' lists containing all relevant sensor data.
@@ -68,3 +178,583 @@ def request_data(console_port, data_port, num_samples):
         data.append(sample)  # add each sensor readings sample to the complete list
 
     return data
+
+
+def parse_frames(buffer, num_fields=NUM_FIELDS):
+    """
+    Parses every complete ascii frame in a byte buffer at once into a NumPy array
+
+    ...
+    The frame contents are found with a single regular expression pass, joined into one comma separated string and
+        converted by NumPy in one call, so there is no per-byte or per-value Python loop. Bytes outside <...> are
+        ignored. The batch is only used when every frame has exactly num_fields - 1 commas, as a short frame and a
+        long one would otherwise add up to the right total. Otherwise, or if the batch does not convert cleanly, the
+        frames are converted one by one instead and those without exactly num_fields numbers are dropped and counted
+        as bad, as in decode_extended_frames.
+
+    :param buffer: bytes received from the data port
+    :param num_fields: values per frame, EXTENDED_FIELDS for extended ascii frames
+    :return: (data, rest, bad) where data is a float array of shape (n, num_fields), rest is the bytes after the
+        last complete frame (the start of a partial frame, if any) and bad is the number of malformed frames
+    """
+    timer = time.perf_counter() if METRICS.enabled else None
+    end = buffer.rfind(b">") + 1
+    frames = ASCII_FRAME.findall(buffer, 0, end)
+    if not frames:
+        return np.empty((0, num_fields)), buffer[end:], 0
+    bad = 0
+    data = None
+    if all(frame.count(b",") == num_fields - 1 for frame in frames):
+        try:
+            data = np.fromstring(b",".join(frames).decode("ascii"), dtype=float, sep=",")
+        except ValueError:                                  # text numpy cannot convert at all
+            pass
+    if data is None or data.size != len(frames) * num_fields:
+        rows = []
+        for frame in frames:                                # the slow path finds the malformed frames
+            try:
+                row = [float(value) for value in frame.split(b",")]
+            except ValueError:
+                row = ()
+            if len(row) == num_fields:
+                rows.append(row)
+            else:
+                bad += 1
+        data = np.array(rows, dtype=float).reshape(-1, num_fields)
+    if timer is not None:
+        PARSE_SECONDS.observe(time.perf_counter() - timer)
+        BAD_FRAMES.inc(bad)
+    return data.reshape(-1, num_fields), buffer[end:], bad
+
+
+def request_data_array(console_port, data_port, num_samples, num_fields=NUM_FIELDS, pwm_val=None):
+    """
+    Bulk equivalent of request_data, returning a NumPy array of shape (num_samples, num_fields)
+
+    ...
+    The whole reply is read into one buffer, using in_waiting sized reads, until it holds 'num_samples' complete
+        <...> frames. A '>' without its '<', e.g. left over from an earlier reply, does not count as a frame. The
+        buffer is then parsed in one pass by parse_frames, and malformed frames are dropped, so fewer than
+        'num_samples' rows may be returned. With a read timeout set on data_port, the frames that have arrived are
+        returned as soon as a read times out.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+    :param num_samples: the number of samples requested
+    :param num_fields: values per frame, EXTENDED_FIELDS for extended ascii frames
+    :param pwm_val: a pwm value sent in the same write as the request and set before sampling, or None
+    :return: a float array of shape (num_samples, num_fields) where each row is of the form:
+                [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+             followed by [sequence, device ms, lwlp read count, bmp age, aht age] for extended frames
+    """
+    start = time.perf_counter() if METRICS.enabled else None
+    console_port.write(_data_request(num_samples, pwm_val))
+    buffer = b""
+    frames_ended = 0
+    while frames_ended < num_samples:
+        chunk = data_port.read(data_port.in_waiting or 1)  # block for at least one byte
+        if not chunk:                                       # the read timed out
+            break
+        buffer += chunk
+        if b">" in chunk:
+            frames_ended = len(ASCII_FRAME.findall(buffer))
+    data, rest, bad = parse_frames(buffer, num_fields)
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start)
+    return data
+
+
+def start_stream(console_port, rate_hz):
+    """
+    Sends a command to the feather telling it to send samples continuously until stopped
+
+    ...
+    The command is of the form <S, RATE>. The feather then writes one sample at a time to its data port, in the same
+        <a,b,c,...> form used by request_data, without waiting for further requests.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param rate_hz: the number of samples per second to stream. 0 streams as fast as the sensors allow
+    :return: None
+    """
+    console_port.write(bytes(f"<S,{rate_hz}>", "ascii"))
+
+
+def stop_stream(console_port):
+    """
+    Sends a command to the feather telling it to stop streaming samples
+
+    ...
+    Samples already in flight will still arrive. Call data_port.reset_input_buffer() afterwards before switching
+        back to request_data.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :return: None
+    """
+    console_port.write(bytes("<X>", "ascii"))
+
+
+def stream_data(data_port):
+    """
+    Generator yielding each streamed sample as it arrives
+
+    ...
+    Reads whatever is waiting on the port in one call instead of one byte at a time, and splits complete frames on
+        '>'. Partial frames are kept until the rest arrives and any bytes before a '<' are discarded. With a read
+        timeout set on data_port, an empty list is yielded whenever a read times out, so the caller can stop waiting.
+
+    :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+    :return: yields lists of the form [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+    """
+    buffer = b""
+    while True:
+        chunk = data_port.read(data_port.in_waiting or 1)  # block for at least one byte
+        if not chunk:                                       # the read timed out
+            yield []
+            continue
+        buffer += chunk
+        start = time.perf_counter() if METRICS.enabled else None
+        *frames, buffer = buffer.split(b">")
+        samples = [frame[frame.rfind(b"<") + 1:].decode("ascii").split(",") for frame in frames if b"<" in frame]
+        if start is not None:
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+        yield from samples
+
+
+def set_binary(console_port, enabled):
+    """
+    Sends a command to the feather selecting binary or ascii frames
+
+    ...
+    The command is of the form <F, VALUE> where VALUE is 1 for binary frames and 0 for the original ascii frames. The
+        format applies to both request_data/request_binary_data and streaming.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param enabled: True for binary frames, False for ascii
+    :return: None
+    """
+    set_frame_format(console_port, BINARY_FORMAT if enabled else ASCII_FORMAT)
+
+
+def set_frame_format(console_port, frame_format):
+    """
+    Sends a command to the feather selecting ascii, binary or extended ascii frames
+
+    ...
+    Extended ascii frames carry everything a binary frame does, the sequence number and device time included, so
+        lost frames and sample times can be recovered without switching to binary.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param frame_format: ASCII_FORMAT, BINARY_FORMAT or EXTENDED_FORMAT
+    :return: None
+    """
+    console_port.write(bytes(f"<F,{int(frame_format)}>", "ascii"))
+
+
+def extended_to_records(data):
+    """
+    Converts parsed extended ascii frames into the same record array as decode_frames
+
+    :param data: a float array of shape (n, EXTENDED_FIELDS), e.g. from parse_frames(buffer, EXTENDED_FIELDS)
+    :return: a record array of BINARY_DTYPE with empty sync and crc fields
+    """
+    data = np.asarray(data, dtype=float).reshape(-1, EXTENDED_FIELDS)
+    frames = np.zeros(len(data), dtype=BINARY_DTYPE)
+    frames["values"] = data[:, :NUM_FIELDS]
+    frames["sequence"] = data[:, NUM_FIELDS]
+    frames["device_ms"] = data[:, NUM_FIELDS + 1]
+    frames["count"] = data[:, NUM_FIELDS + 2]
+    frames["age_ms"] = data[:, NUM_FIELDS + 3:]
+    return frames
+
+
+def decode_frames(buffer):
+    """
+    Decodes every complete binary frame in a byte buffer at once
+
+    ...
+    Frames are located by their sync bytes and checked against their crc32. Frames failing the check are skipped and
+        the search resumes one byte later, so the decoder resynchronizes after garbage. Valid frames are joined and
+        converted with a single np.frombuffer call.
+
+    :param buffer: bytes received from the data port
+    :return: (frames, rest, bad) where frames is a record array of BINARY_DTYPE, rest is the unconsumed tail of the
+        buffer (a partial frame) and bad is the number of frames that failed the crc check
+    """
+    timer = time.perf_counter() if METRICS.enabled else None
+    frames = []
+    bad = 0
+    position = 0
+    while True:
+        start = buffer.find(BINARY_SYNC, position)
+        if start == -1:
+            rest = buffer[-1:] if buffer.endswith(BINARY_SYNC[:1]) else b""  # sync may be split across reads
+            break
+        end = start + BINARY_FRAME_SIZE
+        if end > len(buffer):
+            rest = buffer[start:]
+            break
+        frame = buffer[start:end]
+        if zlib.crc32(frame[2:-4]) == int.from_bytes(frame[-4:], "little"):
+            frames.append(frame)
+            position = end
+        else:
+            bad += 1
+            position = start + 1
+    frames = np.frombuffer(b"".join(frames), dtype=BINARY_DTYPE)
+    if timer is not None:
+        PARSE_SECONDS.observe(time.perf_counter() - timer)
+        BAD_FRAMES.inc(bad)
+    return frames, rest, bad
+
+
+def request_binary_data(console_port, data_port, num_samples, pwm_val=None):
+    """
+    Binary equivalent of request_data, returning a NumPy record array
+
+    ...
+    The feather must already be in binary mode (see set_binary). Frames failing the crc check are dropped, so fewer
+        than 'num_samples' records may be returned.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+    :param num_samples: the number of frames requested
+    :param pwm_val: a pwm value sent in the same write as the request and set before sampling, or None
+    :return: a record array of BINARY_DTYPE. frames["values"] is a float32 array of shape (n, 6)
+    """
+    start = time.perf_counter() if METRICS.enabled else None
+    console_port.write(_data_request(num_samples, pwm_val))
+    frames, rest, bad = decode_frames(data_port.read(num_samples * BINARY_FRAME_SIZE))
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start)
+    return frames
+
+
+def stream_binary_data(data_port):
+    """
+    Binary equivalent of stream_data, yielding record arrays of every frame received per read
+
+    :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+    :return: yields record arrays of BINARY_DTYPE, one per read, each holding one or more frames, or none when a
+        read timed out
+    """
+    buffer = b""
+    while True:
+        chunk = data_port.read(data_port.in_waiting or BINARY_FRAME_SIZE)
+        buffer += chunk
+        frames, buffer, bad = decode_frames(buffer)
+        if len(frames) or not chunk:
+            yield frames
+
+
+def set_averaging(console_port, lwlp_reads, ambient_reads=1):
+    """
+    Sends a command to the feather setting how many sensor reads are averaged into each sample
+
+    ...
+    The command is of the form <A, LWLP_READS, AMBIENT_READS>. Each sample then carries the mean of LWLP_READS
+        differential pressure reads; the feather keeps reading the lwlp between samples and commands, and averages the
+        latest LWLP_READS reads since the previous sample or pwm change. The bmp and aht values are the mean of
+        AMBIENT_READS reads. Binary and extended ascii frames report the number of lwlp reads averaged in their 'count'
+        field.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param lwlp_reads: the number of lwlp reads per sample, 1 to turn averaging off
+    :param ambient_reads: the number of bmp and aht reads per sample
+    :return: None
+    """
+    console_port.write(bytes(f"<A,{int(lwlp_reads)},{int(ambient_reads)}>", "ascii"))
+
+
+def set_sensor_intervals(console_port, bmp_ms, aht_ms):
+    """
+    Sends a command to the feather setting how often the slow ambient sensors are read
+
+    ...
+    The command is of the form <I, BMP_MS, AHT_MS>. Each sample then reuses the cached bmp and aht values until they
+        are older than their interval, so most samples only wait for the lwlp. The feather reads the ambient sensors
+        between samples and commands when they fall due. An interval of 0 reads that sensor for every sample, the
+        default. Binary and extended ascii frames report the age in ms of the bmp and aht values in their 'age_ms'
+        field.
+
+    :param console_port: the port of the pc to send the command. Should be a serial port object using pyserial
+    :param bmp_ms: the time between bmp pressure and temperature reads in ms
+    :param aht_ms: the time between aht humidity and temperature reads in ms
+    :return: None
+    """
+    console_port.write(bytes(f"<I,{int(bmp_ms)},{int(aht_ms)}>", "ascii"))
+
+
+def decode_extended_frames(buffer):
+    """
+    Extended ascii equivalent of decode_frames, skipping malformed frames
+
+    ...
+    Bytes outside <...> are ignored, and frames without exactly EXTENDED_FIELDS numbers are counted as bad rather
+        than raising, so the decoder resynchronizes at the next '<' after garbage.
+
+    :param buffer: bytes received from the data port
+    :return: (frames, rest, bad) where frames is a record array of BINARY_DTYPE, rest is the unconsumed tail of the
+        buffer (a partial frame) and bad is the number of malformed frames
+    """
+    timer = time.perf_counter() if METRICS.enabled else None
+    end = buffer.rfind(b">") + 1
+    rows = []
+    bad = 0
+    for frame in ASCII_FRAME.findall(buffer, 0, end):
+        try:
+            row = [float(value) for value in frame.split(b",")]
+        except ValueError:
+            row = ()
+        if len(row) == EXTENDED_FIELDS:
+            rows.append(row)
+        else:
+            bad += 1
+    rest = buffer[end:]
+    start = rest.rfind(b"<")
+    rest = rest[start:] if start != -1 else b""             # anything before the last '<' can never complete a frame
+    frames = extended_to_records(rows)
+    if timer is not None:
+        PARSE_SECONDS.observe(time.perf_counter() - timer)
+        BAD_FRAMES.inc(bad)
+    return frames, rest, bad
+
+
+class FeatherClient:
+    """
+    asyncio client with awaitable, pipelined requests and an async stream iterator.
+
+    ...
+    Blocking pyserial calls run on two single-thread executors, one reading the data port and one writing commands,
+        so the event loop never waits on the link and commands go out in the order they were awaited.
+
+    Requests are pipelined: request_data writes <D,n> straight away and any number can be in flight. The feather
+        answers commands in order, so incoming frames are handed to the oldest unfinished request. Every frame
+        carries a sequence number, and a gap in the sequence (a frame lost or failing its crc) is charged to the
+        requests waiting for it, so one lost frame cannot shift the replies of later requests. A request that times
+        out stays queued until its frames arrive or are known lost, for the same reason.
+
+    The client needs binary or extended ascii frames and switches the feather to one of them when opened.
+
+    Leaving an 'async for' over stream() does not close the iterator, so a stream is ended with stop_stream(). It
+        sends <X> and drops the frames still in flight until the link has been quiet for a moment, so they are not
+        taken for the reply to the next request.
+
+    Usage:
+
+        async with FeatherClient(console_port, data_port) as client:
+            await client.set_pwm(30000)
+            frames = await client.request_data(10)
+            async for frames in client.stream(100):
+                ...
+                break
+            await client.stop_stream()
+    """
+
+    def __init__(self, console_port, data_port, binary=False, timeout=1.0, poll_interval=0.05):
+        """
+        :param console_port: the port of the pc to send commands. Should be a serial port object using pyserial
+        :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+        :param binary: True for binary frames, False for extended ascii
+        :param timeout: the default seconds to wait for a reply, or for the next frame while streaming
+        :param poll_interval: the data port read timeout, which bounds how long close() waits for the reader
+        """
+        self.console_port = console_port
+        self.data_port = data_port
+        self.binary = binary
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.lost = 0                                       # frames missing from the sequence
+        self.bad = 0                                        # frames skipped as corrupt or malformed
+        self.unexpected = 0                                 # frames no request was waiting for
+        self.flushed = 0                                    # streamed frames dropped after stop_stream
+        self.error = None                                   # exception that stopped the reader, if any
+        self._pending = deque()                             # [future, frames still expected, frames received]
+        self._stream_queue = None
+        self._draining = False                              # between <X> and the end of the frames in flight
+        self._last_frame_time = None                        # loop.time() of the latest frames delivered
+        self._last_sequence = None
+        self._reader = None
+        self._read_executor = None
+        self._write_executor = None
+        self._closing = False
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+        Selects the frame format and starts reading the data port.
+
+        :return: None
+        """
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feather-read")
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feather-write")
+        self.data_port.timeout = self.poll_interval           # lets the reader notice close()
+        self._closing = False
+        await self._write(f"<F,{BINARY_FORMAT if self.binary else EXTENDED_FORMAT}>")
+        self._reader = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def close(self):
+        """
+        Stops the reader and fails any request still waiting. The ports are left open.
+
+        :return: None
+        """
+        self._closing = True
+        if self._reader is not None:
+            await self._reader
+            self._reader = None
+        self._fail_pending(ConnectionError("client closed"))
+        for executor in (self._read_executor, self._write_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    async def request_data(self, num_samples=1, timeout=None):
+        """
+        Requests samples and waits for them.
+
+        :param num_samples: the number of samples requested
+        :param timeout: seconds to wait, or None for the client's default
+        :return: a record array of BINARY_DTYPE, shorter than num_samples if frames were lost
+        :raises asyncio.TimeoutError: if the frames have neither arrived nor been found lost in time
+        """
+        if self._stream_queue is not None or self._draining:
+            raise RuntimeError("cannot request data while streaming, await stop_stream() first")
+        if self.error is not None:
+            raise ConnectionError("reader stopped") from self.error
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())  # a timed out caller is gone
+        self._pending.append([future, num_samples, []])
+        start = time.perf_counter() if METRICS.enabled else None
+        await self._write(f"<D,{num_samples}>")
+        frames = await asyncio.wait_for(asyncio.shield(future), self.timeout if timeout is None else timeout)
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start)
+        return frames
+
+    async def set_pwm(self, pwm_val):
+        """
+        :param pwm_val: a value between 0 and 65535 corresponding to the duty cycle of the fan
+        :return: None
+        """
+        await self._write(f"<P,{int(pwm_val)}>")
+
+    async def stream(self, rate_hz=0, timeout=None):
+        """
+        Streams samples until stop_stream() is awaited or the iterator is closed.
+
+        :param rate_hz: samples per second, 0 for as fast as possible
+        :param timeout: the longest gap between frames in seconds, or None for the client's default
+        :return: an async iterator of record arrays of BINARY_DTYPE, one per read of the data port
+        :raises asyncio.TimeoutError: if no frame arrives for 'timeout' seconds
+        """
+        if self._pending or self._stream_queue is not None or self._draining:
+            raise RuntimeError("cannot stream while requests are in flight or another stream is running")
+        queue = self._stream_queue = asyncio.Queue()
+        await self._write(f"<S,{rate_hz}>")
+        try:
+            while self._stream_queue is queue:
+                if self.error is not None:
+                    raise ConnectionError("reader stopped") from self.error
+                yield await asyncio.wait_for(queue.get(), self.timeout if timeout is None else timeout)
+        finally:
+            if self._stream_queue is queue:                 # closed without stop_stream()
+                await self.stop_stream()
+
+    async def stop_stream(self, quiet=None):
+        """
+        Ends a stream and waits for the frames still in flight, which are dropped and counted in 'flushed'.
+
+        ...
+        The feather does not acknowledge <X>, so the stream counts as stopped once no frame has arrived for 'quiet'
+            seconds. Sequence numbers are still tracked meanwhile, so losses are counted across the stop.
+
+        :param quiet: seconds without frames that end the stop, or None for twice poll_interval (at least 0.1 s)
+        :return: None
+        """
+        if self._stream_queue is None:
+            return
+        self._stream_queue = None
+        self._draining = True
+        loop = asyncio.get_running_loop()
+        quiet = max(2 * self.poll_interval, 0.1) if quiet is None else quiet
+        try:
+            await self._write("<X>")
+            self._last_frame_time = loop.time()
+            while loop.time() - self._last_frame_time < quiet and self.error is None and not self._closing:
+                await asyncio.sleep(quiet / 4)
+        finally:
+            self._draining = False
+
+    async def _write(self, command):
+        await asyncio.get_running_loop().run_in_executor(self._write_executor, self.console_port.write,
+                                                         bytes(command, "ascii"))
+
+    def _read_chunk(self):
+        return self.data_port.read(self.data_port.in_waiting or 1)
+
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        decode = decode_frames if self.binary else decode_extended_frames
+        buffer = b""
+        try:
+            while not self._closing:
+                data = await loop.run_in_executor(self._read_executor, self._read_chunk)
+                if not data:
+                    continue
+                frames, buffer, bad = decode(buffer + data)
+                self.bad += bad
+                if len(frames):
+                    self._deliver(frames)
+        except Exception as error:                          # keep the failure visible to callers
+            self.error = error
+            self._fail_pending(error)
+
+    def _deliver(self, frames):
+        self._last_frame_time = asyncio.get_running_loop().time()
+        for index, sequence in enumerate(frames["sequence"].tolist()):
+            if self._last_sequence is not None:
+                step = counter_step(sequence, self._last_sequence)
+                if step > 1:
+                    self.lost += step - 1
+                    self._skip(step - 1)
+            self._last_sequence = sequence
+            if self._draining:
+                self.flushed += 1
+                continue
+            if self._stream_queue is not None:
+                continue
+            if not self._pending:
+                self.unexpected += 1
+                continue
+            request = self._pending[0]
+            request[2].append(frames[index:index + 1])
+            request[1] -= 1
+            if request[1] <= 0:
+                self._finish(self._pending.popleft())
+        if self._stream_queue is not None:
+            self._stream_queue.put_nowait(frames)
+
+    def _skip(self, count):
+        while count and self._pending:
+            request = self._pending[0]
+            taken = min(count, request[1])
+            request[1] -= taken
+            count -= taken
+            if request[1] <= 0:
+                self._finish(self._pending.popleft())
+
+    def _finish(self, request):
+        future, remaining, received = request
+        if not future.done():
+            future.set_result(np.concatenate(received) if received else np.empty(0, dtype=BINARY_DTYPE))
+
+    def _fail_pending(self, error):
+        while self._pending:
+            future = self._pending.popleft()[0]
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,489 @@
+"""
+This module runs scripted test profiles against the acquisition pipeline without Qt
+
+...
+A profile is a JSON file listing the steps of a run. The runner expands it into segments, drives the fan through
+them from the acquisition worker and records every sample at the full acquisition rate, with the segment and
+setpoint it was taken under. Nothing is drawn, so the host's time goes to acquisition and recording, and runs can be
+chained from a script for overnight sweeps.
+
+Profile format:
+
+    {
+        "name": "duty sweep",
+        "repeat": 1,                                            optional, runs the steps this many times
+        "steps": [
+            {"type": "tare", "settle": 5, "duration": 10},      fan off, wait 'settle' s, then average the diff.
+                                                                pressure for up to 'duration' s (or "samples",
+                                                                "sem" to finish early)
+            {"type": "step", "mode": "duty", "value": 30, "dwell": 20},
+            {"type": "ramp", "mode": "duty", "from": 30, "to": 80, "duration": 60},
+            {"type": "sweep", "mode": "duty", "from": 10, "to": 100, "step": 10, "dwell": 15},
+            {"type": "characterize", "from": 10, "to": 100, "step": 10, "settle": 8, "duration": 4},
+                                                                duty sweep averaging the velocity for 'duration' s
+                                                                after 'settle' s at each level, saved to the
+                                                                characterization map
+            {"type": "step", "mode": "velocity", "value": 8, "dwell": 30},
+            {"type": "dwell", "duration": 10}                   holds the previous setpoint
+        ]
+    }
+
+Duty values are in percent and velocities in m/s. Velocity steps and ramps are held by a VelocityController, so a
+tare must come before the first of them. Ambient conditions are averaged over the first 5 s of the run, as in the GUI.
+
+A characterize step also needs a tare first. When it finishes, its settled velocities are added to the
+characterization map (--characterization) at the density measured during the sweep and the map is saved. Velocity
+segments then start at the duty the map estimates, see characterization.py.
+
+Classes:
+
+    ProfileRunner(profile, console_port, data_port, output_folder, record_format, compress, pid_gains,
+                  humidity_correction, characterization, characterization_file, **worker_kwargs)
+        Executes an expanded profile and records the run
+
+Functions:
+
+    load_profile(filename)
+        Reads a profile from a JSON file
+
+    expand_profile(profile)
+        Turns a profile's steps into a flat list of segments and checks them
+
+    main()
+        Command line entry point
+
+Usage:
+
+    python python_files/headless.py profile.json [--simulate] [--stream_rate 0] [--binary]
+                                    [--record_format columnar] [--characterization map.json] [--dry_run]
+
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+import serial
+from acquisition import AcquisitionWorker
+from calibration import CalibrationJob
+from capture import CapturePort, CAPTURE_EXTENSION
+from characterization import load_characterization
+from control import VelocityController
+from metrics import METRICS, MetricsServer
+from physics import density, dynamic_pressure, velocity
+from recorder import Recorder, ColumnarRecorder, COLUMNAR_EXTENSION, next_filename
+from simulator import open_simulated_ports
+
+FIELDNAMES = ["time", "segment", "setpoint", "duty", "velocity", "diff_pressure", "pressure", "temp", "humidity",
+              "density"]
+MODES = ("duty", "velocity")
+
+
+def load_profile(filename):
+    """
+    Reads a profile from a JSON file
+
+    :param filename: the profile file
+    :return: the profile as a dict
+    """
+    with open(filename) as file:
+        return json.load(file)
+
+
+def expand_profile(profile):
+    """
+    Turns a profile's steps into a flat list of segments and checks them
+
+    ...
+    Each segment is a dict with 'type' ('hold', 'ramp', 'tare' or 'point'), 'mode', 'start', 'end' and 'duration'.
+        Sweeps become one hold per level and dwells repeat the previous setpoint. Tare segments also keep their
+        'settle', 'samples' and 'sem' settings. Characterize steps become one point per level, with its 'settle' and
+        'last' set on the final point of the sweep.
+
+    :param profile: a profile dict, see the module docstring
+    :return: the list of segments
+    :raises ValueError: for an unknown step type or mode, or a velocity or point segment before the first tare
+    """
+    segments = []
+    previous = {"mode": "duty", "end": 0.0}
+    for step in profile["steps"] * int(profile.get("repeat", 1)):
+        kind = step["type"]
+        mode = step.get("mode", "duty")
+        if mode not in MODES:
+            raise ValueError(f"unknown mode {mode!r}, expected one of {MODES}")
+        if kind == "tare":
+            segments.append({"type": "tare", "mode": "duty", "start": 0.0, "end": 0.0,
+                             "duration": float(step.get("duration", 10)), "settle": float(step.get("settle", 5)),
+                             "samples": step.get("samples"), "sem": step.get("sem")})
+        elif kind == "step":
+            segments.append({"type": "hold", "mode": mode, "start": float(step["value"]),
+                             "end": float(step["value"]), "duration": float(step["dwell"])})
+        elif kind == "ramp":
+            segments.append({"type": "ramp", "mode": mode, "start": float(step["from"]), "end": float(step["to"]),
+                             "duration": float(step["duration"])})
+        elif kind == "sweep":
+            levels = np.arange(float(step["from"]), float(step["to"]) + float(step["step"]) / 2, float(step["step"]))
+            segments.extend({"type": "hold", "mode": mode, "start": float(level), "end": float(level),
+                             "duration": float(step["dwell"])} for level in levels)
+        elif kind == "characterize":
+            levels = np.arange(float(step["from"]), float(step["to"]) + float(step["step"]) / 2, float(step["step"]))
+            segments.extend({"type": "point", "mode": "duty", "start": float(level), "end": float(level),
+                             "duration": float(step.get("duration", 4)), "settle": float(step.get("settle", 8)),
+                             "last": index == len(levels) - 1} for index, level in enumerate(levels))
+        elif kind == "dwell":
+            segments.append({"type": "hold", "mode": previous["mode"], "start": previous["end"],
+                             "end": previous["end"], "duration": float(step["duration"])})
+        else:
+            raise ValueError(f"unknown step type {kind!r}")
+        previous = segments[-1]
+
+    tared = False
+    for index, segment in enumerate(segments):
+        tared = tared or segment["type"] == "tare"
+        if segment["mode"] == "velocity" and not tared:
+            raise ValueError(f"segment {index} holds a velocity before any tare")
+        if segment["type"] == "point" and not tared:
+            raise ValueError(f"segment {index} characterizes the fan before any tare")
+    return segments
+
+
+class ProfileRunner:
+    """
+    Executes an expanded profile and records the run.
+
+    ...
+    The runner polls the acquisition worker every 'tick' seconds from the calling thread. Duty segments queue pwm
+        values on the worker; velocity segments hand the worker a VelocityController, which then runs on every
+        sample. Every sample is written to the recorder with the segment index and setpoint in force. Point segments
+        average the velocity and density once settled and add the finished sweep to the characterization map.
+    """
+
+    def __init__(self, profile, console_port, data_port, output_folder="data_output", record_format="csv",
+                 compress=False, pid_gains=None, humidity_correction=False, characterization=None,
+                 characterization_file=None, **worker_kwargs):
+        """
+        :param profile: a profile dict, see the module docstring
+        :param console_port: the port of the pc to send commands. Should be a serial port object using pyserial
+        :param data_port: the port of the pc to receive the data over. Should be a serial port object using pyserial
+        :param output_folder: the folder for the recording
+        :param record_format: "csv" or "columnar"
+        :param compress: True to compress a columnar recording when it closes
+        :param pid_gains: (kp, ki, kd) for velocity segments, or None for VelocityController's defaults
+        :param humidity_correction: True to correct the air density for the measured humidity
+        :param characterization: a CharacterizationMap used as the velocity feed-forward and extended by characterize
+            steps, or None for neither
+        :param characterization_file: the file the map is saved to when it changes
+        :param worker_kwargs: further AcquisitionWorker options, e.g. stream_rate, binary or averaging
+        """
+        self.profile = profile
+        self.segments = expand_profile(profile)
+        self.output_folder = output_folder
+        self.record_format = record_format
+        self.compress = compress
+        self.humidity_correction = humidity_correction
+        self.characterization = characterization
+        self.characterization_file = characterization_file
+        self.controller = VelocityController(*(pid_gains or ()), feed_forward=characterization)
+        self.acquisition = AcquisitionWorker(console_port, data_port, **worker_kwargs)
+        self.worker_kwargs = worker_kwargs
+        self.recorder = None
+        self.density = None                                 # from the ambient calibration
+        self.initDP = None                                  # from the latest tare
+        self.env_job = CalibrationJob(4, max_duration=5)    # density, pressure, humidity, temperature
+        self.tare_job = None
+        self.point_job = None                               # velocity and density of a characterize level
+        self.sweep_points = []                              # (duty fraction, velocity, density) of the sweep so far
+        self.segment_index = 0
+        self.segment_start = None
+        self.start_time = None
+
+    def run(self, tick=0.05):
+        """
+        Runs every segment in turn, then turns the fan off and closes the recording.
+
+        :param tick: seconds between polls of the acquisition worker
+        :return: the recording's filename
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        self.open_recorder()
+        self.acquisition.start()
+        self.start_time = time.time()
+        self.begin_segment(0)
+        try:
+            while self.segment_index < len(self.segments):
+                time.sleep(tick)
+                self.process(*self.get_data())
+                if self.acquisition.error is not None:
+                    raise self.acquisition.error
+                self.advance()
+        finally:
+            self.controller.setpoint = 0
+            self.acquisition.controller = None
+            self.acquisition.set_pwm(0)
+            self.acquisition.stop()
+            self.process(*self.get_data())
+            if isinstance(self.recorder, ColumnarRecorder):     # the last tare, for physics.py reprocessing
+                self.recorder.metadata.update(initDP=self.initDP)
+            self.recorder.close()
+            if self.characterization is not None and self.characterization.changed:   # e.g. a sweep went stale
+                self.characterization.save(self.characterization_file)
+        return self.recorder.filename
+
+    def open_recorder(self):
+        """
+        Creates the recorder for this run.
+
+        :return: None
+        """
+        if self.record_format == "columnar":
+            metadata = {"start_time": time.time(), "profile": self.profile, "segments": self.segments,
+                        "humidity_correction": self.humidity_correction, "acquisition": dict(self.worker_kwargs)}
+            filename = next_filename(self.output_folder, extension=COLUMNAR_EXTENSION)
+            self.recorder = ColumnarRecorder(filename, FIELDNAMES, dtypes={"segment": "<u4", "duty": "<f4"},
+                                             metadata=metadata, compress=self.compress)
+        else:
+            self.recorder = Recorder(next_filename(self.output_folder), FIELDNAMES)
+        self.recorder.start()
+
+    def begin_segment(self, index):
+        """
+        Applies the setpoint at the start of a segment.
+
+        :param index: the segment index
+        :return: None
+        """
+        self.segment_index = index
+        self.segment_start = time.time()
+        if index >= len(self.segments):
+            return
+        segment = self.segments[index]
+        print(f"[{self.segment_start - self.start_time:8.1f} s] segment {index + 1}/{len(self.segments)}: "
+              f"{segment['type']} {segment['mode']} {segment['start']:g} -> {segment['end']:g}")
+        if segment["type"] == "tare":
+            self.tare_job = None                            # started once the fan has settled
+        elif segment["type"] == "point":
+            self.point_job = None
+        self.apply_setpoint(segment["start"])
+
+    def setpoint(self, now):
+        """
+        :param now: a time.time(), or an array of sample times
+        :return: the setpoint of the current segment at 'now', interpolated along ramps, one per time for an array
+        """
+        segment = self.segments[self.segment_index]
+        if segment["type"] != "ramp" or segment["duration"] <= 0:
+            return segment["start"]
+        fraction = np.clip((now - self.segment_start) / segment["duration"], 0.0, 1.0)
+        return segment["start"] + (segment["end"] - segment["start"]) * fraction
+
+    def apply_setpoint(self, value):
+        """
+        Sends the current segment's setpoint to the fan or the controller.
+
+        :param value: duty in percent or velocity in m/s, depending on the segment's mode
+        :return: None
+        """
+        if self.segments[self.segment_index]["mode"] == "velocity":
+            self.controller.setpoint = value
+            self.acquisition.controller = self.controller   # runs on every sample from here on
+        else:
+            self.controller.setpoint = 0
+            self.acquisition.controller = None
+            self.acquisition.set_pwm(int(min(max(value, 0), 100) / 100 * 65535))
+
+    def advance(self):
+        """
+        Updates ramps and tares and moves to the next segment when the current one is done.
+
+        :return: None
+        """
+        now = time.time()
+        segment = self.segments[self.segment_index]
+        elapsed = now - self.segment_start
+        if segment["type"] == "tare":
+            if self.tare_job is None and elapsed >= segment["settle"]:
+                self.tare_job = CalibrationJob(max_samples=segment["samples"], target_sem=segment["sem"],
+                                               max_duration=segment["duration"])
+            if self.tare_job is not None and self.tare_job.done:
+                self.initDP = self.tare_job.mean()[0]
+                self.controller.init_dp = self.initDP
+                self.tare_job = None
+                print(f"  tare: {self.initDP:.4f}")
+                self.begin_segment(self.segment_index + 1)
+            return
+        if segment["type"] == "point":
+            if self.point_job is None and elapsed >= segment["settle"]:
+                self.point_job = CalibrationJob(2, max_duration=segment["duration"])
+            if self.point_job is not None and self.point_job.done:
+                self.finish_point(segment)
+                self.begin_segment(self.segment_index + 1)
+            return
+        if segment["type"] == "ramp":
+            self.apply_setpoint(self.setpoint(now))
+        if elapsed >= segment["duration"]:
+            self.begin_segment(self.segment_index + 1)
+
+    def finish_point(self, segment):
+        """
+        Keeps the settled velocity of a characterize level, and adds the sweep to the map after its last level.
+
+        :param segment: the point segment that finished
+        :return: None
+        """
+        mean_velocity, mean_density = self.point_job.mean()
+        self.point_job = None
+        self.sweep_points.append((segment["start"] / 100, mean_velocity, mean_density))
+        print(f"  {segment['start']:g} % duty: {mean_velocity:.3f} m/s")
+        if not segment["last"]:
+            return
+        duty, velocities, densities = np.array(self.sweep_points).T
+        self.sweep_points = []
+        if self.characterization is None:
+            return
+        try:
+            sweep = self.characterization.add_sweep(densities.mean(), duty, velocities)
+        except ValueError as error:
+            print(f"  characterization not saved: {error}")
+            return
+        self.characterization.save(self.characterization_file)
+        print(f"  characterization at {sweep['density']:.4f} kg/m^3 saved to {self.characterization_file}")
+
+    def get_data(self):
+        """
+        :return: (times, data) of every sample queued by the worker, data holding the six sensor values per row
+        """
+        queued = self.acquisition.drain()
+        if not queued:
+            return np.empty(0), np.empty((0, 6))
+        return np.array([sample_time for sample_time, sample in queued]), \
+            np.array([sample for sample_time, sample in queued])
+
+    def process(self, times, data):
+        """
+        Feeds calibrations and records a batch of samples.
+
+        :param times: the sample times
+        :param data: the sensor values, one row of six per sample
+        :return: None
+        """
+        if not len(data):
+            return
+        press_Pa = data[:, 0] * 100
+        temp_C = data[:, 3]
+        dens_kgm3 = density(press_Pa, temp_C, data[:, 2] if self.humidity_correction else None)
+        dp = data[:, 4]
+        if self.env_job is not None and self.env_job.add(times, np.column_stack((dens_kgm3, press_Pa, data[:, 2],
+                                                                                 temp_C))):
+            self.density = self.env_job.mean()[0]
+            self.controller.density = self.density
+            self.env_job = None
+        if self.tare_job is not None:
+            self.tare_job.add(times, dp)
+        velocities = velocity(dynamic_pressure(dp, self.initDP), dens_kgm3)   # nan until the first tare
+        if self.point_job is not None:
+            self.point_job.add(times, np.column_stack((velocities, dens_kgm3)))
+
+        segment = min(self.segment_index, len(self.segments) - 1)
+        if self.acquisition.controller is not None:
+            duty = self.controller.duty * 100
+        else:
+            duty = (self.acquisition.last_pwm or 0) / 65535 * 100
+        columns = {
+            "time": times - self.start_time,
+            "segment": np.full(len(data), segment),
+            "setpoint": np.broadcast_to(self.setpoint(times) if self.segment_index < len(self.segments) else 0.0,
+                                        len(data)),     # each sample's own point along a ramp
+            "duty": np.full(len(data), duty),
+            "velocity": velocities,
+            "diff_pressure": dp,
+            "pressure": press_Pa / 1000,                    # kPa, as in the GUI's recordings
+            "temp": temp_C,
+            "humidity": data[:, 2],
+            "density": dens_kgm3,
+        }
+        self.recorder.write_rows(np.column_stack([columns[name] for name in FIELDNAMES]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a test profile without the GUI')
+    parser.add_argument('profile', help='JSON test profile')
+    parser.add_argument('--dry_run', action='store_true', help='Print the expanded segments and exit')
+    parser.add_argument('--stream_rate', type=float, default=None,
+                        help='Stream samples at this rate in Hz (0 = as fast as possible) instead of polling')
+    parser.add_argument('--binary', action='store_true', help='Use crc-checked binary frames')
+    parser.add_argument('--averaging', type=int, default=1,
+                        help='Differential pressure reads the feather averages into each sample')
+    parser.add_argument('--sensor_intervals', type=int, nargs=2, default=None, metavar=('BMP_MS', 'AHT_MS'),
+                        help='Read the ambient sensors on their own interval and reuse their values in between')
+    parser.add_argument('--pid', type=float, nargs=3, default=None, metavar=('KP', 'KI', 'KD'),
+                        help='PID gains for velocity segments, in duty fraction per m/s')
+    parser.add_argument('--humidity_correction', action='store_true',
+                        help='Correct the air density for the measured humidity')
+    parser.add_argument('--characterization', default=None,
+                        help='Duty to velocity map used as the velocity feed-forward and extended by characterize '
+                             'steps (default: characterization.json in the output folder)')
+    parser.add_argument('--no_feed_forward', action='store_true',
+                        help='Hold velocities with the PID alone; characterize steps are still saved')
+    parser.add_argument('--record_format', choices=['csv', 'columnar'], default='csv',
+                        help='Record to csv or to a directory of memory-mappable binary columns')
+    parser.add_argument('--compress', action='store_true', help='Compress columnar recordings when they are closed')
+    parser.add_argument('--output_folder', default='data_output', help='Folder for the recording')
+    parser.add_argument('--console_port', default='COM14', help='Serial port of the feather console')
+    parser.add_argument('--data_port', default='COM15', help='Serial port of the feather data channel')
+    parser.add_argument('--simulate', action='store_true', help='Run against a simulated feather instead of hardware')
+    parser.add_argument('--capture', action='store_true',
+                        help='Save every raw byte from the data port with its receive time to a capture file')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Time the data path and serve the metrics at http://127.0.0.1:PORT/metrics')
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    segments = expand_profile(profile)
+    if args.dry_run:
+        for index, segment in enumerate(segments):
+            print(f"{index + 1:4d} {segment['type']:>5} {segment['mode']:>8} {segment['start']:8g} -> "
+                  f"{segment['end']:<8g} {segment['duration']:8g} s")
+        timed = sum(segment["duration"] + segment.get("settle", 0) for segment in segments)
+        print(f"about {timed / 60:.1f} min")
+        return
+
+    if args.simulate:
+        console_port, data_port = open_simulated_ports()
+    else:
+        console_port = serial.Serial(args.console_port, 115200)
+        data_port = serial.Serial(args.data_port, 115200)
+    if args.capture:
+        os.makedirs(args.output_folder, exist_ok=True)
+        data_port = CapturePort(data_port, next_filename(args.output_folder, "capture", CAPTURE_EXTENSION),
+                                metadata={"binary": args.binary, "stream_rate": args.stream_rate,
+                                          "averaging": args.averaging, "sensor_intervals": args.sensor_intervals,
+                                          "profile": profile})
+    characterization_file = args.characterization or os.path.join(args.output_folder, "characterization.json")
+    runner = ProfileRunner(profile, console_port, data_port, output_folder=args.output_folder,
+                           record_format=args.record_format, compress=args.compress, pid_gains=args.pid,
+                           humidity_correction=args.humidity_correction,
+                           characterization=load_characterization(characterization_file),
+                           characterization_file=characterization_file,
+                           stream_rate=args.stream_rate, binary=args.binary, averaging=args.averaging,
+                           sensor_intervals=args.sensor_intervals)
+    if args.no_feed_forward:
+        runner.controller.feed_forward = None
+    if args.metrics_port is not None:
+        METRICS.enabled = True
+        runner.acquisition.register_metrics()
+        METRICS.gauge("recorder_backlog", "Row batches waiting to be written to disk",
+                      lambda: runner.recorder.backlog if runner.recorder is not None else 0)
+        MetricsServer(METRICS, args.metrics_port).start()   # a daemon thread, gone when the run ends
+    try:
+        filename = runner.run()
+    except KeyboardInterrupt:
+        filename = runner.recorder.filename
+        print("Stopped")
+    print(f"Data saved to: {filename}")
+    if args.capture:
+        data_port.close()                                   # flushes the capture to disk
+        print(f"Capture saved to: {data_port.filename}")
+
+
+if __name__ == '__main__':
+    main()
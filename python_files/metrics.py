@@ -0,0 +1,331 @@
+"""
+This module contains the instrumentation registry and its Prometheus text endpoint
+
+...
+Counters, gauges and histograms are registered once, by name, in a Registry. The module level METRICS registry is
+disabled by default: instrumented code checks METRICS.enabled before taking any timestamps, so the cost of disabled
+instrumentation is one attribute lookup per call site. Values the code already keeps, such as a worker's lost frame
+count or a recorder's backlog, are exposed through a function read at scrape time instead and cost nothing between
+scrapes.
+
+Some metrics are written from more than one thread, e.g. the bad frame count from each worker and FeatherClient
+reader, so every metric has its own lock around its updates. A scrape copies a histogram's counts and sum under
+that lock, so they always agree. The lock is only taken when the update is made, which instrumented code skips while
+the registry is disabled.
+
+MetricsServer serves the registry at http://127.0.0.1:<port>/metrics in the Prometheus text exposition format, e.g.
+
+    # HELP feather_request_seconds Round trip of a <D,n> data request
+    # TYPE feather_request_seconds histogram
+    feather_request_seconds_bucket{le="0.0016"} 812
+    ...
+
+Classes:
+
+    Counter(name, help_text, function)
+        Monotonically increasing count
+
+    Gauge(name, help_text, function)
+        Value that can go up and down
+
+    Histogram(name, help_text, bounds)
+        Counts of observations in fixed buckets, with their sum
+
+    Registry()
+        Named collection of metrics with a Prometheus text rendering
+
+    Rate(function, min_interval)
+        Per second rate of a growing count, for use as a gauge function
+
+    MetricsServer(registry, port, host)
+        Thread serving a registry over HTTP
+
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BOUNDS = [50e-6 * 2 ** exponent for exponent in range(18)]  # 50 us to 6.6 s, in seconds
+
+
+class Counter:
+    """
+    Monotonically increasing count.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, function=None):
+        """
+        :param name: the metric name
+        :param help_text: one line describing the metric
+        :param function: returns the current count at scrape time, instead of counting with inc()
+        """
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self._value = 0
+        self._lock = threading.Lock()                       # += is a read and a write, so threads can lose updates
+
+    def inc(self, amount=1):
+        """
+        :param amount: the amount to add
+        :return: None
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        """
+        :return: the current value
+        """
+        return self.function() if self.function is not None else self._value
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down.
+    """
+    kind = "gauge"
+
+    def set(self, value):
+        """
+        :param value: the new value
+        :return: None
+        """
+        with self._lock:
+            self._value = value
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with their sum.
+
+    ...
+    counts[i] holds the observations at or below bounds[i] and above bounds[i - 1]; the last count is everything
+        above the last bound. Quantiles are interpolated linearly within a bucket.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, bounds=None):
+        """
+        :param name: the metric name
+        :param help_text: one line describing the metric
+        :param bounds: the ascending upper bounds of the buckets, DEFAULT_BOUNDS if None
+        """
+        self.name = name
+        self.help_text = help_text
+        self.bounds = list(DEFAULT_BOUNDS if bounds is None else bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        :param value: the observed value, e.g. a duration in seconds
+        :return: None
+        """
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def totals(self):
+        """
+        :return: (counts, sum), copies taken together so they describe the same observations
+        """
+        with self._lock:
+            return list(self.counts), self.sum
+
+    @property
+    def count(self):
+        """
+        :return: the number of observations
+        """
+        return sum(self.totals()[0])
+
+    def quantile(self, q):
+        """
+        :param q: the quantile between 0 and 1
+        :return: the estimated value below which a fraction q of the observations fall, or None without any
+        """
+        counts = self.totals()[0]                           # one consistent copy
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.bounds):               # above the last bound
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+
+class Registry:
+    """
+    Named collection of metrics with a Prometheus text rendering.
+
+    ...
+    Registering a name that already exists returns the existing metric, updating its function if one is given, so
+        a new worker can take over the gauges of the one it replaces.
+    """
+
+    def __init__(self, enabled=False):
+        """
+        :param enabled: True to have instrumented code record timings
+        """
+        self.enabled = enabled
+        self.metrics = {}
+
+    def counter(self, name, help_text, function=None):
+        """
+        :param name: the metric name
+        :param help_text: one line describing the metric
+        :param function: returns the count at scrape time, or None to count with inc()
+        :return: the Counter
+        """
+        return self._register(Counter, name, help_text, function)
+
+    def gauge(self, name, help_text, function=None):
+        """
+        :param name: the metric name
+        :param help_text: one line describing the metric
+        :param function: returns the value at scrape time, or None to set it with set()
+        :return: the Gauge
+        """
+        return self._register(Gauge, name, help_text, function)
+
+    def histogram(self, name, help_text, bounds=None):
+        """
+        :param name: the metric name
+        :param help_text: one line describing the metric
+        :param bounds: the ascending upper bucket bounds, DEFAULT_BOUNDS if None
+        :return: the Histogram
+        """
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, help_text, bounds)
+        return self.metrics[name]
+
+    def snapshot(self):
+        """
+        :return: a dict of metric name to its value, or to the Histogram itself for histograms
+        """
+        return {name: metric if metric.kind == "histogram" else metric.value
+                for name, metric in list(self.metrics.items())}
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in list(self.metrics.items()):         # metrics may be registered meanwhile
+            lines.append(f"# HELP {name} {metric.help_text}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == "histogram":
+                counts, total = metric.totals()
+                cumulative = 0
+                for bound, count in zip(metric.bounds + [None], counts):
+                    cumulative += count
+                    le = "+Inf" if bound is None else f"{bound:.6g}"
+                    lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{name}_sum {total:.9g}")
+                lines.append(f"{name}_count {cumulative}")
+            else:
+                try:
+                    value = metric.value
+                except Exception:                           # a source that has gone away, e.g. a closed recorder
+                    continue
+                lines.append(f"{name} {float(value):.9g}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric_class, name, help_text, function):
+        if name not in self.metrics:
+            self.metrics[name] = metric_class(name, help_text, function)
+        elif function is not None:
+            self.metrics[name].function = function
+        return self.metrics[name]
+
+
+METRICS = Registry()
+
+
+class Rate:
+    """
+    Per second rate of a growing count, for use as a gauge function.
+
+    ...
+    The rate is measured between successive calls at least min_interval apart; calls in between return the previous
+        rate, so a GUI panel and a scraper reading the same gauge do not shorten each other's window.
+    """
+
+    def __init__(self, function, min_interval=1.0):
+        """
+        :param function: returns the current count
+        :param min_interval: the shortest window in seconds the rate is measured over
+        """
+        self.function = function
+        self.min_interval = min_interval
+        self.rate = 0.0
+        self._last = None                                   # (time.monotonic(), count)
+
+    def __call__(self):
+        now, count = time.monotonic(), self.function()
+        if self._last is None:
+            self._last = (now, count)
+        elif now - self._last[0] >= self.min_interval:
+            self.rate = (count - self._last[1]) / (now - self._last[0])
+            self._last = (now, count)
+        return self.rate
+
+
+class MetricsServer(threading.Thread):
+    """
+    Thread serving a registry over HTTP.
+
+    ...
+    Only GET /metrics is answered. The server binds to localhost by default, so the rig is not exposed to the network
+        unless a host is given.
+    """
+
+    def __init__(self, registry=METRICS, port=9100, host="127.0.0.1"):
+        """
+        :param registry: the registry to serve
+        :param port: the TCP port, or 0 for any free port (see server_address once started)
+        :param host: the interface to bind to
+        """
+        super().__init__(daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):                   # no line per scrape on the console
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server_address = self.server.server_address
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+
+        :return: None
+        """
+        self.server.shutdown()
+        self.server.server_close()
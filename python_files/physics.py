@@ -0,0 +1,234 @@
+"""
+This module contains the air data reduction shared by the GUI, the controller, the headless runner and offline tools
+
+...
+Every function takes NumPy arrays or plain floats and works element-wise, so the same code turns one averaged sample
+into an LCD value and a whole recording into a velocity column. Nothing here keeps state.
+
+    density             ideal gas density from the bmp pressure and temperature, optionally corrected for humidity
+    dynamic_pressure    differential pressure less the tare (initDP)
+    velocity            signed velocity from Bernoulli, v = sign(q) * sqrt(2|q| / rho)
+    velocity_uncertainty    first order propagation of the dynamic pressure and density errors into the velocity
+
+Humid air is lighter than dry air at the same pressure and temperature. With humidity given, the water vapour partial
+pressure is found from the relative humidity and the saturation vapour pressure (Magnus formula, Alduchov and
+Eskridge 1996), and the dry air and vapour are summed as two ideal gases. At 22 C and 40 % this is 0.5 % below the
+dry air density.
+
+Recordings made by the GUI or headless.py can be reprocessed in bulk with a new tare or density model from the
+command line. Columnar recordings are memory-mapped, so hours of samples take milliseconds.
+
+Functions:
+
+    saturation_vapor_pressure(temp_C)
+        Saturation vapour pressure of water over a flat water surface in Pa
+
+    density(press_Pa, temp_C, humidity)
+        Air density in kg/m^3
+
+    dynamic_pressure(dp, init_dp)
+        Differential pressure less the tare
+
+    velocity(q, dens)
+        Signed air velocity in m/s
+
+    velocity_uncertainty(q, dens, q_sigma, dens_sigma)
+        Standard uncertainty of the velocity in m/s
+
+    load_recording(filename)
+        Loads a csv or columnar recording as a dict of arrays and its metadata
+
+    reprocess(columns, init_dp, dens, humidity_correction, dp_sigma)
+        Recomputes density, velocity and its uncertainty for a recording
+
+    main()
+        Command line entry point
+
+Usage:
+
+    python python_files/physics.py data_output/recorded_data_1.cols [--init_dp 31.2] [--humidity_correction]
+                                   [--density 1.19] [--dp_sigma 0.5] [--output reprocessed.csv]
+
+"""
+import argparse
+import csv
+import math
+import os
+import time
+import numpy as np
+from recorder import Recorder, ColumnarRecorder, COLUMNAR_EXTENSION, load_columnar
+
+R_DRY = 287.058      # J/(kg K), specific gas constant of dry air
+R_VAPOR = 461.495    # J/(kg K), specific gas constant of water vapour
+ZERO_C = 273.15      # K
+
+
+def saturation_vapor_pressure(temp_C):
+    """
+    :param temp_C: the temperature in C
+    :return: the saturation vapour pressure in Pa
+    """
+    temp_C = np.asarray(temp_C, dtype=float)
+    return 610.94 * np.exp(17.625 * temp_C / (temp_C + 243.04))
+
+
+def density(press_Pa, temp_C, humidity=None):
+    """
+    :param press_Pa: the absolute pressure in Pa
+    :param temp_C: the temperature in C
+    :param humidity: the relative humidity in %, or None for dry air
+    :return: the density in kg/m^3
+    """
+    press_Pa = np.asarray(press_Pa, dtype=float)
+    temp_K = np.asarray(temp_C, dtype=float) + ZERO_C
+    if humidity is None:
+        return press_Pa / (R_DRY * temp_K)
+    vapor_Pa = np.clip(humidity, 0, 100) / 100 * saturation_vapor_pressure(temp_C)
+    return (press_Pa - vapor_Pa) / (R_DRY * temp_K) + vapor_Pa / (R_VAPOR * temp_K)
+
+
+def dynamic_pressure(dp, init_dp):
+    """
+    :param dp: the differential pressure in Pa
+    :param init_dp: the tare in Pa, or None before the first tare (gives nan)
+    :return: dp - init_dp in Pa
+    """
+    return np.asarray(dp, dtype=float) - (np.nan if init_dp is None else init_dp)
+
+
+def velocity(q, dens):
+    """
+    :param q: the dynamic pressure in Pa, negative for reversed flow
+    :param dens: the air density in kg/m^3
+    :return: the velocity in m/s, with the sign of q
+    """
+    if isinstance(q, float) and isinstance(dens, float):      # one sample, e.g. the controller: math is 10x faster
+        return math.copysign(math.sqrt(abs(2 * q / dens)), q)
+    q = np.asarray(q, dtype=float)
+    return np.sign(q) * np.sqrt(np.abs(2 * q / dens))
+
+
+def velocity_uncertainty(q, dens, q_sigma, dens_sigma=0.0):
+    """
+    Standard uncertainty of the velocity in m/s
+
+    ...
+    From v = sqrt(2q / rho), sigma_v / v = 0.5 * sqrt((sigma_q / q)^2 + (sigma_rho / rho)^2). This grows without
+        limit as q goes to 0, where the velocity is no better known than the one the dynamic pressure error alone
+        would give, sqrt(2 sigma_q / rho), so the result is capped there (plus the density term).
+
+    :param q: the dynamic pressure in Pa
+    :param dens: the air density in kg/m^3
+    :param q_sigma: the standard uncertainty of q in Pa, e.g. sensor noise and tare error combined
+    :param dens_sigma: the standard uncertainty of the density in kg/m^3
+    :return: the standard uncertainty of the velocity in m/s
+    """
+    q = np.abs(np.asarray(q, dtype=float))
+    dens = np.asarray(dens, dtype=float)
+    v = np.sqrt(2 * q / dens)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = 0.5 * v * np.sqrt((q_sigma / q) ** 2 + (dens_sigma / dens) ** 2)
+    return np.fmin(sigma, np.sqrt(2 * q_sigma / dens) + v * dens_sigma / (2 * dens))
+
+
+def load_recording(filename):
+    """
+    Loads a csv or columnar recording as a dict of arrays and its metadata
+
+    :param filename: a .csv file written by Recorder or a directory written by ColumnarRecorder
+    :return: (columns, metadata), metadata being empty for csv recordings
+    """
+    if os.path.isdir(filename):
+        return load_columnar(filename)
+    with open(filename, newline="") as file:
+        fieldnames = next(csv.reader(file))
+    table = np.loadtxt(filename, delimiter=",", skiprows=1, ndmin=2)
+    return {name: table[:, index] for index, name in enumerate(fieldnames)}, {}
+
+
+def reprocess(columns, init_dp, dens=None, humidity_correction=False, dp_sigma=0.0, init_dp_sigma=0.0):
+    """
+    Recomputes density, velocity and its uncertainty for a recording
+
+    ...
+    A fixed 'dens' is used when given. Otherwise the density comes from the recorded pressure and temp columns, or
+        from the recorded density column when those were not recorded.
+
+    :param columns: a dict of recorded arrays holding at least 'diff_pressure', pressure in kPa and temp in C
+    :param init_dp: the tare in Pa
+    :param dens: a fixed density in kg/m^3, overriding the recorded ambient conditions, or None
+    :param humidity_correction: True to correct the density for the recorded humidity
+    :param dp_sigma: the standard uncertainty of one differential pressure sample in Pa
+    :param init_dp_sigma: the standard uncertainty of the tare in Pa
+    :return: a dict with 'density', 'velocity' and 'velocity_uncertainty' arrays
+    """
+    if dens is None:
+        if "pressure" in columns and "temp" in columns:
+            humidity = columns.get("humidity") if humidity_correction else None
+            if humidity_correction and humidity is None:
+                raise ValueError("humidity correction needs a recorded humidity column")
+            dens = density(np.asarray(columns["pressure"]) * 1000, columns["temp"], humidity)
+        elif "density" in columns:
+            dens = columns["density"]
+        else:
+            raise ValueError("the recording has no pressure and temp columns, a density is needed")
+    q = dynamic_pressure(columns["diff_pressure"], init_dp)
+    dens = np.broadcast_to(np.asarray(dens, dtype=float), q.shape)
+    return {
+        "density": dens,
+        "velocity": velocity(q, dens),
+        "velocity_uncertainty": velocity_uncertainty(q, dens, np.hypot(dp_sigma, init_dp_sigma)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess a recording with a new tare or density model')
+    parser.add_argument('recording', help='A csv file or columnar directory written by the GUI or headless.py')
+    parser.add_argument('--init_dp', type=float, default=None,
+                        help='Tare in Pa (default: the initDP saved with a columnar recording)')
+    parser.add_argument('--density', type=float, default=None,
+                        help='Fixed density in kg/m^3 instead of the recorded pressure and temperature')
+    parser.add_argument('--humidity_correction', action='store_true', help='Correct the density for humidity')
+    parser.add_argument('--dp_sigma', type=float, default=0.0,
+                        help='Standard uncertainty of one differential pressure sample in Pa')
+    parser.add_argument('--output', default=None,
+                        help='Write the recording with the new columns to this csv file or .cols directory')
+    args = parser.parse_args()
+
+    columns, metadata = load_recording(args.recording)
+    init_dp = metadata.get("initDP") if args.init_dp is None else args.init_dp
+    if init_dp is None:
+        parser.error("no initDP was saved with this recording, pass --init_dp")
+
+    dens = args.density
+    if dens is None and not {"pressure", "temp"} <= set(columns) and "density" not in columns:
+        dens = metadata.get("density")                      # the GUI's calibration, saved with columnar recordings
+
+    start = time.perf_counter()
+    try:
+        results = reprocess(columns, init_dp, dens, args.humidity_correction, args.dp_sigma,
+                            metadata.get("initDP_sem") or 0.0)
+    except ValueError as error:
+        parser.error(str(error))
+    elapsed = time.perf_counter() - start
+    num_samples = len(results["velocity"])
+    print(f"Reprocessed {num_samples} samples in {elapsed * 1000:.1f} ms")
+    if num_samples:
+        print(f"Velocity: mean {np.nanmean(results['velocity']):.3f} m/s, "
+              f"uncertainty {np.nanmedian(results['velocity_uncertainty']):.3f} m/s (median)")
+
+    if args.output is not None:
+        columns.update(results)
+        fieldnames = list(columns)
+        if args.output.endswith(COLUMNAR_EXTENSION):
+            recorder = ColumnarRecorder(args.output, fieldnames, metadata=dict(metadata, initDP=init_dp))
+        else:
+            recorder = Recorder(args.output, fieldnames)
+        recorder.start()
+        recorder.write_rows(np.column_stack([columns[name] for name in fieldnames]))
+        recorder.close()
+        print(f"Data saved to: {recorder.filename}")
+
+
+if __name__ == '__main__':
+    main()
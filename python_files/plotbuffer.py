@@ -0,0 +1,84 @@
+"""
+This module contains the growing x/y buffer behind the live velocity plot
+
+...
+Points are written into preallocated NumPy arrays whose capacity doubles when full, so appending is amortized O(1)
+and the plot can be handed array views instead of rebuilding Python lists every tick. With a maximum age set, points
+older than that are discarded when the buffer fills, which keeps memory bounded for scrolling plots. The old points
+are found with a mask rather than a binary search, since x can step backwards when timing.ClockSync corrects its
+estimate.
+
+Classes:
+
+    PlotBuffer(capacity, max_age)
+        Growable pair of float arrays holding plot points in time order
+
+"""
+import numpy as np
+
+
+class PlotBuffer:
+    """
+    Growable pair of float arrays holding plot points in time order.
+    """
+
+    def __init__(self, capacity=4096, max_age=None):
+        """
+        :param capacity: the number of points allocated up front
+        :param max_age: if set, points older than this many x units behind the newest may be discarded
+        """
+        self.max_age = max_age
+        self._x = np.empty(capacity)
+        self._y = np.empty(capacity)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        """
+        Removes every point but keeps the allocated arrays.
+
+        :return: None
+        """
+        self.count = 0
+
+    def append(self, x, y):
+        """
+        Adds one point. x is expected to grow, but may step back, e.g. when the clock fit is corrected.
+
+        :param x: the x value, e.g. elapsed time in seconds
+        :param y: the y value
+        :return: None
+        """
+        if self.count == len(self._x):
+            self._make_room(x)
+        self._x[self.count] = x
+        self._y[self.count] = y
+        self.count += 1
+
+    def data(self):
+        """
+        :return: (x, y) array views of the stored points. They are only valid until the next append
+        """
+        return self._x[:self.count], self._y[:self.count]
+
+    def x_range(self):
+        """
+        :return: (first x, last x), or (0, 0) when empty
+        """
+        if not self.count:
+            return 0, 0
+        return self._x[0], self._x[self.count - 1]
+
+    def _make_room(self, x):
+        if self.max_age is not None:
+            keep = self._x[:self.count] >= x - self.max_age
+            kept = int(np.count_nonzero(keep))
+            if self.count - kept >= self.count // 2:            # only compact when it frees enough to stay O(1)
+                self._x[:kept] = self._x[:self.count][keep]
+                self._y[:kept] = self._y[:self.count][keep]
+                self.count = kept
+                return
+        self._x = np.resize(self._x, 2 * len(self._x))
+        self._y = np.resize(self._y, 2 * len(self._y))
@@ -0,0 +1,267 @@
+"""
+This module contains the background writers that record a run to disk as it happens
+
+...
+Rows are handed to the writer thread through a queue and appended to the file straight away, so memory use depends
+only on how far the disk falls behind, not on the length of the run. The queue holds at most max_backlog batches;
+beyond that write_rows waits for the disk rather than grow without bound. Files are flushed and fsync'd
+periodically, so a crash loses at most the last flush interval. If the writer fails, e.g. on a full disk, its
+exception is raised again from the next write_rows and from close.
+
+Two formats are available. Recorder writes a csv file. ColumnarRecorder writes a directory holding one raw
+little-endian binary file per column plus a meta.json with the column dtypes and run metadata. Columns can be
+memory-mapped straight back into NumPy arrays by load_columnar, or packed into a compressed columns.npz when the
+recording is closed.
+
+Classes:
+
+    Recorder(filename, fieldnames, flush_interval, max_backlog)
+        Thread that appends queued rows to a csv file
+
+    ColumnarRecorder(filename, fieldnames, flush_interval, dtypes, metadata, compress, max_backlog)
+        Thread that appends queued rows column by column to a directory of binary files
+
+Functions:
+
+    next_filename(folder, prefix, extension)
+        Returns the first unused numbered filename in a folder
+
+    load_columnar(filename)
+        Loads a ColumnarRecorder recording as a dict of NumPy arrays and its metadata
+
+"""
+import csv
+import json
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+
+COLUMNAR_EXTENSION = ".cols"
+
+
+class Recorder(threading.Thread):
+    """
+    Thread that appends queued rows to a csv file.
+    """
+
+    def __init__(self, filename, fieldnames, flush_interval=1.0, max_backlog=10000):
+        """
+        :param filename: the file to create
+        :param fieldnames: the column names, in the order of the values in each row
+        :param flush_interval: the longest time in seconds that written rows stay unsynced
+        :param max_backlog: the most row batches queued before write_rows waits for the writer
+        """
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.fieldnames = list(fieldnames)
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.error = None                                   # exception that stopped the writer, if any
+        self._queue = queue.Queue(max_backlog)
+
+    @property
+    def backlog(self):
+        """
+        :return: the number of row batches waiting to be written
+        """
+        return self._queue.qsize()
+
+    def write_rows(self, rows):
+        """
+        Queues rows to be appended to the file. Only blocks once max_backlog batches are waiting for the disk.
+
+        :param rows: a 2-D NumPy array or a list of rows, each row holding values in the order of fieldnames
+        :return: None
+        :raises Exception: the error that stopped the writer, if it has failed
+        """
+        self._put(rows)
+
+    def close(self, timeout=None):
+        """
+        Writes every queued row, syncs and closes the file.
+
+        :param timeout: seconds to wait for the writer to finish, or None to wait until it has
+        :return: None
+        :raises Exception: the error that stopped the writer, if it failed
+        """
+        if self.error is None:
+            self._put(None)                                 # rows queued before this are still written
+        if self.is_alive():
+            self.join(timeout)
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            self._open()
+            try:
+                last_sync = time.monotonic()
+                while True:
+                    try:
+                        rows = self._queue.get(timeout=self.flush_interval)
+                    except queue.Empty:
+                        rows = ()
+                    if rows is None:
+                        break
+                    if len(rows):
+                        self._write(rows)
+                        self.rows_written += len(rows)
+                    if time.monotonic() - last_sync >= self.flush_interval:
+                        self._sync()
+                        last_sync = time.monotonic()
+                self._sync()
+            finally:
+                self._close_files()
+            self._finish()
+        except Exception as error:                          # raised again by write_rows and close
+            self.error = error
+
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self._queue.put(item, timeout=self.flush_interval)
+                return
+            except queue.Full:                              # the disk is behind: wait for the writer to catch up
+                if self.ident is not None and not self.is_alive() and self.error is None:   # finished by close()
+                    raise RuntimeError(f"recording {self.filename} is closed")
+
+    def _open(self):
+        self._file = open(self.filename, mode='w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.fieldnames)
+
+    def _write(self, rows):
+        self._writer.writerows(rows.tolist() if isinstance(rows, np.ndarray) else rows)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_files(self):
+        self._file.close()
+
+    def _finish(self):
+        pass
+
+
+class ColumnarRecorder(Recorder):
+    """
+    Thread that appends queued rows column by column to a directory of binary files.
+
+    ...
+    Each batch of rows is split into columns, converted to that column's dtype and appended to its file as one
+        chunk. meta.json is written when the recording opens, so a crashed run can still be loaded, and rewritten
+        with the final row count when it closes.
+    """
+
+    def __init__(self, filename, fieldnames, flush_interval=1.0, dtypes=None, metadata=None, compress=False,
+                 max_backlog=10000):
+        """
+        :param filename: the directory to create, by convention ending in .cols
+        :param fieldnames: the column names, in the order of the values in each row
+        :param flush_interval: the longest time in seconds that written rows stay unsynced
+        :param dtypes: a dict of column name to NumPy dtype. Columns not listed are stored as float64
+        :param metadata: a dict of JSON-serializable run information stored alongside the columns
+        :param compress: True to pack the columns into a compressed columns.npz when the recording closes
+        :param max_backlog: the most row batches queued before write_rows waits for the writer
+        """
+        super().__init__(filename, fieldnames, flush_interval, max_backlog)
+        dtypes = dtypes or {}
+        self.dtypes = {name: np.dtype(dtypes.get(name, "<f8")).newbyteorder("<") for name in self.fieldnames}
+        self.metadata = dict(metadata or {})
+        self.compress = compress
+        self._compressed = False
+
+    def _open(self):
+        os.makedirs(self.filename)
+        self._write_meta()
+        self._files = [open(os.path.join(self.filename, f"{name}.bin"), mode='wb') for name in self.fieldnames]
+
+    def _write(self, rows):
+        rows = np.asarray(rows)
+        for column, (file, name) in enumerate(zip(self._files, self.fieldnames)):
+            file.write(rows[:, column].astype(self.dtypes[name]).tobytes())
+
+    def _sync(self):
+        for file in self._files:
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _close_files(self):
+        for file in self._files:
+            file.close()
+
+    def _finish(self):
+        if self.compress:
+            columns = load_columnar(self.filename)[0]
+            np.savez_compressed(os.path.join(self.filename, "columns.npz"), **columns)
+            del columns                                     # release the memory maps before deleting their files
+            for name in self.fieldnames:
+                os.remove(os.path.join(self.filename, f"{name}.bin"))
+            self._compressed = True
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {
+            "columns": self.fieldnames,
+            "dtypes": {name: dtype.str for name, dtype in self.dtypes.items()},
+            "rows": self.rows_written,
+            "compressed": self._compressed,
+            "metadata": self.metadata,
+        }
+        with open(os.path.join(self.filename, "meta.json"), mode='w') as file:
+            json.dump(meta, file, indent=2)
+
+
+def next_filename(folder, prefix="recorded_data", extension=".csv"):
+    """
+    Returns the first unused numbered filename in a folder
+
+    ...
+    The folder is listed once and the number after the highest existing '<prefix>_<N><extension>' is used.
+
+    :param folder: the folder to look in
+    :param prefix: the part of the name before the number
+    :param extension: the part of the name after the number
+    :return: the path of the form folder/prefix_N.extension
+    """
+    pattern = re.compile(re.escape(prefix) + r"_(\d+)" + re.escape(extension) + "$")
+    numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(folder)) if match]
+    return os.path.join(folder, f"{prefix}_{max(numbers, default=0) + 1}{extension}")
+
+
+def load_columnar(filename):
+    """
+    Loads a ColumnarRecorder recording as a dict of NumPy arrays and its metadata
+
+    ...
+    Uncompressed columns are memory-mapped read-only, so nothing is read from disk until it is used. The row count
+        is taken from the shortest column file, which also recovers recordings that were never closed. Compressed
+        recordings are decompressed into memory.
+
+    :param filename: the recording directory
+    :return: (columns, metadata) where columns is a dict of column name to array
+    """
+    with open(os.path.join(filename, "meta.json")) as file:
+        meta = json.load(file)
+
+    archive = os.path.join(filename, "columns.npz")
+    if os.path.exists(archive):
+        with np.load(archive) as columns:
+            return {name: columns[name] for name in meta["columns"]}, meta["metadata"]
+
+    dtypes = {name: np.dtype(meta["dtypes"][name]) for name in meta["columns"]}
+    paths = {name: os.path.join(filename, f"{name}.bin") for name in meta["columns"]}
+    rows = min(os.path.getsize(paths[name]) // dtypes[name].itemsize for name in meta["columns"])
+    columns = {}
+    for name in meta["columns"]:
+        if rows:
+            columns[name] = np.memmap(paths[name], dtype=dtypes[name], mode='r', shape=(rows,))
+        else:
+            columns[name] = np.empty(0, dtype=dtypes[name])     # np.memmap cannot map an empty file
+    return columns, meta["metadata"]
@@ -0,0 +1,163 @@
+"""
+This module contains a fixed-length rolling window over one or more channels of sensor data
+
+...
+Samples are stored in a preallocated NumPy ring buffer, one column per channel. Running sums are updated as samples
+enter and leave, so the mean and standard deviation cost the same whatever the window size. The sums are recomputed
+from the buffer once per window length to stop floating point drift.
+
+Classes:
+
+    RollingWindow(window_size, num_channels, ema_alpha)
+        Ring buffer with O(1) mean/std-dev, an exponential moving average and min/max per channel
+
+"""
+import numpy as np
+
+
+class RollingWindow:
+    """
+    Ring buffer with O(1) mean/std-dev, an exponential moving average and min/max per channel.
+
+    ...
+    Empty slots are kept at zero so that the value leaving a slot can always be subtracted from the running sums,
+        whether or not the window has filled yet.
+    """
+
+    def __init__(self, window_size, num_channels=1, ema_alpha=None):
+        """
+        :param window_size: the number of most recent samples kept
+        :param num_channels: the number of columns, one per signal
+        :param ema_alpha: smoothing factor of the exponential moving average. Defaults to 2 / (window_size + 1)
+        """
+        self.window_size = window_size
+        self.num_channels = num_channels
+        self.ema_alpha = 2 / (window_size + 1) if ema_alpha is None else ema_alpha
+        self.buffer = np.zeros((window_size, num_channels))
+        self.clear()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        """
+        Empties the window.
+
+        :return: None
+        """
+        self.buffer[:] = 0
+        self.index = 0                                      # slot the next sample is written to
+        self.count = 0                                      # number of valid samples, at most window_size
+        self._sum = np.zeros(self.num_channels)
+        self._sum_sq = np.zeros(self.num_channels)
+        self._since_resum = 0
+        self._ema = None
+
+    def fill(self, values):
+        """
+        Fills the whole window with the same sample, e.g. to start the differential pressure at its tare value.
+
+        :param values: one value per channel, or a single value for every channel
+        :return: None
+        """
+        self.buffer[:] = values
+        self.index = 0
+        self.count = self.window_size
+        self._resum()
+        self._ema = self.buffer[0].copy()
+
+    def append(self, values):
+        """
+        Adds one sample.
+
+        :param values: one value per channel
+        :return: None
+        """
+        self.extend(np.reshape(values, (1, self.num_channels)))
+
+    def extend(self, rows):
+        """
+        Adds many samples at once, oldest first.
+
+        :param rows: an array of shape (n, num_channels), or shape (n,) for a single channel window
+        :return: None
+        """
+        rows = np.asarray(rows, dtype=float).reshape(-1, self.num_channels)
+        if not len(rows):
+            return
+        self._update_ema(rows)
+
+        kept = rows[-self.window_size:]                     # older rows would be overwritten in the same call
+        slots = (self.index + np.arange(len(kept))) % self.window_size
+        outgoing = self.buffer[slots]
+        self._sum += kept.sum(axis=0) - outgoing.sum(axis=0)
+        self._sum_sq += (kept ** 2).sum(axis=0) - (outgoing ** 2).sum(axis=0)
+        self.buffer[slots] = kept
+        self.index = (self.index + len(kept)) % self.window_size
+        self.count = min(self.count + len(kept), self.window_size)
+
+        self._since_resum += len(kept)
+        if self._since_resum >= self.window_size:
+            self._resum()
+
+    def values(self):
+        """
+        :return: the samples in the window, oldest first, as an array of shape (count, num_channels)
+        """
+        if self.count < self.window_size:
+            return self.buffer[:self.count].copy()
+        return np.roll(self.buffer, -self.index, axis=0)
+
+    def mean(self):
+        """
+        :return: the mean of each channel, or zeros when the window is empty
+        """
+        if not self.count:
+            return np.zeros(self.num_channels)
+        return self._sum / self.count
+
+    def std(self):
+        """
+        :return: the population standard deviation of each channel, or zeros when the window is empty
+        """
+        if not self.count:
+            return np.zeros(self.num_channels)
+        mean = self._sum / self.count
+        return np.sqrt(np.maximum(self._sum_sq / self.count - mean ** 2, 0))
+
+    def min(self):
+        """
+        :return: the minimum of each channel, or zeros when the window is empty
+        """
+        if not self.count:
+            return np.zeros(self.num_channels)
+        return self.buffer[:self.count].min(axis=0)
+
+    def max(self):
+        """
+        :return: the maximum of each channel, or zeros when the window is empty
+        """
+        if not self.count:
+            return np.zeros(self.num_channels)
+        return self.buffer[:self.count].max(axis=0)
+
+    def ema(self):
+        """
+        :return: the exponential moving average of each channel over every sample added, or zeros when empty
+        """
+        if self._ema is None:
+            return np.zeros(self.num_channels)
+        return self._ema.copy()
+
+    def _update_ema(self, rows):
+        if self._ema is None:
+            self._ema = rows[0].copy()
+            rows = rows[1:]
+        decay = 1 - self.ema_alpha
+        weights = decay ** np.arange(len(rows) - 1, -1, -1)    # newest row has weight 1
+        self._ema = decay ** len(rows) * self._ema + self.ema_alpha * (weights @ rows)
+
+    def _resum(self):
+        self._sum = self.buffer.sum(axis=0)
+        self._sum_sq = (self.buffer ** 2).sum(axis=0)
+        self._since_resum = 0
@@ -0,0 +1,510 @@
+"""
+This module simulates an Adafruit feather running feather_backup/code.py, for testing and benchmarking without the
+wind tunnel
+
+...
+SimulatedFeather runs the firmware's command loop on a thread and answers the same commands (<D,n>, <P,v>, <S,rate>,
+<X>, <F,f>, <A,n,m> and <I,bmp,aht>), alone or batched in one frame such as <P,v;D,n>, with the same ascii or binary
+frames. Sensor values come from TunnelModel, a
+first order model of the fan and test section: duty cycle sets a target velocity, the air speed lags towards it, and
+the differential pressure follows 0.5 * rho * v^2 plus an offset and noise. Frames pass through LinkBuffer, which can
+add latency and limit bandwidth like the USB link.
+
+The feather can be used in-process through SimulatedPort objects, which behave like the pyserial ports feathercom
+expects, or exposed on a pair of pseudo terminals so that unmodified programs can open it by name.
+
+Classes:
+
+    TunnelModel(max_velocity, stall_duty, time_constant, dp_offset, dp_noise, pressure, temperature, humidity, seed)
+        Physics of the fan, test section and sensors
+
+    LinkBuffer(latency, bandwidth)
+        Byte queue from the feather to the pc with optional latency and bandwidth limit
+
+    SimulatedFeather(model, sample_time, latency, bandwidth, lwlp_time)
+        Thread running the firmware's command loop against a TunnelModel
+
+    SimulatedPort(feather, role, timeout)
+        pyserial-like port object for the console or data side of a SimulatedFeather
+
+Functions:
+
+    open_simulated_ports(**kwargs)
+        Starts a SimulatedFeather and returns its (console_port, data_port)
+
+    serve_pty(feather)
+        Exposes a SimulatedFeather on two pseudo terminals (Linux/macOS only)
+
+Usage:
+
+    python python_files/simulator.py [--sample_time 0.005] [--lwlp_time 0.001] [--latency 0.001] [--bandwidth 100000]
+
+"""
+import argparse
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+BINARY_SYNC = b"\xa5\x5a"  # must match feather_backup/code.py and feathercom
+COMMAND = re.compile(rb"<([^<>]*)>")
+
+
+class TunnelModel:
+    """
+    Physics of the fan, test section and sensors.
+
+    ...
+    The target velocity is zero below stall_duty and rises linearly to max_velocity at full duty. The air speed
+        approaches the target with the given time constant. Ambient readings are constant apart from sensor noise.
+    """
+
+    def __init__(self, max_velocity=20.0, stall_duty=0.1, time_constant=2.0, dp_offset=2.0, dp_noise=0.05,
+                 pressure=1013.25, temperature=22.0, humidity=40.0, seed=None):
+        """
+        :param max_velocity: air speed in m/s at 100% duty
+        :param stall_duty: the duty fraction below which the fan does not turn
+        :param time_constant: seconds for the air speed to cover 63% of a step in target
+        :param dp_offset: the differential pressure sensor's zero offset in Pa, removed by taring
+        :param dp_noise: the standard deviation of the differential pressure noise in Pa
+        :param pressure: ambient pressure in hPa
+        :param temperature: ambient temperature in degrees C
+        :param humidity: relative humidity in %
+        :param seed: seed for the noise, for repeatable runs
+        """
+        self.max_velocity = max_velocity
+        self.stall_duty = stall_duty
+        self.time_constant = time_constant
+        self.dp_offset = dp_offset
+        self.dp_noise = dp_noise
+        self.pressure = pressure
+        self.temperature = temperature
+        self.humidity = humidity
+        self.random = random.Random(seed)
+        self.duty_cycle = 0
+        self.velocity = 0.0
+        self._last_time = None
+
+    @property
+    def density(self):
+        """
+        :return: dry air density in kg/m^3 from the ambient pressure and temperature
+        """
+        return self.pressure * 100 / (287.058 * (self.temperature + 273.15))
+
+    def target_velocity(self):
+        """
+        :return: the steady state air speed in m/s for the current duty cycle
+        """
+        duty = self.duty_cycle / 65535
+        if duty <= self.stall_duty:
+            return 0.0
+        return self.max_velocity * (duty - self.stall_duty) / (1 - self.stall_duty)
+
+    def set_duty(self, duty_cycle):
+        """
+        :param duty_cycle: a value between 0 and 65535, as sent by <P,v>
+        :return: None
+        """
+        self.duty_cycle = min(max(int(duty_cycle), 0), 65535)
+
+    def sample(self, now=None, dp_reads=1, ambient_reads=1):
+        """
+        Advances the model to 'now' and reads every sensor.
+
+        :param now: the time in seconds, defaults to time.monotonic()
+        :param dp_reads: the number of differential pressure reads averaged, which divides the noise by sqrt(dp_reads)
+        :param ambient_reads: the number of bmp and aht reads averaged, which divides their noise the same way
+        :return: a list in the form [bmp pressure, bmp temp, aht hum, aht temp, lwlp pressure, lwlp temp]
+        """
+        now = time.monotonic() if now is None else now
+        if self._last_time is not None and self.time_constant > 0:
+            blend = 1 - math.exp(-(now - self._last_time) / self.time_constant)
+            self.velocity += (self.target_velocity() - self.velocity) * blend
+        elif self.time_constant <= 0:
+            self.velocity = self.target_velocity()
+        self._last_time = now
+
+        gauss = self.random.gauss
+        dp = 0.5 * self.density * self.velocity * abs(self.velocity) + self.dp_offset + \
+            gauss(0, self.dp_noise / math.sqrt(dp_reads))
+        ambient = 1 / math.sqrt(ambient_reads)
+        return [
+            self.pressure + gauss(0, 0.02 * ambient),
+            self.temperature + gauss(0, 0.01 * ambient),
+            self.humidity + gauss(0, 0.1 * ambient),
+            self.temperature + gauss(0, 0.02 * ambient),
+            dp,
+            self.temperature + gauss(0, 0.05),
+        ]
+
+
+class LinkBuffer:
+    """
+    Byte queue from the feather to the pc with optional latency and bandwidth limit.
+
+    ...
+    Each chunk put on the link becomes readable once the link has finished sending everything before it, plus its
+        own length divided by the bandwidth, plus the latency.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        """
+        :param latency: seconds between a byte leaving the feather and arriving at the pc
+        :param bandwidth: bytes per second, or None for unlimited
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._in_flight = deque()                           # (ready_time, bytes), in order
+        self._ready = bytearray()
+        self._free_at = 0.0                                 # time the link finishes its current chunk
+        self._condition = threading.Condition()
+
+    def put(self, data):
+        """
+        :param data: bytes sent by the feather
+        :return: None
+        """
+        with self._condition:
+            now = time.monotonic()
+            sent = max(now, self._free_at)
+            if self.bandwidth:
+                sent += len(data) / self.bandwidth
+            self._free_at = sent
+            self._in_flight.append((sent + self.latency, bytes(data)))
+            self._condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        """
+        :return: the number of bytes that have arrived and not been read
+        """
+        with self._condition:
+            self._deliver(time.monotonic())
+            return len(self._ready)
+
+    def read(self, size, timeout=None):
+        """
+        Waits until 'size' bytes have arrived or the timeout runs out, like pyserial's read.
+
+        :param size: the number of bytes wanted
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return: up to 'size' bytes
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._deliver(now)
+                if len(self._ready) >= size or (deadline is not None and now >= deadline):
+                    data = bytes(self._ready[:size])
+                    del self._ready[:size]
+                    return data
+                waits = [deadline - now] if deadline is not None else []
+                if self._in_flight:
+                    waits.append(self._in_flight[0][0] - now)
+                self._condition.wait(min(waits) if waits else None)
+
+    def reset(self):
+        """
+        Discards every byte in flight or waiting to be read.
+
+        :return: None
+        """
+        with self._condition:
+            self._in_flight.clear()
+            self._ready.clear()
+
+    def _deliver(self, now):
+        while self._in_flight and self._in_flight[0][0] <= now:
+            self._ready += self._in_flight.popleft()[1]
+
+
+class SimulatedFeather(threading.Thread):
+    """
+    Thread running the firmware's command loop against a TunnelModel.
+    """
+
+    def __init__(self, model=None, sample_time=0.005, latency=0.0, bandwidth=None, lwlp_time=0.001):
+        """
+        :param model: the TunnelModel providing sensor values, a default model if None
+        :param sample_time: seconds the feather spends reading all sensors for one sample
+        :param latency: seconds between a byte leaving the feather and arriving at the pc
+        :param bandwidth: bytes per second from the feather to the pc, or None for unlimited
+        :param lwlp_time: the part of sample_time spent reading the lwlp, the rest is split between the bmp and aht
+        """
+        super().__init__(daemon=True)
+        self.model = TunnelModel() if model is None else model
+        self.sample_time = sample_time
+        self.output = LinkBuffer(latency, bandwidth)
+        self.streaming = False
+        self.stream_period = 0
+        self.frame_format = 0                               # 0 = ascii, 1 = binary, 2 = extended ascii
+        self.lwlp_reads = 1
+        self.ambient_reads = 1                              # bmp and aht reads averaged into each sample
+        self.lwlp_time = min(lwlp_time, sample_time)
+        self.sensor_intervals = [0.0, 0.0]                  # seconds between [bmp, aht] reads, 0 = every sample
+        self._ambient = [0.0, 0.0, 0.0, 0.0]                # cached [bmp pressure, bmp temp, aht hum, aht temp]
+        self._ambient_times = [None, None]                  # when the [bmp, aht] values were cached
+        self.sequence = 0
+        self._commands = bytearray()
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def receive(self, data):
+        """
+        Bytes written by the pc to the console port.
+
+        :param data: command bytes
+        :return: None
+        """
+        with self._condition:
+            self._commands += data
+            self._condition.notify_all()
+
+    def stop(self):
+        """
+        Stops the command loop.
+
+        :return: None
+        """
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self):
+        next_sample_time = 0
+        while not self._stop_event.is_set():
+            for command in self._take_commands():
+                if command[0] == 'S':
+                    next_sample_time = time.monotonic()
+                try:
+                    self.handle_command(command)
+                except (ValueError, IndexError):            # a malformed command is ignored, as by the firmware
+                    pass
+            if self.streaming and time.monotonic() >= next_sample_time:
+                self.send_data(1)
+                next_sample_time = max(next_sample_time + self.stream_period, time.monotonic())
+            elif not self.streaming:
+                with self._condition:
+                    if not COMMAND.search(self._commands) and not self._stop_event.is_set():
+                        self._condition.wait()              # nothing to do until a command arrives
+            else:
+                time.sleep(min(max(next_sample_time - time.monotonic(), 0), 0.001))
+
+    def handle_command(self, command):
+        """
+        Acts on a command the same way as the firmware's handle_command.
+
+        :param command: the command split on commas, e.g. ['D', '1']
+        :return: None
+        """
+        if command[0] == 'D':
+            self.send_data(int(command[1]))
+        elif command[0] == 'P':
+            self.model.set_duty(int(command[1]))
+        elif command[0] == 'S':
+            rate_hz = float(command[1])
+            self.stream_period = 1 / rate_hz if rate_hz > 0 else 0
+            self.streaming = True
+        elif command[0] == 'X':
+            self.streaming = False
+        elif command[0] == 'F':
+            self.frame_format = int(command[1])
+        elif command[0] == 'A':
+            self.lwlp_reads = max(int(command[1]), 1)
+            self.ambient_reads = max(int(command[2]), 1) if len(command) > 2 else 1
+        elif command[0] == 'I':
+            bmp_ms = max(int(command[1]), 0)
+            aht_ms = max(int(command[2]), 0) if len(command) > 2 else bmp_ms
+            self.sensor_intervals = [bmp_ms / 1000, aht_ms / 1000]
+
+    def send_data(self, num_samples):
+        """
+        Reads the model 'num_samples' times, taking sample_time for each, and puts the frames on the link.
+
+        ...
+        Like the firmware, the bmp and aht are only read when their interval has run out, and a sample that reuses
+            their cached values only takes lwlp_time. Each ambient sensor read takes ambient_reads times as long.
+
+        :param num_samples: number of samples to send
+        :return: None
+        """
+        ambient_time = (self.sample_time - self.lwlp_time) / 2 * self.ambient_reads    # per ambient sensor
+        for _ in range(num_samples):
+            now = time.monotonic()
+            sample = self.model.sample(now, dp_reads=self.lwlp_reads, ambient_reads=self.ambient_reads)
+            read_time = self.lwlp_time
+            for sensor, interval in enumerate(self.sensor_intervals):
+                read_at = self._ambient_times[sensor]
+                if read_at is None or now - read_at >= interval:
+                    self._ambient[2 * sensor:2 * sensor + 2] = sample[2 * sensor:2 * sensor + 2]
+                    self._ambient_times[sensor] = now
+                    read_time += ambient_time
+            if read_time:
+                time.sleep(read_time)
+            ages = [min(int((time.monotonic() - read_at) * 1000), 65535) for read_at in self._ambient_times]
+            self.output.put(self.frame(self._ambient + sample[4:], ages))
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+    def frame(self, sample, ages=(0, 0)):
+        """
+        :param sample: six sensor values
+        :param ages: the age in ms of the [bmp, aht] values
+        :return: the bytes the firmware would write for this sample in the current format
+        """
+        device_ms = int(time.monotonic() * 1000) & 0xFFFFFFFF
+        if self.frame_format == 1:
+            payload = struct.pack("<6fIIIHH", *sample, self.sequence, device_ms, self.lwlp_reads, *ages)
+            return BINARY_SYNC + payload + struct.pack("<I", zlib.crc32(payload))
+        if self.frame_format == 2:
+            sample = list(sample) + [self.sequence, device_ms, self.lwlp_reads, *ages]
+        return bytes("<" + ",".join(str(value) for value in sample) + ">", "ascii")
+
+    def _take_commands(self):
+        with self._condition:
+            end = self._commands.rfind(b">") + 1
+            commands = COMMAND.findall(self._commands, 0, end)
+            del self._commands[:end]
+        return [command.split(",") for frame in commands for command in frame.decode("ascii").split(";")]
+
+
+class SimulatedPort:
+    """
+    pyserial-like port object for the console or data side of a SimulatedFeather.
+
+    ...
+    Writes to either side go to the feather as commands. Reads come from the feather's data link; the console side
+        never has anything to read.
+    """
+
+    def __init__(self, feather, role, timeout=None):
+        """
+        :param feather: the SimulatedFeather to talk to
+        :param role: 'console' or 'data'
+        :param timeout: read timeout in seconds, or None to block like serial.Serial's default
+        """
+        self.feather = feather
+        self.role = role
+        self.timeout = timeout
+        self.name = f"simulated-{role}"
+        self.is_open = True
+
+    def write(self, data):
+        self.feather.receive(data)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return self.feather.output.in_waiting if self.role == 'data' else 0
+
+    def read(self, size=1):
+        if self.role != 'data':
+            if self.timeout is None:
+                threading.Event().wait()                    # a real console port would block forever too
+            time.sleep(self.timeout)
+            return b""
+        return self.feather.output.read(size, self.timeout)
+
+    def read_until(self, expected=b"\n", size=None):
+        line = bytearray()
+        while size is None or len(line) < size:
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+            if line.endswith(expected):
+                break
+        return bytes(line)
+
+    def reset_input_buffer(self):
+        if self.role == 'data':
+            self.feather.output.reset()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def open_simulated_ports(timeout=None, **kwargs):
+    """
+    Starts a SimulatedFeather and returns its (console_port, data_port)
+
+    :param timeout: read timeout of the returned ports, as for serial.Serial
+    :param kwargs: passed to SimulatedFeather, e.g. sample_time, latency, bandwidth or model
+    :return: (console_port, data_port) SimulatedPort objects. The feather is console_port.feather
+    """
+    feather = SimulatedFeather(**kwargs)
+    feather.start()
+    return SimulatedPort(feather, 'console', timeout), SimulatedPort(feather, 'data', timeout)
+
+
+def serve_pty(feather):
+    """
+    Exposes a SimulatedFeather on two pseudo terminals (Linux/macOS only)
+
+    ...
+    Programs open the returned device names with serial.Serial exactly as they would the feather's COM ports.
+        Two daemon threads copy commands from the console terminal to the feather and frames from the feather to
+        the data terminal.
+
+    :param feather: a started SimulatedFeather
+    :return: (console device name, data device name)
+    """
+    import tty                                              # only available on unix-like systems
+
+    console_master, console_slave = os.openpty()
+    data_master, data_slave = os.openpty()
+    for fd in (console_slave, data_slave):
+        tty.setraw(fd)
+
+    def pump_commands():
+        while True:
+            feather.receive(os.read(console_master, 4096))
+
+    def pump_frames():
+        while True:
+            data = feather.output.read(1)
+            data += feather.output.read(feather.output.in_waiting, 0)
+            os.write(data_master, data)
+
+    threading.Thread(target=pump_commands, daemon=True).start()
+    threading.Thread(target=pump_frames, daemon=True).start()
+    return os.ttyname(console_slave), os.ttyname(data_slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated feather on a pair of pseudo terminals')
+    parser.add_argument('--sample_time', type=float, default=0.005, help='Seconds to read all sensors once')
+    parser.add_argument('--lwlp_time', type=float, default=0.001, help='Seconds of sample_time spent on the lwlp')
+    parser.add_argument('--latency', type=float, default=0.0, help='Link latency in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Link bandwidth in bytes per second')
+    parser.add_argument('--max_velocity', type=float, default=20.0, help='Air speed in m/s at 100%% duty')
+    parser.add_argument('--time_constant', type=float, default=2.0, help='Air speed lag in seconds')
+    parser.add_argument('--dp_noise', type=float, default=0.05, help='Differential pressure noise in Pa')
+    parser.add_argument('--seed', type=int, default=None, help='Noise seed for repeatable runs')
+    args = parser.parse_args()
+
+    model = TunnelModel(max_velocity=args.max_velocity, time_constant=args.time_constant, dp_noise=args.dp_noise,
+                        seed=args.seed)
+    feather = SimulatedFeather(model, args.sample_time, args.latency, args.bandwidth, args.lwlp_time)
+    feather.start()
+    console_name, data_name = serve_pty(feather)
+    print(f"console port: {console_name}")
+    print(f"data port:    {data_name}")
+    print("Press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        feather.stop()
+
+
+if __name__ == '__main__':
+    main()
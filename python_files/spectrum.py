@@ -0,0 +1,127 @@
+"""
+This module contains the streaming spectral analysis of the full rate velocity signal
+
+...
+StreamingSpectrum keeps the samples it is given until a block of block_size has gathered, then cuts as many
+overlapping blocks as are complete, removes each block's mean, applies a Hann window and transforms them with one
+batched rfft. The power spectra of the most recent num_blocks blocks are averaged in a RollingWindow, which is the
+Welch estimate of the power spectral density, updated block by block rather than recomputed over the whole record.
+Each block's mean and variance are kept the same way, giving the mean velocity, the rms of its fluctuation and the
+turbulence intensity u'/U over the same blocks as the spectrum.
+
+The sample rate is taken from the sample times, so the feather's actual rate is used whatever was requested. Blocks
+assume evenly spaced samples: frames lost on the link are not filled in, and polled samples (no --stream_rate) are
+spaced as unevenly as the round trips that fetched them.
+
+Classes:
+
+    StreamingSpectrum(block_size, overlap, num_blocks)
+        Welch power spectral density, rms and turbulence intensity over overlapping blocks of a sample stream
+
+"""
+import numpy as np
+from rolling import RollingWindow
+
+
+class StreamingSpectrum:
+    """
+    Welch power spectral density, rms and turbulence intensity over overlapping blocks of a sample stream.
+
+    ...
+    The psd is one sided and scaled to density (units^2 / Hz), so its integral over frequency equals the variance
+        of the windowed fluctuation, close to rms() ** 2.
+    """
+
+    def __init__(self, block_size=1024, overlap=0.5, num_blocks=16):
+        """
+        :param block_size: samples per FFT block; the frequency resolution is sample_rate / block_size
+        :param overlap: the fraction of each block shared with the next, from 0 to below 1
+        :param num_blocks: the number of most recent blocks averaged
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError("overlap must be at least 0 and below 1")
+        self.block_size = block_size
+        self.step = max(1, int(round(block_size * (1 - overlap))))
+        self.num_blocks = num_blocks
+        self.window = np.hanning(block_size)
+        self.window_power = float((self.window ** 2).sum())
+        self.spectra = RollingWindow(num_blocks, block_size // 2 + 1)   # |rfft|^2 of each block
+        self.stats = RollingWindow(num_blocks, 2)                       # mean and variance of each block
+        self.sample_rate = None                             # Hz, from the sample times of the latest blocks
+        self.blocks = 0                                     # blocks transformed since the last clear
+        self._values = np.empty(0)
+        self._times = np.empty(0)
+
+    def clear(self):
+        """
+        Forgets every sample and block, e.g. after a new tare changes the velocity scale.
+
+        :return: None
+        """
+        self.spectra.clear()
+        self.stats.clear()
+        self.sample_rate = None
+        self.blocks = 0
+        self._values = np.empty(0)
+        self._times = np.empty(0)
+
+    def extend(self, times, values):
+        """
+        Adds samples and transforms every block they complete.
+
+        :param times: the sample times in seconds
+        :param values: the samples, e.g. velocities in m/s; non-finite samples are skipped
+        :return: the number of new blocks
+        """
+        values = np.asarray(values, dtype=float)
+        finite = np.isfinite(values)
+        self._values = np.concatenate((self._values, values[finite]))
+        self._times = np.concatenate((self._times, np.asarray(times, dtype=float)[finite]))
+        if len(self._values) < self.block_size:
+            return 0
+
+        num_new = (len(self._values) - self.block_size) // self.step + 1
+        index = np.arange(num_new)[:, None] * self.step + np.arange(self.block_size)
+        blocks = self._values[index]
+        span = self._times[index[-1, -1]] - self._times[0]
+        if span > 0:
+            self.sample_rate = index[-1, -1] / span
+        means = blocks.mean(axis=1)
+        fluctuation = blocks - means[:, None]
+        self.spectra.extend(np.abs(np.fft.rfft(fluctuation * self.window, axis=1)) ** 2)
+        self.stats.extend(np.column_stack((means, (fluctuation ** 2).mean(axis=1))))
+        self.blocks += num_new
+
+        consumed = num_new * self.step                      # the overlap stays for the next block
+        self._values = self._values[consumed:]
+        self._times = self._times[consumed:]
+        return num_new
+
+    def psd(self):
+        """
+        :return: (frequencies in Hz, power spectral density), both empty until a block is complete
+        """
+        if not self.blocks or not self.sample_rate:
+            return np.empty(0), np.empty(0)
+        density = self.spectra.mean() / (self.sample_rate * self.window_power)
+        density[1:-1 if self.block_size % 2 == 0 else None] *= 2    # one sided: fold the negative frequencies
+        return np.fft.rfftfreq(self.block_size, 1 / self.sample_rate), density
+
+    def mean(self):
+        """
+        :return: the mean of the averaged blocks, or nan until a block is complete
+        """
+        return self.stats.mean()[0] if self.blocks else np.nan
+
+    def rms(self):
+        """
+        :return: the rms of the fluctuation about each block's mean, or nan until a block is complete
+        """
+        return np.sqrt(self.stats.mean()[1]) if self.blocks else np.nan
+
+    def turbulence_intensity(self):
+        """
+        :return: rms() / |mean()|, or nan until a block is complete or while the mean is 0
+        """
+        mean = abs(self.mean())
+        return self.rms() / mean if mean > 0 else np.nan
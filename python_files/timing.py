@@ -0,0 +1,180 @@
+"""
+This module contains the bookkeeping that turns the feather's frame counters into host times and loss counts
+
+...
+Every frame from the feather carries a uint32 sequence number and a uint32 device time in ms taken when the sample was
+read. ClockSync maps device times onto the host clock, so each sample is stamped with when it was measured rather than
+when the GUI got round to it. SequenceTracker counts frames that never arrived.
+
+The host arrival time of a frame is its device time plus the clock offset plus a transport delay that is never
+negative. ClockSync keeps the smallest host - device difference seen in each bin of device time (the frames that
+waited least), and fits a line through those minima to get the offset and the drift between the two clocks.
+
+Classes:
+
+    ClockSync(bin_seconds, num_bins)
+        Estimates the offset and drift of the device clock against the host clock
+
+    SequenceTracker()
+        Counts frames received, lost and repeated from their sequence numbers
+
+"""
+from collections import deque
+import numpy as np
+
+WRAP = 1 << 32  # sequence numbers and device times are uint32
+
+
+def counter_step(raw, last):
+    """
+    Signed change of a uint32 counter, allowing for wrap-around
+
+    :param raw: the new raw counter value
+    :param last: the previous value, raw or unwrapped
+    :return: the shortest signed distance from last to raw modulo 2^32, between -2^31 and 2^31 - 1
+    """
+    return (raw - last + WRAP // 2) % WRAP - WRAP // 2
+
+
+class ClockSync:
+    """
+    Estimates the offset and drift of the device clock against the host clock.
+
+    ...
+    Frames are handled one by one in plain Python, which is faster than NumPy for the few frames that arrive per
+        read, and the line is only refitted when a bin's minimum changes. If the device clock jumps backwards (the
+        feather restarted), the estimate starts over.
+    """
+
+    def __init__(self, bin_seconds=1.0, num_bins=60):
+        """
+        :param bin_seconds: the span of device time each minimum delay point is taken from
+        :param num_bins: the number of recent bins the offset and drift are fitted over
+        """
+        self.bin_seconds = bin_seconds
+        self.num_bins = num_bins
+        self.offset = None                                  # host - device in seconds at reference_time
+        self.drift = 0.0                                    # extra host seconds per device second
+        self.reference_time = 0.0                           # device seconds the offset applies at
+        self.resets = 0
+        self._bins = deque(maxlen=num_bins)                 # [bin index, device seconds, host - device seconds]
+        self._last_ms = None                                # unwrapped device time of the latest frame
+
+    def reset(self):
+        """
+        Forgets every point, e.g. after the feather restarts.
+
+        :return: None
+        """
+        self.offset = None
+        self.drift = 0.0
+        self._bins.clear()
+        self._last_ms = None
+
+    def add(self, device_ms, host_time):
+        """
+        Adds frames that arrived together and returns their aligned host times.
+
+        :param device_ms: the raw uint32 device times of the frames, oldest first
+        :param host_time: the host time the frames were read
+        :return: a list of the host time each frame was measured at
+        """
+        device_times = []
+        changed = False
+        for raw in device_ms.tolist() if isinstance(device_ms, np.ndarray) else device_ms:
+            if self._last_ms is not None:
+                step = counter_step(raw, self._last_ms)
+                if step < 0:
+                    self.resets += 1
+                    self.reset()
+                    changed = True
+            self._last_ms = raw if self._last_ms is None else self._last_ms + step
+            device_time = self._last_ms / 1000
+            device_times.append(device_time)
+
+            point = [int(device_time // self.bin_seconds), device_time, host_time - device_time]
+            if self._bins and self._bins[-1][0] == point[0]:
+                if point[2] < self._bins[-1][2]:
+                    self._bins[-1] = point
+                    changed = True
+            else:
+                self._bins.append(point)
+                changed = True
+        if changed:
+            self._fit()
+        return [self.to_host_seconds(device_time) for device_time in device_times]
+
+    def to_host(self, device_ms):
+        """
+        :param device_ms: a raw uint32 device time near the most recent frame
+        :return: the matching host time, or device seconds if nothing has been added yet
+        """
+        unwrapped = device_ms if self._last_ms is None else self._last_ms + counter_step(device_ms, self._last_ms)
+        return self.to_host_seconds(unwrapped / 1000)
+
+    def to_host_seconds(self, device_time):
+        """
+        :param device_time: an unwrapped device time in seconds
+        :return: the matching host time
+        """
+        if self.offset is None:
+            return device_time
+        return device_time + self.offset + self.drift * (device_time - self.reference_time)
+
+    def _fit(self):
+        points = np.array([point[1:] for point in self._bins])
+        self.reference_time = float(points[-1, 0])
+        if len(points) < 3:                                 # too short a baseline for the drift to mean anything
+            self.drift = 0.0
+            self.offset = float(points[:, 1].min())
+            return
+        x = points[:, 0] - self.reference_time
+        y = points[:, 1]
+        x_mean = x.mean()
+        self.drift = float(((x - x_mean) * (y - y.mean())).sum() / ((x - x_mean) ** 2).sum())
+        self.offset = float(y.mean() - self.drift * x_mean)
+        self.offset = min(self.offset, float(points[-1, 1]))    # never place a sample after it arrived
+
+
+class SequenceTracker:
+    """
+    Counts frames received, lost and repeated from their sequence numbers.
+
+    ...
+    A sequence number that goes backwards by less than 2^31 means the feather restarted, and counting carries on from
+        the new number.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.lost = 0                                       # frames skipped in the sequence
+        self.repeated = 0                                   # frames that repeated the previous sequence number
+        self.resets = 0
+        self._last = None
+
+    def add(self, sequence):
+        """
+        :param sequence: the raw uint32 sequence numbers of newly received frames, oldest first
+        :return: the number of frames lost before and between these frames
+        """
+        lost = 0
+        for raw in sequence.tolist() if isinstance(sequence, np.ndarray) else sequence:
+            if self._last is not None:
+                step = counter_step(raw, self._last)
+                if step > 1:
+                    lost += step - 1
+                elif step == 0:
+                    self.repeated += 1
+                elif step < 0:
+                    self.resets += 1
+            self._last = raw
+            self.received += 1
+        self.lost += lost
+        return lost
+
+    def loss_fraction(self):
+        """
+        :return: lost / (received + lost), or 0 before any frames arrive
+        """
+        total = self.received + self.lost
+        return self.lost / total if total else 0.0
@@ -0,0 +1,80 @@
+import time
+import pytest
+from acquisition import AcquisitionWorker
+from feathercom import BAD_FRAMES
+from metrics import METRICS
+from simulator import open_simulated_ports
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["ascii", "binary"])
+@pytest.mark.parametrize("stream_rate", [None, 0], ids=["poll", "stream"])
+def test_worker_receives_samples_and_sets_the_fan(stream_rate, binary):
+    console_port, data_port = open_simulated_ports(timeout=1)
+    worker = AcquisitionWorker(console_port, data_port, stream_rate=stream_rate, binary=binary)
+    worker.set_pwm(30000)
+    worker.start()
+    try:
+        time.sleep(0.3)
+        samples = worker.drain()
+        assert worker.is_alive(), worker.error
+        assert len(samples) > 5
+        assert all(len(sample) == 6 for host_time, sample in samples)
+        assert console_port.feather.model.duty_cycle == 30000
+    finally:
+        worker.stop()
+        console_port.feather.stop()
+
+
+@pytest.fixture
+def metrics_enabled():
+    METRICS.enabled = True
+    yield
+    METRICS.enabled = False
+
+
+@pytest.mark.parametrize("stream_rate", [None, 0], ids=["poll", "stream"])
+def test_malformed_frames_are_counted_and_survived(metrics_enabled, stream_rate):
+    console_port, data_port = open_simulated_ports(timeout=1)
+    worker = AcquisitionWorker(console_port, data_port, stream_rate=stream_rate)
+    worker.start()
+    try:
+        time.sleep(0.3)
+        before = BAD_FRAMES.value
+        console_port.feather.output.put(b"<1,2,3>")
+        console_port.feather.output.put(b"<1,2,garbage,4,5,6,7,8,9,10,11>")
+        time.sleep(0.3)
+        worker.drain()
+        time.sleep(0.2)
+        assert worker.is_alive(), worker.error
+        assert worker.drain()                               # still receiving
+        assert BAD_FRAMES.value - before == 2
+    finally:
+        worker.stop()
+        console_port.feather.stop()
+
+
+class SilentPort:
+    """A port on a feather that never answers; reads wait for the timeout like pyserial's."""
+
+    def __init__(self):
+        self.timeout = None
+        self.in_waiting = 0
+
+    def write(self, data):
+        pass
+
+    def read(self, size=1):
+        time.sleep(self.timeout if self.timeout is not None else 60)
+        return b""
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["ascii", "binary"])
+@pytest.mark.parametrize("stream_rate", [None, 0], ids=["poll", "stream"])
+def test_worker_stops_while_the_feather_is_silent(stream_rate, binary):
+    port = SilentPort()
+    worker = AcquisitionWorker(port, port, stream_rate=stream_rate, binary=binary)
+    worker.start()
+    time.sleep(0.3)
+    worker.stop(timeout=1.0)
+    assert not worker.is_alive()
+    assert worker.error is None
@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK = os.path.join(ROOT, "python_files", "benchmark.py")
+
+
+@pytest.mark.parametrize("stage", ["window", "lcds", "plot", "record"])
+def test_gui_stages_run(stage, tmp_path):
+    pytest.importorskip("pyqtgraph")
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    result = subprocess.run([sys.executable, BENCHMARK, "--stages", stage, "--quick",
+                             "--output", str(tmp_path / "bench.json")],
+                            cwd=ROOT, env=env, capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from calibration import CalibrationJob
+
+
+def test_mean_and_sem_match_numpy_over_batches():
+    rng = np.random.default_rng(3)
+    data = rng.normal([101325.0, 22.0], [5.0, 0.1], size=(500, 2))
+    times = np.arange(500) * 0.01
+    job = CalibrationJob(2, max_samples=1000)
+    for start in range(0, 500, 37):
+        assert not job.add(times[start:start + 37], data[start:start + 37])
+    assert np.allclose(job.mean(), data.mean(axis=0))
+    assert np.allclose(job.std(), data.std(axis=0, ddof=1))
+    assert np.allclose(job.sem(), data.std(axis=0, ddof=1) / np.sqrt(500))
+    assert job.progress() == pytest.approx(0.5)
+
+
+def test_finishes_on_the_sample_limit():
+    job = CalibrationJob(max_samples=10)
+    assert job.add(np.arange(15.0), np.ones(15))
+    assert job.count == 10
+    assert job.progress() == 1.0
+
+
+def test_finishes_on_the_target_sem():
+    rng = np.random.default_rng(4)
+    job = CalibrationJob(target_sem=0.01, min_samples=10)
+    batches = 0
+    while not job.add(np.zeros(50), rng.normal(0, 0.1, 50)):
+        batches += 1
+        assert batches < 10
+    assert 50 <= job.count <= 200                           # sem 0.1 / sqrt(n) reaches 0.01 near n = 100
+
+
+def test_finishes_on_the_duration():
+    job = CalibrationJob(max_duration=1.0)
+    assert not job.add([0.0, 0.5], [1.0, 1.0])
+    assert job.add([1.0], [1.0])
+
+
+def test_cancelled_job_ignores_samples():
+    job = CalibrationJob(max_samples=10)
+    job.add([0.0], [1.0])
+    job.cancel()
+    assert not job.active
+    assert not job.add([1.0], [5.0])
+    assert job.count == 1
+
+
+def test_needs_a_way_to_finish():
+    with pytest.raises(ValueError):
+        CalibrationJob()
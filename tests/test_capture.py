@@ -0,0 +1,77 @@
+import time
+import numpy as np
+import pytest
+from acquisition import AcquisitionWorker
+from capture import CapturePort, ReplayPort, read_capture, replay, RECORD_HEADER, CAPTURE_MAGIC
+from simulator import open_simulated_ports
+
+
+class ListRecorder:
+    """Collects the rows replay() writes."""
+
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(np.asarray(rows).tolist())
+
+
+def write_capture(filename, records):
+    with open(filename, "wb") as file:
+        file.write(CAPTURE_MAGIC + b'{"binary": false}\n')
+        for host_time, payload in records:
+            file.write(RECORD_HEADER.pack(host_time, len(payload)) + payload)
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["ascii", "binary"])
+def capture_file(request, tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp("capture") / "run.fcap")
+    console_port, data_port = open_simulated_ports(timeout=1)
+    data_port = CapturePort(data_port, filename, metadata={"binary": request.param, "stream_rate": 0})
+    worker = AcquisitionWorker(console_port, data_port, stream_rate=0, binary=request.param)
+    worker.start()
+    time.sleep(1.5)
+    worker.stop()
+    data_port.close()
+    console_port.feather.stop()
+    return filename
+
+
+def test_capture_round_trip(capture_file):
+    metadata, records = read_capture(capture_file)
+    records = list(records)
+    assert "start_time" in metadata
+    assert records
+    assert all(earlier[0] <= later[0] for earlier, later in zip(records, records[1:]))
+
+
+def test_replay_processes_the_capture(capture_file):
+    recorder = ListRecorder()
+    result = replay(capture_file, 0, tare_seconds=0.5, recorder=recorder)
+    assert result["samples"] > 0
+    assert len(recorder.rows) == result["ticks"]
+
+
+def test_replay_is_the_same_at_any_speed(capture_file):
+    outputs = []
+    for speed in (0, 4):
+        recorder = ListRecorder()
+        result = replay(capture_file, speed, tare_seconds=0.5, recorder=recorder)
+        outputs.append(np.array(recorder.rows))
+        assert result["samples"] > 0
+    assert outputs[0].shape == outputs[1].shape
+    assert np.array_equal(outputs[0], outputs[1], equal_nan=True)
+
+
+def test_replay_port_keeps_record_boundaries(tmp_path):
+    filename = str(tmp_path / "records.fcap")
+    write_capture(filename, [(10.0, b"abc"), (10.01, b"de"), (10.02, b"fgh")])
+    port = ReplayPort(filename, speed=0)
+    assert port.in_waiting == 3
+    assert port.read(port.in_waiting) == b"abc"
+    assert port.time() == 10.0
+    assert port.read(4) == b"defg"                          # the last byte read is from the third record
+    assert port.time() == 10.02
+    assert port.read(port.in_waiting) == b"h"
+    with pytest.raises(EOFError):
+        port.read(1)
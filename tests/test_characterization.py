@@ -0,0 +1,47 @@
+import pytest
+from characterization import CharacterizationMap, load_characterization
+
+
+def sweep_map():
+    characterization = CharacterizationMap(density_tolerance=0.02, drift_tolerance=0.05)
+    characterization.add_sweep(1.18, [0.0, 0.1, 0.2, 0.5, 1.0], [0.0, 0.0, 2.0, 8.0, 15.0])
+    characterization.add_sweep(1.20, [0.0, 0.2, 0.5, 1.0], [0.0, 1.0, 7.0, 14.0])
+    return characterization
+
+
+def test_add_sweep_keeps_only_rising_points():
+    sweep = sweep_map().sweeps[0]
+    assert sweep["duty"] == [0.0, 0.2, 0.5, 1.0]
+    assert sweep["velocity"] == [0.0, 2.0, 8.0, 15.0]
+
+
+def test_add_sweep_needs_two_rising_points():
+    with pytest.raises(ValueError):
+        CharacterizationMap().add_sweep(1.2, [0.1, 0.2], [0.0, 0.0])
+
+
+def test_duty_for_interpolates_between_densities():
+    characterization = sweep_map()
+    assert characterization.duty_for(8.0, 1.18) == pytest.approx(0.5)
+    assert characterization.duty_for(8.0, 1.19) == pytest.approx((0.5 + (0.5 + 0.5 / 7)) / 2)
+    assert characterization.duty_for(16.0, 1.18) is None
+    assert characterization.duty_for(8.0, 1.30) is None
+
+
+def test_check_marks_drifted_sweeps_stale():
+    characterization = sweep_map()
+    assert characterization.check(8.0, 0.52, 1.18)
+    assert not characterization.check(8.0, 0.7, 1.18)
+    assert all(sweep["stale"] for sweep in characterization.bracket(1.18) + characterization.sweeps[:1])
+    assert characterization.duty_for(8.0, 1.18) is None
+
+
+def test_save_and_load(tmp_path):
+    filename = str(tmp_path / "maps" / "characterization.json")
+    characterization = sweep_map()
+    characterization.save(filename)
+    assert not characterization.changed
+    loaded = load_characterization(filename, drift_tolerance=0.1)
+    assert loaded.sweeps == characterization.sweeps
+    assert loaded.drift_tolerance == 0.1
+    assert load_characterization(str(tmp_path / "none.json")).sweeps == []
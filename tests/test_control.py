@@ -0,0 +1,85 @@
+import threading
+from control import VelocityController
+from characterization import CharacterizationMap
+
+
+def dp_for(speed, density=1.2):
+    """Differential pressure of air moving at 'speed' m/s, with a tare of 0."""
+    return 0.5 * density * speed * abs(speed)
+
+
+def test_holds_the_setpoint_of_a_lagging_fan():
+    controller = VelocityController()
+    controller.init_dp = 0.0
+    controller.setpoint = 8.0
+    speed, dt = 0.0, 0.01
+    for step in range(6000):
+        duty = controller.update(step * dt, dp_for(speed)) / 65535
+        speed += (20 * duty - speed) * dt / 0.5             # 20 m/s at full duty, 0.5 s lag
+    assert abs(speed - 8.0) < 0.1
+    assert abs(controller.velocity - 8.0) < 0.1
+
+
+def test_fan_is_off_until_tared_and_at_a_zero_setpoint():
+    controller = VelocityController()
+    controller.setpoint = 5.0
+    assert controller.update(0.0, 100.0) == 0
+    controller.init_dp = 0.0
+    controller.setpoint = 0.0
+    assert controller.update(1.0, 100.0) == 0
+    assert controller.duty == 0.0
+
+
+def test_duty_slews_at_most_max_rate():
+    controller = VelocityController(max_rate=0.5)
+    controller.init_dp = 0.0
+    controller.setpoint = 20.0
+    controller.update(0.0, 0.0)
+    controller.update(0.1, 0.0)
+    assert 0 < controller.duty <= 0.05 + 1e-9
+    assert controller.pwm() == int(round(controller.duty * 1000) * 65535 / 1000)
+
+
+def test_setpoint_waits_for_a_running_update():
+    controller = VelocityController()
+    controller.init_dp = 0.0
+    controller.setpoint = 5.0
+    controller._lock.acquire()                              # stands in for update() halfway through a step
+    setter = threading.Thread(target=setattr, args=(controller, "setpoint", 0.0))
+    setter.start()
+    setter.join(0.2)
+    assert setter.is_alive()
+    assert controller.setpoint == 5.0
+    controller._lock.release()
+    setter.join(1.0)
+    assert controller.setpoint == 0.0
+
+
+def test_setpoint_changes_from_another_thread_during_updates():
+    characterization = CharacterizationMap()
+    characterization.add_sweep(1.2, [0.1, 0.5, 1.0], [0.0, 8.0, 15.0])
+    controller = VelocityController(feed_forward=characterization, hold_time=0.05)
+    controller.init_dp = 0.0
+    stop = threading.Event()
+    errors = []
+
+    dp = dp_for(6.0)
+
+    def run():
+        now = 0.0
+        try:
+            while not stop.is_set():
+                now += 0.001
+                pwm = controller.update(now, dp)
+                assert 0 <= pwm <= 65535
+        except Exception as error:
+            errors.append(error)
+
+    worker = threading.Thread(target=run)
+    worker.start()
+    for index in range(2000):
+        controller.setpoint = (0.0, 4.0, 8.0, 12.0)[index % 4]
+    stop.set()
+    worker.join()
+    assert errors == []
+    assert controller.setpoint == 12.0
@@ -0,0 +1,45 @@
+import pytest
+import devices
+from devices import DeviceManager, FeatherPorts
+
+
+class FakeSerial:
+    """Serial port that records whether it is open and refuses names starting with 'bad'."""
+    opened = []
+
+    def __init__(self, name, baudrate):
+        if name.startswith("bad"):
+            raise OSError(f"could not open {name}")
+        self.name = name
+        self.is_open = True
+        FakeSerial.opened.append(self)
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def fake_serial(monkeypatch):
+    FakeSerial.opened = []
+    monkeypatch.setattr(devices.serial, "Serial", FakeSerial)
+    return FakeSerial
+
+
+@pytest.mark.parametrize("failing", [FeatherPorts("b", "2", "bad_console", "data_b"),
+                                     FeatherPorts("b", "2", "console_b", "bad_data")])
+def test_open_closes_every_port_when_one_fails(fake_serial, failing):
+    manager = DeviceManager()
+    feathers = [FeatherPorts("a", "1", "console_a", "data_a"), failing, FeatherPorts("c", "3", "console_c", "data_c")]
+    with pytest.raises(OSError):
+        manager.open(feathers)
+    assert fake_serial.opened
+    assert not any(port.is_open for port in fake_serial.opened)
+    assert manager.workers == []
+
+
+def test_open_adds_every_feather(fake_serial):
+    manager = DeviceManager()
+    feathers = [FeatherPorts("a", "1", "console_a", "data_a"), FeatherPorts("b", "2", "console_b", "data_b")]
+    assert manager.open(feathers) == [0, 1]
+    assert manager.names == ["a", "b"]
+    assert all(port.is_open for port in fake_serial.opened)
@@ -0,0 +1,68 @@
+import asyncio
+import numpy as np
+import pytest
+from feathercom import FeatherClient
+from simulator import open_simulated_ports
+
+
+@pytest.fixture
+def ports():
+    console_port, data_port = open_simulated_ports(timeout=0.05, sample_time=0.002)
+    yield console_port, data_port
+    console_port.feather.stop()
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["extended", "binary"])
+def test_pipelined_requests_get_their_own_frames(ports, binary):
+    async def run():
+        async with FeatherClient(*ports, binary=binary) as client:
+            replies = await asyncio.gather(*(client.request_data(count) for count in (1, 3, 2)))
+            return client, replies
+    client, replies = asyncio.run(run())
+    assert [len(reply) for reply in replies] == [1, 3, 2]
+    assert np.all(np.diff(np.concatenate([reply["sequence"] for reply in replies])) == 1)
+    assert (client.lost, client.bad, client.unexpected) == (0, 0, 0)
+
+
+def test_stream_yields_consecutive_frames(ports):
+    async def run():
+        received = []
+        async with FeatherClient(*ports) as client:
+            async for frames in client.stream(0):
+                received.append(frames)
+                if sum(map(len, received)) >= 20:
+                    break
+        return np.concatenate(received)
+    frames = asyncio.run(run())
+    assert len(frames) >= 20
+    assert np.all(np.diff(frames["sequence"]) == 1)
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["extended", "binary"])
+def test_request_after_stream(ports, binary):
+    async def run():
+        async with FeatherClient(*ports, binary=binary) as client:
+            streamed = None
+            async for frames in client.stream(0):
+                streamed = int(frames["sequence"][-1])
+                if streamed >= 20:
+                    break
+            await client.stop_stream()
+            reply = await client.request_data(3)
+            return client, streamed, reply
+    client, streamed, reply = asyncio.run(run())
+    assert len(reply) == 3
+    assert reply["sequence"][0] == streamed + client.flushed + 1     # nothing left over from the stream
+    assert client.unexpected == 0
+
+
+def test_request_while_streaming_is_refused(ports):
+    async def run():
+        async with FeatherClient(*ports) as client:
+            async for frames in client.stream(0):
+                with pytest.raises(RuntimeError):
+                    await client.request_data(1)
+                break
+            await client.stop_stream()
+            return await client.request_data(1)
+    assert len(asyncio.run(run())) == 1
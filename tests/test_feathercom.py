@@ -0,0 +1,118 @@
+import struct
+import zlib
+from itertools import islice
+import numpy as np
+from feathercom import parse_frames, request_data_array, decode_frames, decode_extended_frames, stream_data
+from feathercom import BINARY_DTYPE, BINARY_SYNC, EXTENDED_FIELDS
+
+
+def binary_frame(sequence, values=(1, 2, 3, 4, 5, 6)):
+    frame = np.zeros(1, dtype=BINARY_DTYPE)
+    frame["sync"] = BINARY_SYNC
+    frame["values"] = values
+    frame["sequence"] = sequence
+    raw = frame.tobytes()
+    return raw[:-4] + struct.pack("<I", zlib.crc32(raw[2:-4]))
+
+
+def extended_frame(sequence):
+    return bytes("<" + ",".join(str(value) for value in [1, 2, 3, 4, 5, 6, sequence, 1000, 1, 0, 0]) + ">", "ascii")
+
+
+class CannedPort:
+    """Data port whose reply arrives in the given chunks, one chunk per read."""
+
+    def __init__(self, *chunks):
+        self.chunks = [bytearray(chunk) for chunk in chunks]
+        self.written = b""
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size=1):
+        chunk = bytes(self.chunks[0][:size])
+        del self.chunks[0][:size]
+        if not self.chunks[0]:
+            self.chunks.pop(0)
+        return chunk
+
+    def write(self, data):
+        self.written += data
+
+
+def test_stream_data_yields_each_frame():
+    port = CannedPort(b"junk<1,2,3,4,5,6><7,8", b",9,10,11,12>")
+    samples = list(islice(stream_data(port), 2))
+    assert samples == [["1", "2", "3", "4", "5", "6"], ["7", "8", "9", "10", "11", "12"]]
+
+
+def test_parse_frames():
+    data, rest, bad = parse_frames(b"<1,2,3,4,5,6><7,8,9,10,11,12><1,2", 6)
+    assert data.tolist() == [[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]]
+    assert rest == b"<1,2"
+    assert bad == 0
+
+
+def test_parse_frames_drops_malformed_frames():
+    data, rest, bad = parse_frames(b"<1,2,3,4,5,6><1,2,garbage><1,2,3><7,8,9,10,11,12>", 6)
+    assert data.tolist() == [[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]]
+    assert bad == 2
+
+
+def test_parse_frames_short_and_long_frame_are_both_bad():
+    data, rest, bad = parse_frames(b"<1,2,3,4,5><6,7,8,9,10,11,12>", 6)
+    assert data.shape == (0, 6)
+    assert bad == 2
+
+
+def test_parse_frames_only_garbage():
+    data, rest, bad = parse_frames(b"<nan?>", 6)
+    assert data.shape == (0, 6)
+    assert bad == 1
+
+
+def test_request_data_array():
+    port = CannedPort(b"<1,2,3,4,5,6><7,8,", b"9,10,11,12>")
+    data = request_data_array(port, port, 2)
+    assert data.tolist() == [[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]]
+    assert port.written == b"<D,2>"
+
+
+def test_request_data_array_ignores_stray_terminator():
+    port = CannedPort(b">", b"<1,2,3,", b"4,5,6>")
+    data = request_data_array(port, port, 1)
+    assert data.tolist() == [[1, 2, 3, 4, 5, 6]]
+    assert port.written == b"<D,1>"
+
+
+def test_decode_frames_skips_bad_crc_and_garbage():
+    corrupt = bytearray(binary_frame(1))
+    corrupt[10] ^= 0xFF
+    buffer = b"junk" + binary_frame(0) + bytes(corrupt) + binary_frame(2) + binary_frame(3)[:20]
+    frames, rest, bad = decode_frames(buffer)
+    assert frames["sequence"].tolist() == [0, 2]
+    assert np.allclose(frames["values"][0], [1, 2, 3, 4, 5, 6])
+    assert bad == 1
+    assert rest == binary_frame(3)[:20]
+
+
+def test_decode_frames_split_sync():
+    frames, rest, bad = decode_frames(binary_frame(0) + BINARY_SYNC[:1])
+    assert len(frames) == 1
+    assert rest == BINARY_SYNC[:1]
+
+
+def test_decode_extended_frames_drops_malformed():
+    buffer = extended_frame(0) + b"<1,2,x>" + b"noise" + extended_frame(1) + b"<1,2"
+    frames, rest, bad = decode_extended_frames(buffer)
+    assert frames["sequence"].tolist() == [0, 1]
+    assert np.allclose(frames["values"][0], [1, 2, 3, 4, 5, 6])
+    assert bad == 1
+    assert rest == b"<1,2"
+
+
+def test_decode_extended_frames_field_count():
+    frames, rest, bad = decode_extended_frames(b"<" + b",".join([b"1"] * (EXTENDED_FIELDS + 1)) + b">")
+    assert len(frames) == 0
+    assert bad == 1
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from headless import ProfileRunner, FIELDNAMES, expand_profile
+from simulator import open_simulated_ports
+
+
+def test_expand_profile():
+    profile = {"repeat": 2, "steps": [
+        {"type": "tare", "duration": 4},
+        {"type": "sweep", "mode": "velocity", "from": 2, "to": 6, "step": 2, "dwell": 5},
+        {"type": "dwell", "duration": 3},
+        {"type": "ramp", "mode": "velocity", "from": 6, "to": 0, "duration": 10},
+    ]}
+    segments = expand_profile(profile)
+    assert len(segments) == 12
+    assert [segment["type"] for segment in segments[:6]] == ["tare", "hold", "hold", "hold", "hold", "ramp"]
+    assert [segment["start"] for segment in segments[1:5]] == [2, 4, 6, 6]
+    assert segments[4] == {"type": "hold", "mode": "velocity", "start": 6, "end": 6, "duration": 3}
+    assert (segments[5]["start"], segments[5]["end"], segments[5]["duration"]) == (6, 0, 10)
+    assert segments[6:] == segments[:6]
+
+
+@pytest.mark.parametrize("steps", [
+    [{"type": "step", "mode": "velocity", "value": 5, "dwell": 1}],
+    [{"type": "step", "mode": "rpm", "value": 5, "dwell": 1}],
+    [{"type": "hover", "value": 5}],
+], ids=["velocity before tare", "unknown mode", "unknown step"])
+def test_expand_profile_refuses(steps):
+    with pytest.raises(ValueError):
+        expand_profile({"steps": steps})
+
+
+class RowSink:
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.append(rows)
+
+
+def test_ramp_setpoint_is_taken_at_each_sample_time():
+    console_port, data_port = open_simulated_ports(sample_time=0)
+    try:
+        profile = {"steps": [{"type": "step", "value": 10, "dwell": 1},
+                             {"type": "ramp", "from": 20, "to": 60, "duration": 4}]}
+        runner = ProfileRunner(profile, console_port, data_port)
+        runner.recorder = RowSink()
+        runner.start_time = 1000.0
+        runner.segment_index = 1
+        runner.segment_start = 1001.0
+        times = np.array([1000.5, 1001.0, 1002.0, 1003.5, 1006.0])
+        data = np.tile([1013.25, 22.0, 40.0, 22.0, 0.0, 22.0], (len(times), 1))
+        runner.process(times, data)
+        rows = np.concatenate(runner.recorder.rows)
+        setpoints = rows[:, FIELDNAMES.index("setpoint")]
+        assert np.allclose(setpoints, [20, 20, 30, 45, 60])
+        assert np.allclose(rows[:, FIELDNAMES.index("time")], times - 1000.0)
+
+        runner.segment_index = 0
+        runner.process(times[:2], data[:2])
+        assert np.allclose(runner.recorder.rows[-1][:, FIELDNAMES.index("setpoint")], [10, 10])
+    finally:
+        console_port.feather.stop()
@@ -0,0 +1,69 @@
+import sys
+import threading
+import urllib.request
+import pytest
+from metrics import Registry, MetricsServer
+
+
+def test_counter_gauge_and_function_values():
+    registry = Registry()
+    counter = registry.counter("frames_total", "Frames")
+    counter.inc()
+    counter.inc(4)
+    gauge = registry.gauge("backlog", "Rows waiting")
+    gauge.set(7)
+    registry.gauge("depth", "Queue depth", lambda: 3)
+    assert registry.snapshot() == {"frames_total": 5, "backlog": 7, "depth": 3}
+    assert registry.counter("frames_total", "Frames") is counter
+
+
+def test_updates_from_several_threads_are_not_lost():
+    registry = Registry()
+    counter = registry.counter("frames_total", "Frames")
+    histogram = registry.histogram("seconds", "Durations", bounds=[1, 2, 4])
+
+    def update():
+        for _ in range(20000):
+            counter.inc()
+            histogram.observe(1.5)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)                             # switch threads as often as possible
+    try:
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert counter.value == 80000
+    assert histogram.totals() == ([0, 80000, 0, 0], 80000 * 1.5)
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Registry().histogram("seconds", "Durations", bounds=[1, 2, 4])
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(16.5)
+    assert histogram.quantile(0.4) == pytest.approx(1.5)          # half way through the (1, 2] bucket
+    assert histogram.quantile(1.0) == 4
+
+
+def test_render_and_serve():
+    registry = Registry()
+    registry.counter("frames_total", "Frames").inc(2)
+    registry.histogram("seconds", "Durations", bounds=[1]).observe(0.5)
+    text = registry.render()
+    assert "# TYPE frames_total counter\nframes_total 2\n" in text
+    assert 'seconds_bucket{le="1"} 1\nseconds_bucket{le="+Inf"} 1\n' in text
+    server = MetricsServer(registry, port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5) as response:
+            assert response.read().decode() == registry.render()
+    finally:
+        server.stop()
@@ -0,0 +1,29 @@
+import math
+import numpy as np
+import pytest
+from physics import density, dynamic_pressure, velocity, velocity_uncertainty
+
+
+def test_density_of_dry_and_humid_air():
+    assert density(101325.0, 15.0) == pytest.approx(1.225, abs=1e-3)      # ISA sea level
+    humid = density(101325.0, 25.0, 80.0)
+    assert humid < density(101325.0, 25.0)                                 # water vapour is lighter than air
+    assert density([101325.0, 90000.0], [15.0, 15.0]).shape == (2,)
+
+
+def test_velocity_keeps_the_sign_of_q():
+    q = np.array([-60.0, 0.0, 60.0])
+    assert np.allclose(velocity(q, 1.2), [-10.0, 0.0, 10.0])
+    assert velocity(60.0, 1.2) == pytest.approx(10.0)                      # scalar path
+    assert velocity(-60.0, 1.2) == pytest.approx(-10.0)
+
+
+def test_dynamic_pressure_before_a_tare_is_nan():
+    assert np.isnan(dynamic_pressure([5.0], None)).all()
+    assert np.allclose(dynamic_pressure([5.0, 7.0], 2.0), [3.0, 5.0])
+
+
+def test_velocity_uncertainty():
+    q, dens, q_sigma = 60.0, 1.2, 0.6
+    assert velocity_uncertainty(q, dens, q_sigma) == pytest.approx(0.5 * 10.0 * q_sigma / q)
+    assert velocity_uncertainty(0.0, dens, q_sigma) == pytest.approx(math.sqrt(2 * q_sigma / dens))
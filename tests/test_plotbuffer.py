@@ -0,0 +1,42 @@
+import numpy as np
+from plotbuffer import PlotBuffer
+
+
+def test_append_grows_and_keeps_every_point():
+    buffer = PlotBuffer(capacity=4)
+    for index in range(10):
+        buffer.append(index, 2 * index)
+    x, y = buffer.data()
+    assert x.tolist() == list(range(10))
+    assert y.tolist() == [2 * index for index in range(10)]
+    assert buffer.x_range() == (0, 9)
+
+
+def test_max_age_bounds_the_buffer():
+    buffer = PlotBuffer(capacity=8, max_age=5)
+    for index in range(1000):
+        buffer.append(index, -index)
+    x, y = buffer.data()
+    assert x[-1] == 999
+    assert np.all(np.diff(x) == 1)
+    assert np.array_equal(y, -x)
+    assert x[0] <= 999 - 5                                  # nothing younger than max_age is discarded
+    assert len(buffer) <= 16
+
+
+def test_max_age_keeps_young_points_after_x_steps_back():
+    buffer = PlotBuffer(capacity=8, max_age=10)
+    for x in [50, 51, 0, 1, 2, 3, 4, 5]:                    # the clock estimate stepped back after 51
+        buffer.append(x, x)
+    buffer.append(52, 52)
+    x, y = buffer.data()
+    assert x.tolist() == [50, 51, 52]
+    assert np.array_equal(y, x)
+
+
+def test_clear():
+    buffer = PlotBuffer()
+    buffer.append(1.0, 2.0)
+    buffer.clear()
+    assert len(buffer) == 0
+    assert buffer.x_range() == (0, 0)
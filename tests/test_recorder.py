@@ -0,0 +1,73 @@
+import csv
+import time
+import numpy as np
+import pytest
+from recorder import Recorder, ColumnarRecorder, next_filename, load_columnar
+
+
+def test_csv_recorder_writes_every_row(tmp_path):
+    recorder = Recorder(str(tmp_path / "run.csv"), ["a", "b"], flush_interval=0.01)
+    recorder.start()
+    recorder.write_rows(np.array([[1.0, 2.0], [3.0, 4.0]]))
+    recorder.write_rows([[5, 6]])
+    recorder.close()
+    assert recorder.error is None
+    with open(tmp_path / "run.csv", newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows == [["a", "b"], ["1.0", "2.0"], ["3.0", "4.0"], ["5", "6"]]
+    assert recorder.rows_written == 3
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_columnar_recorder_round_trip(tmp_path, compress):
+    filename = str(tmp_path / "run.cols")
+    recorder = ColumnarRecorder(filename, ["time", "sequence"], flush_interval=0.01, dtypes={"sequence": "<u4"},
+                                metadata={"port": "sim"}, compress=compress)
+    recorder.start()
+    rows = np.column_stack([np.linspace(0, 1, 25), np.arange(25)])
+    recorder.write_rows(rows[:10])
+    recorder.write_rows(rows[10:])
+    recorder.close()
+    assert recorder.error is None
+    columns, metadata = load_columnar(filename)
+    assert metadata == {"port": "sim"}
+    assert np.array_equal(columns["time"], rows[:, 0])
+    assert columns["sequence"].dtype == np.dtype("<u4")
+    assert np.array_equal(columns["sequence"], np.arange(25))
+
+
+def test_recorder_error_is_kept_and_raised(tmp_path):
+    recorder = Recorder(str(tmp_path / "missing" / "run.csv"), ["a"])
+    recorder.start()
+    recorder.join()
+    assert isinstance(recorder.error, OSError)
+    with pytest.raises(OSError):
+        recorder.write_rows([[1]])
+    with pytest.raises(OSError):
+        recorder.close()
+
+
+class SlowRecorder(Recorder):
+    """A recorder on a disk slower than the rows arrive."""
+
+    def _write(self, rows):
+        time.sleep(0.02)
+        super()._write(rows)
+
+
+def test_backlog_is_bounded(tmp_path):
+    recorder = SlowRecorder(str(tmp_path / "run.csv"), ["a"], flush_interval=0.01, max_backlog=2)
+    recorder.start()
+    backlogs = []
+    for index in range(10):
+        recorder.write_rows([[index]])
+        backlogs.append(recorder.backlog)
+    recorder.close()
+    assert max(backlogs) <= 2
+    assert recorder.rows_written == 10
+
+
+def test_next_filename(tmp_path):
+    for name in ("recorded_data_1.csv", "recorded_data_7.csv", "recorded_data_x.csv", "other_9.csv"):
+        (tmp_path / name).touch()
+    assert next_filename(str(tmp_path)) == str(tmp_path / "recorded_data_8.csv")
@@ -0,0 +1,43 @@
+import numpy as np
+from rolling import RollingWindow
+
+
+def test_statistics_match_numpy_after_wrapping():
+    rng = np.random.default_rng(1)
+    window = RollingWindow(50, num_channels=3)
+    data = rng.normal(10, 2, size=(237, 3))
+    for start in range(0, len(data), 17):
+        window.extend(data[start:start + 17])
+    kept = data[-50:]
+    assert np.array_equal(window.values(), kept)
+    assert np.allclose(window.mean(), kept.mean(axis=0))
+    assert np.allclose(window.std(), kept.std(axis=0))
+    assert np.array_equal(window.min(), kept.min(axis=0))
+    assert np.array_equal(window.max(), kept.max(axis=0))
+
+
+def test_partial_window_and_empty():
+    window = RollingWindow(10)
+    assert np.array_equal(window.mean(), [0])
+    window.extend([1, 2, 3])
+    assert len(window) == 3
+    assert np.allclose(window.mean(), [2])
+    assert np.array_equal(window.min(), [1])
+
+
+def test_ema_is_the_same_one_by_one_or_in_a_batch():
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(40, 2))
+    single, batch = RollingWindow(8, 2), RollingWindow(8, 2)
+    for row in data:
+        single.append(row)
+    batch.extend(data)
+    assert np.allclose(single.ema(), batch.ema())
+
+
+def test_fill_sets_every_slot():
+    window = RollingWindow(5, 2)
+    window.fill([3.0, -1.0])
+    assert len(window) == 5
+    assert np.allclose(window.mean(), [3, -1])
+    assert np.allclose(window.std(), [0, 0])
@@ -0,0 +1,55 @@
+import numpy as np
+from simulator import TunnelModel, SimulatedFeather, open_simulated_ports
+
+
+def test_model_follows_the_duty_cycle():
+    model = TunnelModel(time_constant=0, seed=1)
+    model.set_duty(65535)
+    samples = np.array([model.sample(float(index)) for index in range(200)])
+    expected = 0.5 * model.density * model.velocity ** 2 + model.dp_offset
+    assert model.velocity == model.target_velocity()
+    assert abs(samples[:, 4].mean() - expected) < 0.05
+
+
+def test_simulated_ports_answer_commands():
+    console_port, data_port = open_simulated_ports(timeout=1, sample_time=0)
+    try:
+        console_port.write(b"<P,65535>")
+        console_port.write(b"<D,3>")
+        frames = [data_port.read_until(b">") for _ in range(3)]
+        assert all(len(frame.strip(b"<>").split(b",")) == 6 for frame in frames)
+        assert console_port.feather.model.duty_cycle == 65535
+    finally:
+        console_port.feather.stop()
+
+
+def test_malformed_commands_are_ignored():
+    console_port, data_port = open_simulated_ports(timeout=1, sample_time=0)
+    try:
+        console_port.write(b"<P,abc>")
+        console_port.write(b"<S>")
+        console_port.write(b"<P,1000;D,1>")
+        frame = data_port.read_until(b">")
+        assert len(frame.strip(b"<>").split(b",")) == 6
+        assert console_port.feather.model.duty_cycle == 1000
+        assert console_port.feather.is_alive()
+    finally:
+        console_port.feather.stop()
+
+
+def test_averaging_command_sets_both_read_counts():
+    feather = SimulatedFeather(sample_time=0)
+    feather.handle_command(['A', '8', '4'])
+    assert (feather.lwlp_reads, feather.ambient_reads) == (8, 4)
+    feather.handle_command(['A', '2'])
+    assert (feather.lwlp_reads, feather.ambient_reads) == (2, 1)
+    feather.handle_command(['A', '0', '-3'])
+    assert (feather.lwlp_reads, feather.ambient_reads) == (1, 1)
+
+
+def test_ambient_reads_reduce_ambient_noise():
+    model = TunnelModel(seed=1)
+    single = np.array([model.sample(0.0) for _ in range(2000)])
+    averaged = np.array([model.sample(0.0, ambient_reads=16) for _ in range(2000)])
+    ratio = averaged[:, :4].std(axis=0) / single[:, :4].std(axis=0)
+    assert np.allclose(ratio, 0.25, rtol=0.2)
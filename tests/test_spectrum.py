@@ -0,0 +1,74 @@
+import numpy as np
+from spectrum import StreamingSpectrum
+
+RATE = 1000.0                                               # Hz
+BLOCK = 1024
+TONE = 125.0                                                # Hz, bin 128 of a 1024 sample block at 1 kHz
+
+
+def signal(count, amplitude=2.0, noise=0.5, mean=10.0, seed=5):
+    times = np.arange(count) / RATE
+    rng = np.random.default_rng(seed)
+    return times, mean + amplitude * np.sin(2 * np.pi * TONE * times) + rng.normal(0, noise, count)
+
+
+def test_peak_frequency_and_parseval():
+    times, values = signal(16 * BLOCK)
+    spectrum = StreamingSpectrum(BLOCK, overlap=0.5, num_blocks=30)
+    spectrum.extend(times, values)
+    frequencies, density = spectrum.psd()
+    assert abs(spectrum.sample_rate - RATE) < 1e-6
+    assert frequencies[np.argmax(density)] == TONE
+    variance = 2.0 ** 2 / 2 + 0.5 ** 2                      # tone power A^2 / 2 plus the noise variance
+    assert abs(density.sum() * (frequencies[1] - frequencies[0]) / variance - 1) < 0.05
+    assert abs(spectrum.rms() ** 2 / variance - 1) < 0.05
+    assert abs(spectrum.mean() - 10.0) < 0.02
+    assert abs(spectrum.turbulence_intensity() - spectrum.rms() / spectrum.mean()) < 1e-12
+
+
+def test_density_of_a_block_computed_by_hand():
+    # np.hanning(4) is [0, 0.75, 0.75, 0], so the windowed block is [0, 0.75, 0, 0]: |rfft|^2 is 0.5625 in every
+    # bin and the window power is 2 * 0.5625. Dividing by 4 Hz * 1.125 gives 0.125, doubled for the one bin that is
+    # neither dc nor Nyquist.
+    spectrum = StreamingSpectrum(4, overlap=0, num_blocks=1)
+    spectrum.extend([0.0, 0.25, 0.5, 0.75], [3.0, 4.0, 3.0, 2.0])
+    frequencies, density = spectrum.psd()
+    assert spectrum.sample_rate == 4.0
+    assert np.allclose(frequencies, [0.0, 1.0, 2.0])
+    assert np.allclose(density, [0.125, 0.25, 0.125])
+    assert spectrum.mean() == 3.0
+    assert np.isclose(spectrum.rms() ** 2, 0.5)
+
+
+def test_white_noise_level():
+    times, values = signal(40 * BLOCK, amplitude=0.0)
+    spectrum = StreamingSpectrum(BLOCK, overlap=0.5, num_blocks=80)
+    spectrum.extend(times, values)
+    frequencies, density = spectrum.psd()
+    expected = 0.5 ** 2 / (RATE / 2)                        # one sided: the variance spread over 0 to Nyquist
+    assert abs(np.mean(density[1:-1]) / expected - 1) < 0.05
+
+
+def test_streaming_matches_one_batch():
+    times, values = signal(6 * BLOCK)
+    batch = StreamingSpectrum(BLOCK, overlap=0.5, num_blocks=8)
+    batch.extend(times, values)
+    streamed = StreamingSpectrum(BLOCK, overlap=0.5, num_blocks=8)
+    for start in range(0, len(values), 97):
+        streamed.extend(times[start:start + 97], values[start:start + 97])
+    assert streamed.blocks == batch.blocks == 11
+    assert np.allclose(streamed.psd()[1], batch.psd()[1])
+    assert np.allclose(streamed.rms(), batch.rms())
+
+
+def test_empty_and_non_finite():
+    spectrum = StreamingSpectrum(64)
+    assert spectrum.psd()[0].size == 0
+    assert np.isnan(spectrum.rms())
+    times, values = signal(200)
+    values[::10] = np.nan
+    spectrum.extend(times, values)
+    assert spectrum.blocks > 0
+    assert np.isfinite(spectrum.psd()[1]).all()
+    spectrum.clear()
+    assert spectrum.blocks == 0
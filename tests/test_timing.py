@@ -0,0 +1,59 @@
+import numpy as np
+from timing import ClockSync, SequenceTracker, counter_step, WRAP
+
+
+def test_counter_step_wraps():
+    assert counter_step(5, WRAP - 3) == 8
+    assert counter_step(WRAP - 3, 5) == -8
+    assert counter_step(7, 7) == 0
+
+
+def test_clock_sync_finds_offset_and_drift():
+    rng = np.random.default_rng(0)
+    sync = ClockSync(bin_seconds=1.0, num_bins=60)
+    offset, drift = 1000.0, 50e-6
+    for device_ms in range(0, 30000, 10):
+        host_time = offset + device_ms / 1000 * (1 + drift) + rng.exponential(0.005)
+        sync.add([device_ms], host_time)
+    measured = sync.to_host(29990)
+    assert abs(measured - (offset + 29.99 * (1 + drift))) < 0.002
+    assert abs(sync.drift - drift) < 20e-6
+
+
+def test_clock_sync_never_places_a_sample_after_it_arrived():
+    sync = ClockSync()
+    times = sync.add(np.array([1000, 1010, 1020]), 50.0)
+    assert all(time <= 50.0 for time in times)
+    assert times == sorted(times)
+
+
+def test_clock_sync_unwraps_device_time():
+    sync = ClockSync()
+    sync.add([WRAP - 10], 100.0)
+    aligned = sync.add([10], 100.02)[0]
+    assert sync.resets == 0
+    assert abs(aligned - 100.02) < 1e-9
+
+
+def test_clock_sync_starts_over_when_the_device_restarts():
+    sync = ClockSync()
+    for device_ms in range(0, 5000, 100):
+        sync.add([device_ms], 10 + device_ms / 1000)
+    aligned = sync.add([0], 20.0)[0]
+    assert sync.resets == 1
+    assert aligned == 20.0
+
+
+def test_sequence_tracker_counts_lost_repeated_and_resets():
+    tracker = SequenceTracker()
+    assert tracker.add(np.array([1, 2, 3])) == 0
+    assert tracker.add([6, 6]) == 2
+    assert tracker.add([0, 1]) == 0
+    assert (tracker.received, tracker.lost, tracker.repeated, tracker.resets) == (7, 2, 1, 1)
+    assert tracker.loss_fraction() == 2 / 9
+
+
+def test_sequence_tracker_wraps():
+    tracker = SequenceTracker()
+    assert tracker.add([WRAP - 2, WRAP - 1, 1]) == 1
+    assert tracker.resets == 0